@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+"""
+End to end benchmark of sdwire_upload without hardware.
+
+The sdwire is played by fake_sd_mux_ctrl.py, the printer by a simulated
+``_comm`` answering M21/M22/M20 from the card image, and the card by a
+FAT32 image file written with the plugin's FAT32 backend. Every case
+uploads ``count`` files of ``size`` MB in one batch and records how long
+each step took:
+
+  switch_usb   M22 and switching the card to the host
+  discovery    waiting for the card's block device
+  mount        opening the filesystem
+  copy         writing the files (sum over the batch)
+  resolve      short name lookups through the printer
+  switch_sd    switching back and waiting for M21
+  unmount      closing the filesystem, without switch_sd
+  total        first upload call to last success callback
+
+Results go to stdout (or --output) as JSON, --compare prints the change
+against an earlier run:
+
+  python benchmarks/bench_upload.py --sizes 1 10 --counts 1 5 -o new.json
+  python benchmarks/bench_upload.py --compare old.json new.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import octoprint_sdwire  # noqa: E402
+from octoprint_sdwire import fat32, mux  # noqa: E402
+
+PHASES = (
+    "switch_usb",
+    "discovery",
+    "mount",
+    "copy",
+    "resolve",
+    "switch_sd",
+    "unmount",
+    "total",
+)
+
+FAKE_SD_MUX_CTRL = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "fake_sd_mux_ctrl.py"
+)
+UUID = "B3DC-0001"
+SERIAL = "sd-wire_bench"
+
+
+class BenchSettings(object):
+    # just enough of OctoPrint's PluginSettings for the plugin
+    def __init__(self, values):
+        self._values = values
+
+    def get(self, path, **kwargs):
+        return self._values[path[0]]
+
+    def get_boolean(self, path, **kwargs):
+        return bool(self._values[path[0]])
+
+    def get_int(self, path, **kwargs):
+        return int(self._values[path[0]])
+
+    def get_float(self, path, **kwargs):
+        return float(self._values[path[0]])
+
+
+class BenchPluginManager(object):
+    def send_plugin_message(self, identifier, data):
+        pass
+
+
+class SimComm(object):
+    CAPABILITY_EXTENDED_M20 = "EXTENDED_M20"
+
+    def __init__(self, lfn):
+        self.lfn = lfn
+        self.sd_ready = False
+        self._firmware_capabilities_received = True
+
+    def _capability_supported(self, capability):
+        return self.lfn
+
+    def isSdReady(self):
+        return self.sd_ready
+
+
+class SimPrinter(object):
+    """
+    Printer with the card in its slot as long as the fake sdwire says
+    "sd". Responds to M21/M22 after ``latency`` seconds through the plugin's
+    gcode received hook, M20 reads the listing from the card image.
+    """
+
+    def __init__(self, plugin, state, image, latency, m20_latency, lfn):
+        self._plugin = plugin
+        self._state = state
+        self._image = image
+        self._latency = latency
+        self._m20_latency = m20_latency
+        self._comm = SimComm(lfn)
+        self._files = []
+
+    def _card_present(self):
+        with open(self._state) as f:
+            return f.read().strip() == "sd"
+
+    def _respond(self, line, ready):
+        time.sleep(self._latency)
+        self._comm.sd_ready = ready
+        self._plugin.sdwire_gcode_received(self._comm, line)
+
+    def is_ready(self):
+        return True
+
+    def is_sd_ready(self):
+        return self._comm.sd_ready
+
+    def commands(self, commands, force=False):
+        if commands == "M21":
+            if self._card_present():
+                line, ready = "SD card ok", True
+            else:
+                line, ready = "SD init fail", False
+        elif commands == "M22":
+            line, ready = "SD card released", False
+        else:
+            return
+        threading.Thread(target=self._respond, args=(line, ready)).start()
+
+    def refresh_sd_files(self, blocking=False):
+        if not (self._comm.sd_ready and self._card_present()):
+            self._files = []
+            return
+        volume = fat32.Fat32Volume(self._image)
+        try:
+            entries = [
+                e for e in volume.list_dir() if not e["attr"] & fat32.ATTR_DIRECTORY
+            ]
+        finally:
+            volume.close()
+        time.sleep(self._m20_latency * (1 + len(entries) / 10.0))
+        self._files = [
+            dict(
+                name=e["short_name"].lower(),
+                display=e["long_name"],
+                size=e["size"],
+                date=None,
+            )
+            for e in entries
+        ]
+
+    def get_sd_files(self, refresh=False):
+        if refresh:
+            self.refresh_sd_files(blocking=True)
+        return list(self._files)
+
+    def get_current_job(self):
+        # nothing selected, every uploaded file may be evicted
+        return dict(file=dict(name=None, path=None, origin=None))
+
+
+class Recorder(object):
+    # replaces plugin methods on the instance with timing wrappers
+    def __init__(self):
+        self.times = []
+
+    def wrap(self, obj, name, key):
+        original = getattr(obj, name)
+
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.times.append((key(*args, **kwargs), time.monotonic() - start))
+
+        setattr(obj, name, wrapper)
+
+    def reset(self):
+        self.times = []
+
+    def sum(self, key):
+        return sum(duration for k, duration in self.times if k == key)
+
+
+class Bench(object):
+    def __init__(self, args, workdir):
+        self.args = args
+        self.workdir = workdir
+        self.image = os.path.join(workdir, "card.img")
+        self.state = os.path.join(workdir, "mux-state")
+        self.by_uuid = os.path.join(workdir, "by-uuid")
+        os.mkdir(self.by_uuid)
+        with open(self.state, "w") as f:
+            f.write("sd")
+
+        config = os.path.join(workdir, "fake-sd-mux-ctrl.json")
+        with open(config, "w") as f:
+            json.dump(
+                dict(
+                    state=self.state,
+                    by_uuid_dir=self.by_uuid,
+                    uuid=UUID,
+                    image=self.image,
+                    switch_delay=args.switch_delay,
+                    enum_delay=args.enum_delay,
+                ),
+                f,
+            )
+        os.environ["SDWIRE_FAKE_CONFIG"] = config
+
+        self.recorder = Recorder()
+        self.plugin = self._make_plugin()
+
+    def _make_plugin(self):
+        # OctoPrint's extension tree needs a running plugin manager
+        octoprint_sdwire.valid_file_type = lambda filename, type=None: (
+            filename.lower().endswith((".gcode", ".gco", ".g"))
+        )
+
+        plugin = octoprint_sdwire.SdwirePlugin()
+        values = plugin.get_settings_defaults()
+        values.update(
+            sdwire_serial=SERIAL,
+            disk_uuid=UUID,
+            batch_window=0.0,
+            write_backend="fat32",
+            fat32_fsck=False,
+            skip_unchanged=False,
+        )
+        plugin._settings = BenchSettings(values)
+        plugin._plugin_manager = BenchPluginManager()
+        plugin._identifier = "sdwire"
+        plugin._data_folder = os.path.join(self.workdir, "data")
+        os.mkdir(plugin._data_folder)
+        plugin.get_plugin_data_folder = lambda: plugin._data_folder
+        plugin._by_uuid_dir = self.by_uuid
+        plugin._mux = mux.MuxController(
+            mux.SdMuxCtrlBackend(FAKE_SD_MUX_CTRL, SERIAL, sudo=None)
+        )
+        plugin._mux_serial = SERIAL
+        plugin._printer = SimPrinter(
+            plugin,
+            self.state,
+            self.image,
+            self.args.printer_latency,
+            self.args.m20_latency,
+            not self.args.no_lfn,
+        )
+
+        r = self.recorder
+        r.wrap(plugin, "sdwire_switch", lambda mode: "switch_" + mode)
+        r.wrap(plugin, "_wait_for_disk", lambda *a: "discovery")
+        r.wrap(plugin, "sdwire_open_volume", lambda *a: "open")
+        r.wrap(plugin, "sdwire_close_volume", lambda *a, **kw: "close")
+        r.wrap(plugin, "_write_card_file", lambda *a: "copy")
+        r.wrap(plugin, "_get_remote_filenames", lambda *a: "resolve")
+        r.wrap(plugin, "_get_vfat_remote_filenames", lambda *a: "resolve")
+        return plugin
+
+    def _make_files(self, size, count, run):
+        paths = []
+        block = os.urandom(1024 * 1024)
+        for i in range(count):
+            path = os.path.join(
+                self.workdir, "Benchmark part {:03d} run {}.gcode".format(i, run)
+            )
+            with open(path, "wb") as f:
+                # a different first block per file so no two are alike
+                f.write(os.urandom(min(len(block), size)))
+                left = size - min(len(block), size)
+                while left > 0:
+                    f.write(block[:left])
+                    left -= min(len(block), left)
+            paths.append(path)
+        return paths
+
+    def run_case(self, size, count, run):
+        fat32.mkfs(
+            self.image, self.args.image_size * 1024 * 1024, self.args.cluster_size
+        )
+        paths = self._make_files(size, count, run)
+
+        done = threading.Event()
+        results = []
+
+        def finished(ok):
+            def callback(filename, remote_filename, elapsed):
+                results.append((ok, filename, remote_filename))
+                if len(results) == count:
+                    done.set()
+
+            return callback
+
+        self.recorder.reset()
+        start = time.monotonic()
+        for path in paths:
+            self.plugin.sdwire_upload(
+                self.plugin._printer,
+                os.path.basename(path),
+                path,
+                lambda filename, remote_filename: None,
+                finished(True),
+                finished(False),
+            )
+        if not done.wait(self.args.timeout):
+            raise RuntimeError(
+                "uploads did not finish in {}s".format(self.args.timeout)
+            )
+        total = time.monotonic() - start
+
+        for path in paths:
+            os.unlink(path)
+        failed = [r for r in results if not r[0]]
+        if failed:
+            raise RuntimeError("uploads failed: {}".format(failed))
+
+        r = self.recorder
+        attach = r.sum("switch_usb") + r.sum("discovery")
+        phases = dict(
+            switch_usb=r.sum("switch_usb"),
+            discovery=r.sum("discovery"),
+            mount=max(0.0, r.sum("open") - attach),
+            copy=r.sum("copy"),
+            resolve=r.sum("resolve"),
+            switch_sd=r.sum("switch_sd"),
+            unmount=max(0.0, r.sum("close") - r.sum("switch_sd")),
+            total=total,
+        )
+        phases["throughput"] = size * count / total / 1000000 if total else 0.0
+        return phases
+
+
+def _median(runs, key):
+    return statistics.median(run[key] for run in runs)
+
+
+def _git_revision():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="sdwire-bench-")
+    try:
+        bench = Bench(args, workdir)
+        cases = []
+        for size_mb in args.sizes:
+            for count in args.counts:
+                size = int(size_mb * 1000000)
+                runs = [bench.run_case(size, count, i) for i in range(args.repeat)]
+                case = dict(
+                    size=size,
+                    count=count,
+                    runs=runs,
+                    median=dict(
+                        (key, _median(runs, key)) for key in PHASES + ("throughput",)
+                    ),
+                )
+                cases.append(case)
+                print(
+                    "{:>8} x {:<3} total {:.3f}s, copy {:.3f}s, {:.1f} MB/s".format(
+                        "{}MB".format(size_mb),
+                        count,
+                        case["median"]["total"],
+                        case["median"]["copy"],
+                        case["median"]["throughput"],
+                    ),
+                    file=sys.stderr,
+                )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return dict(
+        version=1,
+        meta=dict(
+            time=time.time(),
+            revision=_git_revision(),
+            python=platform.python_version(),
+            platform=platform.platform(),
+            args=dict(
+                (key, value)
+                for key, value in vars(args).items()
+                if key not in ("output", "compare")
+            ),
+        ),
+        cases=cases,
+    )
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    old_cases = dict(((c["size"], c["count"]), c["median"]) for c in old["cases"])
+    print(
+        "{} ({}) -> {} ({})".format(
+            old_path, old["meta"]["revision"], new_path, new["meta"]["revision"]
+        )
+    )
+    for case in new["cases"]:
+        before = old_cases.get((case["size"], case["count"]))
+        if before is None:
+            continue
+        print("{:.0f}MB x {}:".format(case["size"] / 1000000, case["count"]))
+        for key in PHASES:
+            a, b = before[key], case["median"][key]
+            change = "{:+.1f}%".format((b - a) / a * 100) if a else "n/a"
+            print("  {:<11} {:9.4f}s -> {:9.4f}s  {}".format(key, a, b, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sdwire upload benchmark")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--counts", type=int, nargs="+", default=[1, 5])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--switch-delay", type=float, default=0.05)
+    parser.add_argument("--enum-delay", type=float, default=0.3)
+    parser.add_argument("--printer-latency", type=float, default=0.05)
+    parser.add_argument("--m20-latency", type=float, default=0.2)
+    parser.add_argument(
+        "--no-lfn", action="store_true", help="printer without long file names"
+    )
+    parser.add_argument("--image-size", type=int, default=0, help="MB, default: fit")
+    parser.add_argument("--cluster-size", type=int, default=4096)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("-o", "--output")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files"
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    if not args.image_size:
+        # room for the largest batch, at least what FAT32 needs
+        needed = max(args.sizes) * max(args.counts) * 1.2
+        minimum = 65536 * args.cluster_size * 1.05 / 1000000
+        args.image_size = int(max(needed, minimum)) + 1
+
+    result = run(args)
+    data = json.dumps(result, indent=1)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Stand-in for sd-mux-ctrl used by bench_upload.py. Reads its setup from the
+# JSON file named by $SDWIRE_FAKE_CONFIG:
+#
+#   state         file holding the current side, "sd" or "usb"
+#   by_uuid_dir   directory playing /dev/disk/by-uuid
+#   uuid, image   link name and the card image it points to
+#   switch_delay  seconds a switch takes
+#   enum_delay    seconds until the "usb device" shows up after --ts
+#
+# Like the real tool it returns before the card is enumerated, the link
+# appears later from a child process.
+
+import json
+import os
+import sys
+import time
+
+
+def main():
+    with open(os.environ["SDWIRE_FAKE_CONFIG"]) as f:
+        config = json.load(f)
+    link = os.path.join(config["by_uuid_dir"], config["uuid"])
+
+    actions = [arg for arg in sys.argv[1:] if not arg.startswith("--device-serial")]
+    if actions == ["--status"]:
+        with open(config["state"]) as f:
+            state = f.read().strip()
+        print("SD connected to: {}".format("DUT" if state == "sd" else "TS"))
+        return 0
+
+    if actions == ["--dut"]:
+        mode = "sd"
+    elif actions == ["--ts"]:
+        mode = "usb"
+    else:
+        print("usage: {} --device-serial=X --dut|--ts|--status".format(sys.argv[0]))
+        return 1
+
+    time.sleep(config["switch_delay"])
+    with open(config["state"], "w") as f:
+        f.write(mode)
+
+    if mode == "sd":
+        if os.path.lexists(link):
+            os.unlink(link)
+        return 0
+
+    if os.fork() == 0:
+        # don't hold the caller's pipes open while "enumerating"
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        time.sleep(config["enum_delay"])
+        tmp = link + ".tmp"
+        os.symlink(config["image"], tmp)
+        os.rename(tmp, link)
+        os._exit(0)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,46 @@
 from __future__ import absolute_import
 
 import datetime
+import errno
 import logging
 import os
+import platform
+import shutil
 import subprocess
 import tempfile
 import threading
 import time
+from urllib.parse import quote
 
+import flask
 import octoprint.plugin
+from octoprint.access.permissions import Permissions
 from octoprint.events import Events
-
-from . import _vfatdir
+from octoprint.filemanager import valid_file_type
+from octoprint.util import get_dos_filename
+from octoprint.util.comm import SDFileData
+
+from . import (
+    capabilities,
+    cardfiles,
+    copier,
+    discovery,
+    fat32,
+    gcode,
+    jobs,
+    manifest,
+    metrics,
+    mux,
+    pool,
+    progress,
+    sdindex,
+    sdstate,
+    vfat,
+)
+
+# seconds the listing of a card session stands in for the printer's M20 after
+# the card went back to it
+CARD_LISTING_TTL = 10.0
 
 
 class SdwirePlugin(
@@ -20,22 +49,122 @@ class SdwirePlugin(
     octoprint.plugin.AssetPlugin,
     octoprint.plugin.TemplatePlugin,
     octoprint.plugin.EventHandlerPlugin,
+    octoprint.plugin.SimpleApiPlugin,
 ):
     def __init__(self):
         super(SdwirePlugin, self).__init__()
         self._logger = logging.getLogger("octoprint.plugins.sdwire")
-        self.lfn = False
+        self._upload_lock = threading.Lock()
+        # held by the session that has the card on the host side
+        self._session_lock = threading.Lock()
+        self._upload_thread = None
+        self._jobs = jobs.JobQueue()
+        self._job = None
+        self._progress = None
+        self._by_uuid_dir = discovery.BY_UUID_DIR
+        self._sd_waiter = sdstate.SdStateWaiter()
+        self._sd_index = sdindex.SdIndex()
+        self._card_listing = None
+        self._mux_lock = threading.Lock()
+        self._mux = None
+        self._mux_serial = None
+        self._device = None
+        self._scheduler = None
+        self._short_names = None
+        self._volume = None
+        self._manifest = None
+        self._manifest_uuid = None
+        self._hash_cache = None
+        self._journal = None
+        self._capabilities = None
+        self._write_speed = None
+        self._metrics = metrics.Metrics()
+        self._timing = None
 
     def on_startup(self, host, port):
-        self._logger.info(
-            "OctoPrint-Sdwire (sdwire_serial={}, disk_uuid={})".format(
-                self._settings.get(["sdwire_serial"]), self._settings.get(["disk_uuid"])
+        for device in self._get_devices():
+            self._logger.info(
+                "OctoPrint-Sdwire (sdwire_serial={}, disk_uuid={}, printer={})".format(
+                    device.serial, device.uuid, device.printer or "any"
+                )
             )
-        )
+        self._start_probe()
 
     def on_event(self, event, payload):
         if event == Events.CONNECTING:
-            self.sdwire_low_switch(mode="sd")
+            self._sd_index.invalidate()
+            self._card_listing = None
+            device = self._get_device(port=(payload or {}).get("port"))
+            if device:
+                self.sdwire_low_switch(mode="sd", device=device)
+        elif event == Events.CONNECTED:
+            # the printer on this port may use another sdwire
+            self._start_probe()
+        elif event == Events.DISCONNECTED:
+            self._sd_index.invalidate()
+            self._card_listing = None
+        elif event == Events.UPDATED_FILES:
+            # sd state might have changed, let waiters re-check
+            self._sd_waiter.notify()
+            if (payload or {}).get("type") == "printables":
+                self._reload_sd_index()
+        elif event == Events.PRINT_STARTED and payload.get("origin") == "sdcard":
+            self._record_print(payload.get("path") or payload.get("name"))
+
+    ##~~ Gcode received hook
+
+    def sdwire_gcode_received(self, comm, line, *args, **kwargs):
+        state = sdstate.parse_line(line)
+        if state is not None:
+            self._sd_waiter.set_state(state)
+            if not state:
+                # card removed or swapped, its listing is gone
+                self._sd_index.invalidate()
+        return line
+
+    ##~~ Gcode queuing hook
+
+    def sdwire_gcode_queuing(
+        self,
+        comm,
+        phase,
+        cmd,
+        cmd_type,
+        gcode,
+        subcode=None,
+        tags=None,
+        *args,
+        **kwargs
+    ):
+        # right after a card session the printer's listing comes from its scan
+        if (
+            gcode == "M20"
+            and "trigger:comm.refresh_sd_files" in (tags or ())
+            and self._publish_card_listing(comm)
+        ):
+            self._logger.debug("Serving {} from the card scan".format(cmd))
+            return (None,)
+
+    ##~~ Firmware capability report hook
+
+    def sdwire_capability_report(self, comm, capabilities, *args, **kwargs):
+        # remembered for uploads before the report of the next connection
+        device = self._get_device()
+        if device:
+            self._get_capabilities().set(
+                "lfn",
+                device.serial,
+                comm._capability_supported(comm.CAPABILITY_EXTENDED_M20),
+            )
+
+    ##~~ Extension tree hook
+
+    def sdwire_extension_tree(self, *args, **kwargs):
+        # converted uploads end up as .bgcode (.bgc short names) on the card,
+        # OctoPrint drops files from the printer's listing it doesn't know
+        if not self._settings.get_boolean(["binary_gcode"]):
+            return None
+        return dict(machinecode=dict(bgcode=["bgcode", "bgc"]))
 
     ##~~ SettingsPlugin mixin
 
@@ -44,11 +173,149 @@ class SdwirePlugin(
             sd_mux_ctrl="/usr/local/bin/sd-mux-ctrl",
             sdwire_serial="sd-wire_11",
             disk_uuid="",
+            batch_uploads=True,
+            batch_window=1.0,
+            zero_copy=True,
+            copy_buffer_size=0,
+            writeback_limit=32,
+            progress_interval=0.5,
+            progress_step=1.0,
+            device_timeout=5.0,
+            mux_backend="sd-mux-ctrl",
+            switch_settle=0.3,
+            write_backend="mount",
+            fat32_fsck=True,
+            skip_unchanged=True,
+            strip_comments=False,
+            strip_thumbnails=False,
+            trim_precision=False,
+            precision_xyz=3,
+            precision_e=5,
+            binary_gcode=False,
+            bgcode_printer_model="",
+            devices="",
+            parallel_copies=2,
+            lock_dir="",
+            evict_policy="off",
+            evict_protected="",
+            evict_dry_run=False,
+            preallocate=True,
+            resume_uploads=True,
+            resume_checkpoint=16,
+            verify_uploads=False,
         )
 
+    def on_settings_save(self, data):
+        octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        self._reset_mux()
+        self._scheduler = None
+
     def get_template_configs(self):
         return [{"type": "settings", "custom_bindings": False}]
 
+    ##~~ SimpleApiPlugin mixin
+
+    def on_api_get(self, request):
+        # files fetched by the card command, GET ?download=<path>
+        if "download" in request.values:
+            if not Permissions.FILES_DOWNLOAD.can():
+                return flask.abort(403)
+            return flask.send_from_directory(
+                self._get_downloads_folder(),
+                request.values["download"],
+                as_attachment=True,
+            )
+
+        # phase timings, GET ?format=prometheus for Prometheus' text format
+        if request.values.get("format") == "prometheus":
+            return flask.Response(
+                self._metrics.prometheus(),
+                mimetype="text/plain; version=0.0.4; charset=utf-8",
+            )
+
+        limit = request.values.get("limit", 20, type=int)
+        return flask.jsonify(
+            summary=self._metrics.summary(),
+            recent=self._metrics.recent(limit),
+            sd_waits=list(self._sd_waiter.waits)[-limit:] if limit else [],
+            jobs=self._jobs.status(),
+            capabilities=self._get_capabilities().to_dict(),
+        )
+
+    def get_api_commands(self):
+        return dict(cancel=["id"], prioritize=["id"], card=[])
+
+    def on_api_command(self, command, data):
+        if command == "card":
+            return self._card_command(data)
+
+        if not Permissions.FILES_UPLOAD.can():
+            return flask.abort(403)
+
+        if command == "cancel":
+            job = self._jobs.cancel(data["id"])
+            if job is None:
+                return flask.abort(409, description="No such queued or running upload")
+            self._logger.info("Cancelling upload of {}".format(job["filename"]))
+            if job.state == jobs.CANCELLED:
+                # never started, the worker won't see it again
+                job["failure_cb"](job["filename"], job["remote_filename"], 0)
+        else:
+            try:
+                priority = int(data.get("priority", jobs.PRIORITY_SELECTED))
+            except (TypeError, ValueError):
+                return flask.abort(400, description="priority must be a number")
+            job = self._jobs.prioritize(data["id"], priority)
+            if job is None:
+                return flask.abort(409, description="No such queued upload")
+        return flask.jsonify(job.to_dict())
+
+    # List the card and delete, rename or download files on it, all in one
+    # session with the card on the host side.
+    def _card_command(self, data):
+        delete = data.get("delete") or []
+        rename = data.get("rename") or []
+        download = data.get("download") or []
+        if not all(isinstance(value, list) for value in (delete, rename, download)):
+            return flask.abort(
+                400, description="delete, rename and download take lists"
+            )
+        paths = delete + download
+        for item in rename:
+            if not isinstance(item, list) or len(item) != 2:
+                return flask.abort(
+                    400, description="rename takes [path, new name] pairs"
+                )
+            paths += item
+        if not all(isinstance(path, str) for path in paths):
+            return flask.abort(400, description="Card paths must be strings")
+        if not Permissions.FILES_LIST.can():
+            return flask.abort(403)
+        if (delete or rename) and not Permissions.FILES_DELETE.can():
+            return flask.abort(403)
+        if download and not Permissions.FILES_DOWNLOAD.can():
+            return flask.abort(403)
+
+        device = self._get_device()
+        if device is None or not device.uuid:
+            return flask.abort(409, description="No sdwire card configured")
+        if not self._check_printer_state():
+            return flask.abort(
+                409, description="Printer is not ready or sd card is in use"
+            )
+        # uploads keep the card, try again once they are done
+        if not self._session_lock.acquire(blocking=False):
+            return flask.abort(409, description="The card is busy with uploads")
+        try:
+            result = self._run_session(
+                "card", device, self._card_session, delete, rename, download
+            )
+        finally:
+            self._session_lock.release()
+        if result is None:
+            return flask.abort(503, description="The card could not be opened")
+        return flask.jsonify(**result)
+
     ##~~ AssetPlugin mixin
 
     def get_assets(self):
@@ -77,16 +344,29 @@ class SdwirePlugin(
             return False
         return True
 
+    def _is_sd_ready(self):
+        if not self._printer._comm:
+            return None
+        return self._printer._comm.isSdReady()
+
     # wait for sd card being available or unavailable
     def _wait_for_sdcard_state(self, timeout, wait_for_notavailable):
-        sdready = wait_for_notavailable
-        # wait up to timeout for sd card to appear
-        for _i in range(timeout * 10):
-            sdready = self._printer._comm.isSdReady()
-            if sdready != wait_for_notavailable:
-                break
-            time.sleep(0.1)
-        return sdready != wait_for_notavailable
+        result = self._sd_waiter.wait(
+            not wait_for_notavailable, timeout, check=self._is_sd_ready
+        )
+        self._metrics.record_phase(
+            "sd_wait", result["state"], result["duration"], result["ok"]
+        )
+        self._logger.info(
+            "SD card {}{} after {:.2f}s (timeout {}s, via {})".format(
+                "" if result["ok"] else "not ",
+                result["state"],
+                result["duration"],
+                timeout,
+                result["source"],
+            )
+        )
+        return result["ok"]
 
     def _wait_for_sdcard(self, timeout):
         return self._wait_for_sdcard_state(timeout, False)
@@ -94,86 +374,167 @@ class SdwirePlugin(
     def _wait_for_nosdcard(self, timeout):
         return self._wait_for_sdcard_state(timeout, True)
 
-    def _get_vfat_remote_filename(self, vfatdir, filename):
+    def _predict_vfat_remote_filename(self, filename):
         try:
-            short_name = _vfatdir.get_short_name(vfatdir, filename)
+            short_name = self._short_names.predict(filename)
         except Exception as e:
-            self._logger.exception("Getting vfat remote filename failed: {}".format(e))
+            self._logger.exception(
+                "Predicting vfat remote filename failed: {}".format(e)
+            )
             return None
 
         if short_name:
-            short_name = short_name.decode().lower()
-            self._logger.debug(
-                "Found short filename {} for {} using vfat ioctl".format(
-                    short_name, filename
+            # reserve it for the rest of the batch
+            self._short_names.add(filename, short_name)
+        return short_name
+
+    def _get_vfat_remote_filenames(self, filenames):
+        # one directory pass for all files written in this session
+        self._short_names.invalidate()
+        short_names = {}
+        for filename in filenames:
+            try:
+                short_name = self._short_names.lookup(filename)
+            except Exception as e:
+                self._logger.exception(
+                    "Getting vfat remote filename failed: {}".format(e)
                 )
-            )
-            return short_name
+                break
 
-        return None
+            if short_name:
+                self._logger.debug(
+                    "Found short filename {} for {} using vfat ioctl".format(
+                        short_name, filename
+                    )
+                )
+                short_names[filename] = short_name
+        else:
+            # the directory pass saw every file on the card
+            for long_name, short_name in self._short_names.items():
+                self._sd_index.add(long_name, short_name)
+
+        return short_names
+
+    # OctoPrint's cached listing, M20 isn't sent
+    def _reload_sd_index(self):
+        if self._printer.is_sd_ready():
+            self._sd_index.load(self._printer.get_sd_files())
+
+    def _get_sd_index(self):
+        if not self._sd_index.loaded:
+            self._reload_sd_index()
+        return self._sd_index
+
+    def _lookup_remote_filenames(self, filenames, timestamp):
+        short_names = {}
+        for filename in filenames:
+            short_name = self._sd_index.lookup(filename, timestamp)
+            if short_name:
+                self._logger.debug(
+                    "Found short filename {} for {}".format(short_name, filename)
+                )
+                short_names[filename] = short_name
+        return short_names
 
-    def _get_remote_filename(self, filename, timestamp):
+    def _get_remote_filenames(self, filenames, timestamp):
         self._wait_for_sdcard(10)
 
-        files = self._printer.get_sd_files(refresh=True)
-        # Exact match.
-        for item in files:
-            if item["display"] == filename and item["name"]:
-                self._logger.debug(
-                    "Found short filename {} for {}".format(filename, item["name"])
-                )
-                return item["name"]
-        # Partial match since printers have limited filename length (56 characters on prusa MK3).
-        printer_supported_filename_length = 20
-        if len(filename) > printer_supported_filename_length:
-            for item in files:
-                if (
-                    item["display"]
-                    and len(item["display"]) > printer_supported_filename_length
-                    and filename.startswith(item["display"])
-                    and item["name"]
-                    and item["date"]
-                    and int(item["date"]) >= timestamp
-                ):
-                    self._logger.debug(
-                        "Found short filename {} for {} by partial match".format(
-                            item["name"], filename
-                        )
-                    )
-                    return item["name"]
-        return None
+        self._get_sd_index()
+        short_names = self._lookup_remote_filenames(filenames, timestamp)
+        missing = [filename for filename in filenames if filename not in short_names]
+        if missing:
+            # One listing for all files not indexed yet, M20 over serial is slow.
+            self._sd_index.load(self._printer.get_sd_files(refresh=True))
+            short_names.update(self._lookup_remote_filenames(missing, timestamp))
+        return short_names
 
     def sdwrite_notify_error(self, message):
         self._plugin_manager.send_plugin_message(self._identifier, dict(error=message))
 
-    def sdwire_low_switch(self, mode):
+    def _get_devices(self):
+        return pool.configured_devices(
+            self._settings.get(["devices"]),
+            self._settings.get(["sdwire_serial"]),
+            self._settings.get(["disk_uuid"]),
+        )
+
+    # the device whose card is in the connected (or connecting) printer
+    def _get_device(self, port=None):
+        devices = self._get_devices()
+        if len(devices) <= 1:
+            return devices[0] if devices else None
+        (
+            _state,
+            current_port,
+            _baudrate,
+            profile,
+        ) = self._printer.get_current_connection()
+        return pool.select_device(
+            devices,
+            port=port or current_port,
+            profile=profile.get("id") if profile else None,
+        )
+
+    def _get_scheduler(self):
+        if self._scheduler is None:
+            self._scheduler = pool.HostScheduler(
+                self._settings.get(["lock_dir"]) or pool.default_lock_dir(),
+                slots=self._settings.get_int(["parallel_copies"]),
+                logger=self._logger,
+            )
+        return self._scheduler
+
+    def _get_mux(self, serial):
+        with self._mux_lock:
+            if self._mux is not None and self._mux_serial != serial:
+                self._mux.close()
+                self._mux = None
+            if self._mux is None:
+                if self._settings.get(["mux_backend"]) == "ftdi":
+                    backend = mux.FtdiBackend(serial, logger=self._logger)
+                else:
+                    backend = mux.SdMuxCtrlBackend(
+                        self._settings.get(["sd_mux_ctrl"]), serial, logger=self._logger
+                    )
+                self._mux = mux.MuxController(
+                    backend,
+                    logger=self._logger,
+                    settle=self._settings.get_float(["switch_settle"]),
+                )
+                self._mux_serial = serial
+            return self._mux
+
+    def _reset_mux(self):
+        with self._mux_lock:
+            if self._mux is not None:
+                self._mux.close()
+                self._mux = None
+
+    def sdwire_low_switch(self, mode, force=False, device=None):
         mode = mode.lower()
         if mode not in ["sd", "usb"]:
             self._logger.error("sdwire_low_switch(): unknown mode: {}".format(mode))
             return False
 
-        if mode == "sd":
-            # switching to SD is unreliable on some printers, so try harder
-            actions = ["--ts", "--dut", "--ts", "--dut"]
-        elif mode == "usb":
-            actions = ["--dut", "--ts"]
+        # the device of the running upload, else the connected printer's
+        device = device or self._device or self._get_device()
+        if device is None:
+            self._logger.error("sdwire_low_switch(): no sdwire device configured")
+            return False
 
         self._logger.debug("Switching sdwire to {}.".format(mode.upper()))
+        start = time.monotonic()
+        try:
+            switched = self._get_mux(device.serial).switch(mode, force=force)
+        except Exception as e:
+            self._logger.exception("Sdwire controller failed: {}".format(e))
+            self._reset_mux()
+            switched = False
+        self._metrics.record_phase("switch", mode, time.monotonic() - start, switched)
 
-        for a in actions:
-            if not self._run_cmd(
-                [
-                    "/usr/bin/sudo",
-                    self._settings.get(["sd_mux_ctrl"]),
-                    "--device-serial={}".format(self._settings.get(["sdwire_serial"])),
-                    a,
-                ]
-            ):
-                self._logger.debug(
-                    "Switching sdwire to {} failed.".format(mode.upper())
-                )
-                return False
-            time.sleep(0.3)
+        if not switched:
+            self._logger.debug("Switching sdwire to {} failed.".format(mode.upper()))
+            return False
 
         self._logger.debug("Sdwire switched to {}.".format(mode.upper()))
         return True
@@ -185,6 +546,9 @@ class SdwirePlugin(
             return False
 
         if mode == "usb":
+            # whatever was scanned before may change now
+            self._card_listing = None
+            self._sd_waiter.reset()
             self._printer.commands("M22", force=True)
             self._wait_for_nosdcard(timeout=2)
 
@@ -192,30 +556,914 @@ class SdwirePlugin(
             return False
 
         if mode == "sd":
+            self._sd_waiter.reset()
             self._printer.commands("M21", force=True)
-            self._wait_for_sdcard(timeout=2)
+            if not self._wait_for_sdcard(timeout=2):
+                # switching to SD is unreliable on some printers, toggle the
+                # card once more so the printer sees it being inserted
+                self._logger.info("Printer did not pick up the SD card, retrying.")
+                self.sdwire_low_switch("usb", force=True)
+                self.sdwire_low_switch("sd", force=True)
+                self._sd_waiter.reset()
+                self._printer.commands("M21", force=True)
+                self._wait_for_sdcard(timeout=2)
+            # served from the card scan when there is one, see sdwire_gcode_queuing
             self._printer.refresh_sd_files()
 
         return True
 
+    def _get_free_remote_name(self, printer, filename, reserved):
+        # like printer._get_free_remote_name() but also avoids names already
+        # taken by uploads queued in the current batch
+        if not reserved:
+            printer.refresh_sd_files(blocking=True)
+        existing = [x["name"] for x in printer.get_sd_files()] + list(reserved)
+
+        if valid_file_type(filename, "gcode"):
+            return get_dos_filename(
+                filename,
+                existing_filenames=existing,
+                extension="gco",
+                whitelisted_extensions=["gco", "g"],
+            )
+        return os.path.basename(filename)
+
+    # time a phase of the running upload batch, not recorded outside of one
+    def _timed(self, phase):
+        return (self._timing or metrics.Timing(None)).phase(phase)
+
+    def sdwire_send_progress(self, data):
+        if self._job is not None:
+            data["job"] = self._job.id
+        self._plugin_manager.send_plugin_message(self._identifier, data)
+
+    def _set_phase(self, phase, filename=None, total=None, copied=0):
+        if self._job is not None:
+            self._job.phase = phase
+        self._progress.set_phase(phase, filename=filename, total=total, copied=copied)
+
+    # progress callback of everything reading or writing the card for a job,
+    # stops it once the job is cancelled
+    def _copy_progress(self, copied, total=None):
+        job = self._job
+        if job is not None:
+            job.check_cancelled()
+        self._progress.update(copied, total)
+        if job is not None:
+            job.progress = self._progress.percent
+
+    def sdwire_copyfile(
+        self, src, dst, progress_cb, hasher=None, resume_from=0, checkpoint_cb=None
+    ):
+        return copier.copy_file(
+            src,
+            dst,
+            progress_cb=progress_cb,
+            bufsize=self._settings.get_int(["copy_buffer_size"]) * 1024,
+            zero_copy=self._settings.get_boolean(["zero_copy"]),
+            hasher=hasher,
+            preallocate_dst=self._settings.get_boolean(["preallocate"]),
+            resume_from=resume_from,
+            checkpoint_cb=checkpoint_cb,
+            checkpoint_interval=self._settings.get_int(["resume_checkpoint"])
+            * 1024
+            * 1024,
+            writeback_limit=self._get_writeback_limit(),
+        )
+
+    # bytes an upload may leave dirty in the page cache, 0 for no limit
+    def _get_writeback_limit(self):
+        return max(self._settings.get_int(["writeback_limit"]) or 0, 0) * 1024 * 1024
+
+    # host side copy of the card's manifest, one per card uuid
+    def _get_manifest(self, uuid):
+        if self._manifest is None or self._manifest_uuid != uuid:
+            self._manifest = manifest.Manifest(
+                os.path.join(
+                    self.get_plugin_data_folder(), "manifest-{}.json".format(uuid)
+                )
+            )
+            self._manifest_uuid = uuid
+        return self._manifest
+
+    def _get_hash_cache(self):
+        if self._hash_cache is None:
+            self._hash_cache = manifest.HashCache(
+                os.path.join(self.get_plugin_data_folder(), "hashes.json")
+            )
+        return self._hash_cache
+
+    def _get_journal(self):
+        if self._journal is None:
+            self._journal = manifest.UploadJournal(
+                os.path.join(self.get_plugin_data_folder(), "journal.json")
+            )
+        return self._journal
+
+    def _get_capabilities(self):
+        if self._capabilities is None:
+            self._capabilities = capabilities.CapabilityCache(
+                os.path.join(self.get_plugin_data_folder(), "capabilities.json")
+            )
+        return self._capabilities
+
+    def _start_probe(self):
+        thread = threading.Thread(target=self._probe, name="sdwire-probe")
+        thread.daemon = True
+        thread.start()
+
+    # Find out once what uploads would otherwise find out the slow way and
+    # load what they need, so that the first one doesn't pay for it. Mount
+    # options need the card on the host side, they are learned by the first
+    # mount instead (see sdwire_mount).
+    def _probe(self):
+        try:
+            learned = self._get_capabilities()
+            release = platform.release()
+            if learned.get("host", "kernel") != release:
+                # another kernel may take other mount options
+                learned.clear("mount")
+                learned.set("host", "kernel", release)
+            learned.set("host", "by_uuid", os.path.isdir(self._by_uuid_dir))
+            self._get_hash_cache()
+            self._get_journal()
+            self._get_scheduler()
+
+            device = self._get_device()
+            if device is None:
+                return
+            if device.uuid:
+                self._get_manifest(device.uuid)
+            # don't query the sdwire behind the back of a running session
+            if not self._session_lock.acquire(blocking=False):
+                return
+            try:
+                self._probe_mux(device)
+            finally:
+                self._session_lock.release()
+        except Exception as e:
+            self._logger.exception("Probing failed: {}".format(e))
+
+    def _probe_mux(self, device):
+        try:
+            mode = self._get_mux(device.serial).refresh()
+        except Exception as e:
+            self._logger.warning(
+                "Sdwire {} is not reachable: {}".format(device.serial, e)
+            )
+            self._reset_mux()
+            mode = None
+            reachable = False
+        else:
+            # an open FTDI doesn't know its mode until the first switch
+            reachable = (
+                mode is not None or self._settings.get(["mux_backend"]) == "ftdi"
+            )
+        if mode:
+            state = "in {} mode".format(mode.upper())
+        else:
+            state = "reachable" if reachable else "not reachable"
+        self._logger.info("Sdwire {} {}".format(device.serial, state))
+        self._get_capabilities().set("mux", device.serial, reachable)
+
+    # EXTENDED_M20 support of the printer, until its capability report of this
+    # connection is in what it reported the last time
+    def _printer_lfn(self, comm):
+        lfn = comm._capability_supported(comm.CAPABILITY_EXTENDED_M20)
+        device = self._get_device()
+        if comm._firmware_capabilities_received or device is None:
+            return lfn
+        return self._get_capabilities().get("lfn", device.serial, lfn)
+
+    # remote name of an identical copy already on the card, None if there's none
+    def _find_unchanged(self, printer, uuid, filename, path, pipeline):
+        if not uuid or not self._settings.get_boolean(["skip_unchanged"]):
+            return None
+
+        entry = self._get_manifest(uuid).get(filename)
+        if not entry or not entry["hash"]:
+            return None
+        if entry.get("transform") != (pipeline.signature() if pipeline else None):
+            return None
+        try:
+            # cheap checks first, the hash is only computed when sizes match
+            if entry["size"] != os.path.getsize(path):
+                return None
+            digest = self._get_hash_cache().hash(path)
+        except OSError as e:
+            self._logger.debug("Hashing {} failed: {}".format(path, e))
+            return None
+        if digest != entry["hash"]:
+            return None
+
+        # the printer's own listing tells whether the file is still there
+        remote_filename = entry.get("short") or entry["remote"]
+        if remote_filename not in self._get_sd_index():
+            return None
+        return remote_filename
+
+    def _read_card_manifest(self, uuid):
+        if self._use_fat32():
+            data = self._volume.read_file(manifest.MANIFEST_NAME)
+            names = dict(
+                (entry["long_name"], entry["size"]) for entry in self._volume.list_dir()
+            )
+        else:
+            try:
+                with open(
+                    os.path.join(self.mdir_name, manifest.MANIFEST_NAME), "rb"
+                ) as f:
+                    data = f.read()
+            except FileNotFoundError:
+                data = None
+            names = dict(
+                (entry.name, entry.stat().st_size)
+                for entry in os.scandir(self.mdir_name)
+                if entry.is_file()
+            )
+
+        card_manifest = self._get_manifest(uuid)
+        # without a manifest on the card nothing there is known to be ours
+        card_manifest.loads(data or "{}")
+        card_manifest.prune(names)
+
+    def _write_card_manifest(self, uuid, done):
+        card_manifest = self._get_manifest(uuid)
+        for job in done:
+            # entries without a hash are never skipped, only tracked for eviction
+            card_manifest.set(
+                job["filename"],
+                remote=job["remote_filename"],
+                short=job.get("short_filename"),
+                size=job["size"],
+                card_size=job["card_size"],
+                mtime=job["mtime"],
+                transform=job["pipeline"].signature() if job["pipeline"] else None,
+                hash=job.get("hash"),
+                uploaded=time.time(),
+            )
+
+        data = card_manifest.dumps().encode("utf-8")
+        if self._use_fat32():
+            with tempfile.NamedTemporaryFile() as f:
+                f.write(data)
+                f.flush()
+                self._volume.write_file(manifest.MANIFEST_NAME, f.name)
+        else:
+            with open(os.path.join(self.mdir_name, manifest.MANIFEST_NAME), "wb") as f:
+                f.write(data)
+                os.fsync(f.fileno())
+        card_manifest.save()
+
+    # remember when a card file was last printed, for evict_policy "printed"
+    def _record_print(self, name):
+        device = self._get_device()
+        if not device or not device.uuid or not name:
+            return
+        card_manifest = self._get_manifest(device.uuid)
+        if card_manifest.mark_printed(name):
+            card_manifest.save()
+
+    ##~~ Free space and eviction
+
+    # bytes free on the card and its allocation unit
+    def _card_space(self):
+        if self._use_fat32():
+            return self._volume.free_bytes(), self._volume.cluster_size
+        st = os.statvfs(self.mdir_name)
+        return st.f_bavail * st.f_frsize, st.f_bsize
+
+    def _card_file_size(self, name):
+        if self._use_fat32():
+            entry = self._volume.find(name)
+            return entry["size"] if entry else 0
+        try:
+            return os.path.getsize(os.path.join(self.mdir_name, name))
+        except OSError:
+            return 0
+
+    def _delete_card_file(self, name):
+        self._sd_index.remove(name)
+        if self._use_fat32():
+            return self._volume.delete(name)
+        try:
+            os.unlink(os.path.join(self.mdir_name, name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    # names of card files that must not be evicted right now
+    def _files_in_use(self, jobs):
+        names = []
+        for job in jobs:
+            names.append(job["remote_filename"])
+            if job.get("short_filename"):
+                names.append(job["short_filename"])
+        current = (self._printer.get_current_job() or {}).get("file") or {}
+        if current.get("origin") == "sdcard" and current.get("path"):
+            names.append(current["path"])
+        return names
+
+    # Check the job fits on the card, evicting old uploads if allowed. Raises
+    # ENOSPC if it doesn't, before anything is written.
+    def _make_room(self, uuid, job, keep):
+        free, cluster_size = self._card_space()
+
+        def on_card(size):
+            return -(-size // cluster_size) * cluster_size
+
+        # transforms only ever shrink a file, the source size is an upper
+        # bound; a copy being replaced gives its space back, two clusters
+        # spare for directory entries and the manifest
+        needed = (
+            on_card(os.path.getsize(job["path"]))
+            - on_card(self._card_file_size(job["remote_filename"]))
+            + 2 * cluster_size
+        )
+        if needed <= free:
+            return
+
+        policy = self._settings.get(["evict_policy"])
+        dry_run = self._settings.get_boolean(["evict_dry_run"])
+        if policy in ("uploaded", "printed"):
+            protected = (self._settings.get(["evict_protected"]) or "").replace(
+                ",", " "
+            )
+            card_manifest = self._get_manifest(uuid)
+            candidates = card_manifest.eviction_order(
+                policy, protected=protected.split(), keep=keep
+            )
+            with self._timed("evict"):
+                for name, entry in candidates:
+                    if needed <= free:
+                        break
+                    remote = entry.get("remote", name)
+                    card_size = entry.get("card_size", entry["size"])
+                    if dry_run:
+                        self._logger.info(
+                            "Would evict {} ({} bytes) to make room for {}".format(
+                                remote, card_size, job["remote_filename"]
+                            )
+                        )
+                        free += on_card(card_size)
+                        continue
+                    self._logger.info(
+                        "Evicting {} ({} bytes) to make room for {}".format(
+                            remote, card_size, job["remote_filename"]
+                        )
+                    )
+                    self._delete_card_file(remote)
+                    card_manifest.remove(name)
+                    free = self._card_space()[0]
+
+            if needed <= free and not dry_run:
+                return
+
+        raise OSError(
+            errno.ENOSPC,
+            "not enough space on the sd card for {}, {} bytes needed, {} free{}".format(
+                job["remote_filename"],
+                needed,
+                self._card_space()[0],
+                " (dry run, evicting would have made room)"
+                if dry_run and needed <= free
+                else "",
+            ),
+        )
+
+    # wait for the card's block device, returns mount source or None
+    def _wait_for_disk(self, uuid, timeout):
+        learned = self._get_capabilities()
+        if os.path.isdir(self._by_uuid_dir):
+            disk = discovery.wait_for_device(uuid, timeout, self._by_uuid_dir)
+        else:
+            disk = self._wait_for_blkid(uuid, timeout, learned.get("devices", uuid))
+        if disk:
+            learned.set("devices", uuid, disk)
+        return disk
+
+    # No udev maintained links, poll blkid. The device node the card had the
+    # last time is watched more closely, blkid is run as soon as it's there.
+    def _wait_for_blkid(self, uuid, timeout, known=None):
+        deadline = time.monotonic() + timeout
+        next_blkid = 0
+        while time.monotonic() < deadline:
+            hinted = known and os.path.exists(known)
+            if hinted or time.monotonic() >= next_blkid:
+                try:
+                    output = subprocess.check_output(
+                        ["/usr/sbin/blkid", "-U", uuid], stderr=subprocess.PIPE
+                    )
+                except (OSError, subprocess.CalledProcessError):
+                    next_blkid = time.monotonic() + 0.1
+                    if hinted:
+                        # taken by another disk this time
+                        known = None
+                else:
+                    # the device node, with util-linux's blkid
+                    disk = output.decode(errors="replace").strip()
+                    return disk or "UUID={}".format(uuid)
+            time.sleep(0.01)
+        return None
+
+    # switch the card to the host and wait for its block device
+    def sdwire_attach(self, uuid):
+        with self._timed("switch_usb") as phase:
+            phase.ok = self.sdwire_switch(mode="usb")
+        if not phase.ok:
+            self.sdwrite_notify_error("Failed to switch sdwire to USB mode.")
+            return None
+
+        with self._timed("discovery") as phase:
+            disk = self._wait_for_disk(
+                uuid, self._settings.get_float(["device_timeout"])
+            )
+            phase.ok = bool(disk)
+        if disk:
+            self._logger.debug("Disk {} found for UUID: {}".format(disk, uuid))
+        else:
+            self._logger.info(
+                "SD card UUID {} was not found in the system!".format(uuid)
+            )
+            self.sdwrite_notify_error(
+                "SD card UUID {} was not found in the system!".format(uuid)
+            )
+        return disk
+
+    def sdwire_mount(self, uuid):
+        self.mdir = tempfile.TemporaryDirectory()
+        self.mdir_name = self.mdir.name
+        disk = self.sdwire_attach(uuid)
+        if not disk:
+            return False
+
+        self._logger.debug("Mounting sdwire SD Card")
+        # keep file creation dates compatible with windows/macos
+        time_offset = round(
+            (
+                datetime.datetime.now().timestamp()
+                - datetime.datetime.utcnow().timestamp()
+            )
+            / 60
+        )
+        options = [
+            "uid={},time_offset={}".format(os.getuid(), time_offset),
+            "uid={}".format(os.getuid()),
+        ]
+        # older kernels reject time_offset, don't ask them again
+        learned = self._get_capabilities()
+        if learned.get("mount", "time_offset") is False:
+            options = options[1:]
+        with self._timed("mount") as phase:
+            for option in options:
+                phase.ok = self._run_cmd(
+                    [
+                        "/usr/bin/sudo",
+                        "/usr/bin/mount",
+                        disk,
+                        self.mdir_name,
+                        "-o",
+                        option,
+                    ]
+                )
+                if phase.ok:
+                    break
+        if phase.ok and len(options) > 1:
+            learned.set("mount", "time_offset", option == options[0])
+        if not phase.ok:
+            self.sdwrite_notify_error(
+                "Mounting SD card with UUID {} failed.".format(uuid)
+            )
+            return False
+        self._logger.debug("Sdwire mounted")
+        self._short_names = vfat.ShortNameCache(self.mdir_name)
+        return True
+
+    def sdwire_umount(self, uuid, mounted=True):
+        if mounted:
+            self._logger.debug("Umounting sdwire")
+            learned = self._get_capabilities()
+            with self._timed("unmount") as phase:
+                phase.ok = False
+                # by UUID needs blkid, skipped once it failed
+                if learned.get("mount", "umount_uuid") is not False:
+                    phase.ok = self._run_cmd(
+                        ["/usr/bin/sudo", "/usr/bin/umount", "UUID={}".format(uuid)]
+                    )
+                    if phase.ok:
+                        learned.set("mount", "umount_uuid", True)
+                if not phase.ok:
+                    phase.ok = self._run_cmd(
+                        ["/usr/bin/sudo", "/usr/bin/umount", self.mdir_name]
+                    )
+                    if phase.ok and learned.get("mount", "umount_uuid") is None:
+                        learned.set("mount", "umount_uuid", False)
+        self._short_names = None
+        with self._timed("switch_sd") as phase:
+            phase.ok = self.sdwire_switch(mode="sd")
+        self.mdir.cleanup()
+        return True
+
+    def sdwire_open_volume(self, uuid):
+        disk = self.sdwire_attach(uuid)
+        if not disk:
+            return False
+        if not disk.startswith("/"):
+            self.sdwrite_notify_error(
+                "FAT32 writer needs the card's device node, /dev/disk/by-uuid is missing."
+            )
+            return False
+
+        self._logger.debug("Opening sdwire SD Card {}".format(disk))
+        try:
+            with self._timed("mount"):
+                self._volume = fat32.Fat32Volume(disk)
+        except (OSError, fat32.Fat32Error) as e:
+            self._logger.exception("Opening {} failed: {}".format(disk, e))
+            self.sdwrite_notify_error("Opening SD card {} failed: {}".format(disk, e))
+            return False
+        return True
+
+    def sdwire_close_volume(self, uuid, opened=True):
+        ok = True
+        if opened:
+            self._logger.debug("Closing sdwire SD Card")
+            path = self._volume.path
+            with self._timed("unmount"):
+                self._volume.close()
+            self._volume = None
+            if self._settings.get_boolean(["fat32_fsck"]):
+                with self._timed("fsck") as phase:
+                    ok, output = fat32.fsck(path)
+                    phase.ok = ok is not False
+                if ok is None:
+                    self._logger.warning("Could not run fsck.vfat: {}".format(output))
+                    ok = True
+                elif not ok:
+                    self._logger.error("fsck.vfat found problems: {}".format(output))
+                    self.sdwrite_notify_error(
+                        "fsck.vfat found problems:\n{}".format(output)
+                    )
+        with self._timed("switch_sd") as phase:
+            phase.ok = self.sdwire_switch(mode="sd")
+        return ok
+
+    def _use_fat32(self):
+        return self._settings.get(["write_backend"]) == "fat32"
+
+    def _open_card(self, uuid):
+        if self._use_fat32():
+            return self.sdwire_open_volume(uuid)
+        return self.sdwire_mount(uuid)
+
+    def _close_card(self, uuid, opened):
+        if self._use_fat32():
+            return self.sdwire_close_volume(uuid, opened=opened)
+        return self.sdwire_umount(uuid, mounted=opened)
+
+    # transform pipeline for a gcode file, None to copy it unchanged
+    def _get_pipeline(self, filename, lfn):
+        if not valid_file_type(filename, "gcode"):
+            return None
+
+        bgcode = self._settings.get_boolean(["binary_gcode"])
+        if bgcode and not lfn:
+            # .bgcode doesn't fit in a 8.3 name
+            self._logger.info(
+                "Printer has no long file name support, uploading text gcode."
+            )
+            bgcode = False
+
+        return gcode.build_pipeline(
+            strip_comments=self._settings.get_boolean(["strip_comments"]),
+            strip_thumbnails=self._settings.get_boolean(["strip_thumbnails"]),
+            precision=self._settings.get_boolean(["trim_precision"]),
+            precision_xyz=self._settings.get_int(["precision_xyz"]),
+            precision_e=self._settings.get_int(["precision_e"]),
+            bgcode=bgcode,
+            printer_model=self._settings.get(["bgcode_printer_model"]),
+        )
+
+    def _transform_card_file(self, job, hasher, out_hasher=None):
+        bufsize = self._settings.get_int(["copy_buffer_size"]) * 1024
+        if not self._use_fat32():
+            return gcode.copy_file(
+                job["path"],
+                os.path.join(self.mdir_name, job["remote_filename"]),
+                job["pipeline"],
+                progress_cb=self._copy_progress,
+                bufsize=bufsize,
+                hasher=hasher,
+                write_speed=self._write_speed,
+                preallocate_dst=self._settings.get_boolean(["preallocate"]),
+                out_hasher=out_hasher,
+                writeback_limit=self._get_writeback_limit(),
+            )
+
+        # the FAT32 writer allocates by size, so the output is staged first
+        start = time.monotonic()
+        with tempfile.NamedTemporaryFile(prefix="sdwire-") as f:
+            self._set_phase("transforming", total=job["size"])
+            result = gcode.copy_file(
+                job["path"],
+                f.name,
+                job["pipeline"],
+                progress_cb=self._copy_progress,
+                bufsize=bufsize,
+                hasher=hasher,
+                out_hasher=out_hasher,
+            )
+            self._set_phase("copying", total=result["written"])
+            written = self._volume.write_file(
+                job["remote_filename"],
+                f.name,
+                progress_cb=self._copy_progress,
+                bufsize=bufsize or 1024 * 1024,
+                writeback_limit=self._get_writeback_limit(),
+            )
+        if job["lfn"]:
+            job["short_filename"] = written["short_filename"]
+        return gcode.transform_result(
+            result["copied"],
+            result["written"],
+            time.monotonic() - start,
+            self._write_speed,
+            written["fragments"],
+        )
+
+    # fragmented files are slower to write and for the printer to read
+    def _check_fragments(self, job, result):
+        fragments = result.get("fragments")
+        if fragments is None:
+            self._logger.info(
+                "Fragments of {} on the card unknown".format(job["remote_filename"])
+            )
+        elif fragments > 1:
+            self._logger.warning(
+                "{} is stored in {} fragments, no contiguous free space on the card "
+                "was left for it".format(job["remote_filename"], fragments)
+            )
+        else:
+            self._logger.info(
+                "{} is stored contiguously".format(job["remote_filename"])
+            )
+
+    # Plain copy to the mounted card that picks up where an interrupted copy
+    # of the same file stopped. Progress is journaled at checkpoints, on retry
+    # the card's copy is checked against the source up to the last one.
+    def _copy_resumable(self, job, dst, hasher):
+        if not self._settings.get_boolean(["resume_uploads"]):
+            return self.sdwire_copyfile(
+                job["path"], dst, self._copy_progress, hasher=hasher
+            )
+
+        uuid = job.device.uuid
+        remote_filename = job["remote_filename"]
+        journal = self._get_journal()
+        entry = journal.get(uuid, remote_filename)
+        resume_from = 0
+        if entry and entry["size"] == job["size"] and os.path.exists(dst):
+            limit = min(entry["offset"], os.path.getsize(dst))
+            self._set_phase("verifying", filename=remote_filename, total=limit)
+            start = time.monotonic()
+            with self._timed("resume_check"):
+                resume_from = copier.verify_prefix(
+                    job["path"],
+                    dst,
+                    limit,
+                    hasher=hasher,
+                    progress_cb=self._copy_progress,
+                )
+            self._logger.info(
+                "Resuming {} at {} of {} bytes, {} of {} journaled bytes on the card "
+                "matched ({:.2f}s)".format(
+                    remote_filename,
+                    resume_from,
+                    job["size"],
+                    resume_from,
+                    entry["offset"],
+                    time.monotonic() - start,
+                )
+            )
+            self._set_phase(
+                "copying",
+                filename=remote_filename,
+                total=job["size"],
+                copied=resume_from,
+            )
+
+        def checkpoint(offset):
+            journal.update(uuid, remote_filename, job["size"], offset)
+
+        result = self.sdwire_copyfile(
+            job["path"],
+            dst,
+            self._copy_progress,
+            hasher=hasher,
+            resume_from=resume_from,
+            checkpoint_cb=checkpoint,
+        )
+        journal.remove(uuid, remote_filename)
+        return result
+
+    def _write_card_file(self, job):
+        st = os.stat(job["path"])
+        job["size"] = st.st_size
+        job["mtime"] = st.st_mtime
+
+        # hash while copying unless it's known already
+        hasher = None
+        hashing = None
+        verify = self._settings.get_boolean(["verify_uploads"])
+        if self._settings.get_boolean(["skip_unchanged"]) or verify:
+            job["hash"] = self._get_hash_cache().get(job["path"])
+            if job["hash"] is None:
+                if self._copy_reads_data(job):
+                    hasher = manifest.new_hasher()
+                else:
+                    hashing = self._hash_in_background(job["path"])
+        # what is expected back from the card, the source unless transformed
+        out_hasher = manifest.new_hasher() if verify and job["pipeline"] else None
+
+        if job["pipeline"]:
+            if job["lfn"] and not self._use_fat32():
+                job["predicted_filename"] = self._predict_vfat_remote_filename(
+                    job["remote_filename"]
+                )
+            result = self._transform_card_file(job, hasher, out_hasher)
+            job["card_size"] = result["written"]
+            self._logger.info(
+                "Transformed {} ({}): {} -> {} bytes ({:.1f}% smaller), {}".format(
+                    job["filename"],
+                    job["pipeline"].signature(),
+                    result["copied"],
+                    result["written"],
+                    100.0 * result["saved_bytes"] / result["copied"]
+                    if result["copied"]
+                    else 0.0,
+                    "saved {:.2f}s of copying".format(result["saved_time"])
+                    if result["saved_time"] is not None
+                    else "no plain copy measured yet to compare with",
+                )
+            )
+        elif self._use_fat32():
+            result = self._volume.write_file(
+                job["remote_filename"],
+                job["path"],
+                progress_cb=self._copy_progress,
+                bufsize=self._settings.get_int(["copy_buffer_size"]) * 1024
+                or 1024 * 1024,
+                hasher=hasher,
+                writeback_limit=self._get_writeback_limit(),
+            )
+            if job["lfn"]:
+                job["short_filename"] = result["short_filename"]
+            job["card_size"] = job["size"]
+        else:
+            job["card_size"] = job["size"]
+            if job["lfn"]:
+                job["predicted_filename"] = self._predict_vfat_remote_filename(
+                    job["remote_filename"]
+                )
+            result = self._copy_resumable(
+                job, os.path.join(self.mdir_name, job["remote_filename"]), hasher
+            )
+
+        written = result["copied"] - result.get("resumed", 0)
+        if not job["pipeline"] and written >= 1000000:
+            # card speed seen by plain copies, to tell what transforms save
+            self._write_speed = written / result["elapsed"]
+
+        if hasher is not None and result["copied"] == job["size"]:
+            job["hash"] = hasher.hexdigest()
+            self._get_hash_cache().put(job["path"], job["hash"])
+        elif hashing is not None:
+            job["hash"] = hashing()
+        if verify:
+            job["card_hash"] = out_hasher.hexdigest() if out_hasher else job["hash"]
+        return result
+
+    # Whether the copy of ``job`` passes the data through us, so that it can be
+    # hashed on the way. Kernel side (zero-copy) copies don't.
+    def _copy_reads_data(self, job):
+        return (
+            job["pipeline"]
+            or self._use_fat32()
+            or not self._settings.get_boolean(["zero_copy"])
+        )
+
+    # Hash ``path`` in a thread of its own while the kernel copies it, the
+    # source is read once more, mostly from the page cache. Returns a function
+    # waiting for the digest, None if hashing failed.
+    def _hash_in_background(self, path):
+        result = {}
+
+        def run():
+            try:
+                result["hash"] = self._get_hash_cache().hash(path)
+            except OSError as e:
+                self._logger.debug("Hashing {} failed: {}".format(path, e))
+
+        thread = threading.Thread(target=run, name="sdwire-hash")
+        thread.daemon = True
+        thread.start()
+
+        def wait():
+            thread.join()
+            return result.get("hash")
+
+        return wait
+
+    # Read the file back from the card and compare it with what was written,
+    # raises EIO if they differ.
+    def _verify_card_file(self, job):
+        remote_filename = job["remote_filename"]
+        self._set_phase("verifying", filename=remote_filename, total=job["card_size"])
+        hasher = manifest.new_hasher()
+        start = time.monotonic()
+        with self._timed("verify") as phase:
+            if self._use_fat32():
+                size = self._volume.read_back(
+                    remote_filename, hasher, progress_cb=self._copy_progress
+                )
+                how = "dropped cache"
+            else:
+                size, direct = copier.read_back(
+                    os.path.join(self.mdir_name, remote_filename),
+                    hasher,
+                    progress_cb=self._copy_progress,
+                )
+                how = "O_DIRECT" if direct else "dropped cache"
+            phase.ok = hasher.hexdigest() == job["card_hash"]
+        elapsed = time.monotonic() - start
+
+        if not phase.ok:
+            # don't leave a corrupt file for the printer to print
+            self._delete_card_file(remote_filename)
+            raise OSError(
+                errno.EIO,
+                "{} read back from the card differs from what was written".format(
+                    remote_filename
+                ),
+            )
+        self._logger.info(
+            "Verified {}: {} bytes read back in {:.2f}s ({:.2f} MB/s, {})".format(
+                remote_filename,
+                size,
+                elapsed,
+                size / elapsed / 1000000 if elapsed > 0 else 0.0,
+                how,
+            )
+        )
+
     def sdwire_upload(
         self, printer, filename, path, start_cb, success_cb, failure_cb, *args, **kwargs
     ):
 
         # Assume long file names support.
-        if printer._comm._capability_supported(printer._comm.CAPABILITY_EXTENDED_M20):
+        lfn = self._printer_lfn(printer._comm)
+        pipeline = self._get_pipeline(filename, lfn)
+        device = self._get_device()
+
+        unchanged = None
+        if device and device.uuid:
+            unchanged = self._find_unchanged(
+                printer, device.uuid, filename, path, pipeline
+            )
+        if unchanged:
+            self._logger.info(
+                "{} is already on the sdwire sd card as {}, skipping upload.".format(
+                    filename, unchanged
+                )
+            )
+            start_cb(filename, unchanged)
+            success_cb(filename, unchanged, 0)
+            return unchanged
+
+        reserved = []
+        if device:
+            reserved = [
+                job["remote_filename"] for job in self._jobs.queued(device.uuid)
+            ]
+
+        if lfn:
             remote_filename = filename
-            self.lfn = True
+            if pipeline and pipeline.extension:
+                remote_filename = os.path.splitext(filename)[0] + pipeline.extension
         else:
-            remote_filename = printer._get_free_remote_name(filename)
-            self.lfn = False
+            remote_filename = self._get_free_remote_name(printer, filename, reserved)
 
-        if not self._settings.get(["disk_uuid"]):
+        if device is None:
+            self.sdwrite_notify_error("No sdwire device configured for this printer!")
+            failure_cb(filename, remote_filename, 0)
+            return False
+
+        if not device.uuid:
             self.sdwrite_notify_error("SD card UUID was not configured!")
             failure_cb(filename, remote_filename, 0)
             return False
 
-        if not self._settings.get(["sdwire_serial"]):
+        if not device.serial:
             self.sdwrite_notify_error("Sdwire serial was not configured!")
             failure_cb(filename, remote_filename, 0)
             return False
@@ -224,167 +1472,463 @@ class SdwirePlugin(
             failure_cb(filename, remote_filename, 0)
             return False
 
-        self._logger.info("Uploading {} to sdwire sd card.".format(remote_filename))
+        self._logger.info("Queueing {} for sdwire sd card.".format(remote_filename))
         start_cb(filename, remote_filename)
 
-        def sdwire_set_progress(progress):
-            self._plugin_manager.send_plugin_message(
-                self._identifier, dict(progress=int(progress))
-            )
-
-        def sdwire_copyfile(src, dst, progress_cb):
-            with open(src, "rb") as fsrc:
-                file_size = os.stat(fsrc.fileno()).st_size
+        job = jobs.UploadJob(
+            device,
+            priority=self._upload_priority(printer, device, filename, remote_filename),
+            filename=filename,
+            path=path,
+            remote_filename=remote_filename,
+            lfn=lfn,
+            pipeline=pipeline,
+            success_cb=success_cb,
+            failure_cb=failure_cb,
+        )
+        self._jobs.add(job)
 
-                with open(dst, "wb") as fdst:
+        with self._upload_lock:
+            if self._upload_thread is None:
+                self._upload_thread = threading.Thread(target=self._upload_worker)
+                self._upload_thread.daemon = True
+                self._upload_thread.start()
 
-                    bufsize = 1024 * 1024
+        # doesn't really matter as filename from success callback takes precedence
+        return remote_filename
 
-                    fsrc_read = fsrc.read
-                    fdst_write = fdst.write
+    # a new upload of the file selected for printing goes first
+    def _upload_priority(self, printer, device, filename, remote_filename):
+        current = (printer.get_current_job() or {}).get("file") or {}
+        if current.get("origin") != "sdcard" or not current.get("path"):
+            return 0
+        names = [filename, remote_filename]
+        entry = self._get_manifest(device.uuid).get(filename) if device else None
+        if entry:
+            names += [entry.get("short"), entry["remote"]]
+        if current["path"].lower() in [name.lower() for name in names if name]:
+            return jobs.PRIORITY_SELECTED
+        return 0
+
+    # The one worker of this instance, it runs the sessions of queued cards
+    # one after the other. Mount point, volume and progress belong to the
+    # running session; cards of other printers are uploaded to in parallel by
+    # their own OctoPrint instances (see pool.HostScheduler).
+    def _upload_worker(self):
+        while True:
+            # Wait for the queue to settle, so that uploads arriving shortly after
+            # each other share one usb switch / mount cycle.
+            if self._settings.get_boolean(["batch_uploads"]):
+                self._jobs.settle(self._settings.get_float(["batch_window"]))
+
+            with self._upload_lock:
+                if not self._jobs.queued():
+                    self._upload_thread = None
+                    return
 
-                    copied = 0
-                    while True:
-                        buf = fsrc_read(bufsize)
-                        if not buf:
-                            break
-                        fdst_write(buf)
-                        copied += len(buf)
-                        progress_cb(100 * copied / file_size)
-                    return copied
-            return False
+            try:
+                self._run_upload_batch()
+            except Exception as e:
+                self._logger.exception("Unknown problem: {}".format(e))
+                self.sdwrite_notify_error("Unknown problem: {}".format(e))
 
-        def sdwire_mount(uuid):
-            self.mdir = tempfile.TemporaryDirectory()
-            self.mdir_name = self.mdir.name
-            if not self.sdwire_switch(mode="usb"):
-                self.sdwrite_notify_error("Failed to switch sdwire to USB mode.")
-                return False
-
-            # wait for device for 5s
-            disk = None
-            for _i in range(0, 50):
-                disk = self._run_cmd(["/usr/sbin/blkid", "-U", uuid])
-                if disk:
-                    break
-                time.sleep(0.1)
+    # next queued job for ``device``, uploads to other cards wait for their
+    # own session
+    def _take_upload_job(self, device):
+        return self._jobs.take(device.uuid)
+
+    def _fail_upload_job(self, job, start_time, state=jobs.FAILED, error=None):
+        if self._timing is not None and state == jobs.FAILED:
+            self._timing.ok = False
+        self._jobs.finish(job, state, error)
+        job["failure_cb"](
+            job["filename"], job["remote_filename"], int(time.time() - start_time)
+        )
 
-            if disk:
-                self._logger.debug("Disk found for UUID: {}".format(uuid))
-            else:
-                self._logger.info(
-                    "SD card UUID {} was not found in the system!".format(uuid)
-                )
-                self.sdwrite_notify_error(
-                    "SD card UUID {} was not found in the system!".format(uuid)
-                )
-                return False
-
-            self._logger.debug("Mounting sdwire SD Card")
-            # keep file creation dates compatible with windows/macos
-            time_offset = round(
-                (
-                    datetime.datetime.now().timestamp()
-                    - datetime.datetime.utcnow().timestamp()
+    def _run_upload_batch(self):
+        queued = self._jobs.queued()
+        if not queued:
+            return
+        with self._session_lock:
+            # highest priority first, its card's session takes the rest for it
+            self._run_session("upload", queued[0].device, self._upload_batch)
+
+    # Run ``session(device)`` with the card of ``device`` to ourselves and its
+    # phases timed as ``kind``.
+    def _run_session(self, kind, device, session, *args):
+        self._device = device
+        self._timing = self._metrics.start(kind)
+        try:
+            # one session per card, also across OctoPrint instances
+            with self._get_scheduler().card(device.uuid) as waited:
+                self._timing.add("card_wait", waited)
+                return session(device, *args)
+        except Exception:
+            self._timing.ok = False
+            raise
+        finally:
+            timing, self._timing = self._timing, None
+            self._device = None
+            self._metrics.record(timing)
+            self._logger.info(
+                "{} phases: {}".format(
+                    kind.capitalize(),
+                    ", ".join(
+                        "{} {:.2f}s{}".format(
+                            phase,
+                            duration,
+                            " (failed)" if phase in timing.failed else "",
+                        )
+                        for phase, duration in timing.phases.items()
+                    ),
                 )
-                / 60
-            )
-            if not self._run_cmd(
-                [
-                    "/usr/bin/sudo",
-                    "/usr/bin/mount",
-                    "UUID={}".format(uuid),
-                    self.mdir_name,
-                    "-o",
-                    "uid={},time_offset={}".format(os.getuid(), time_offset),
-                ]
-            ):
-                if not self._run_cmd(
-                    [
-                        "/usr/bin/sudo",
-                        "/usr/bin/mount",
-                        "UUID={}".format(uuid),
-                        self.mdir_name,
-                        "-o",
-                        "uid={}".format(os.getuid()),
-                    ]
-                ):
-                    self.sdwrite_notify_error(
-                        "Mounting SD card with UUID {} failed.".format(uuid)
-                    )
-                    return False
-            self._logger.debug("Sdwire mounted")
-            return True
+            )
 
-        def sdwire_umount(uuid):
-            self._logger.debug("Umounting sdwire")
-            if not self._run_cmd(
-                ["/usr/bin/sudo", "/usr/bin/umount", "UUID={}".format(uuid)]
-            ):
-                self._run_cmd(["/usr/bin/sudo", "/usr/bin/umount", self.mdir_name])
-            self.sdwire_switch(mode="sd")
-            self.mdir.cleanup()
-            return True
-
-        def sdwire_run_upload():
-            try:
-                start_time = time.time()
-                short_filename = None
+    def _upload_job(self, uuid, job, done):
+        self._logger.info(
+            "Uploading {} to sdwire sd card.".format(job["remote_filename"])
+        )
+        self._job = job
+        writing = False
+        try:
+            # the file being replaced is already credited in _make_room
+            self._make_room(uuid, job, self._files_in_use(done + [job]))
+            self._set_phase(
+                "copying",
+                filename=job["remote_filename"],
+                total=os.path.getsize(job["path"]),
+            )
+            # a slot per file, so cards with long batches take turns with others
+            with self._get_scheduler().copy_slot() as waited:
+                self._timing.add("copy_wait", waited)
+                job.check_cancelled()
+                with self._timed("copy"):
+                    # a file of that name on the card is overwritten from here
+                    writing = True
+                    result = self._write_card_file(job)
+                    writing = False
+                if self._settings.get_boolean(["verify_uploads"]):
+                    self._verify_card_file(job)
+        except jobs.Cancelled:
+            # nothing half written stays on the card or in the journal, a file
+            # not touched yet or completely written is left alone
+            if writing:
+                self._get_journal().remove(uuid, job["remote_filename"])
+                self._delete_card_file(job["remote_filename"])
+            raise
+        finally:
+            self._job = None
+        self._timing.bytes += result["copied"] - result.get("resumed", 0)
+        self._timing.files += 1
+        self._logger.info(
+            "Copy of {} as {} done in {:.2f}s ({:.2f} MB/s, {})".format(
+                job["filename"],
+                job["remote_filename"],
+                result["elapsed"],
+                result["speed"],
+                result["method"],
+            )
+        )
+        self._check_fragments(job, result)
 
-                try:
+    def _upload_batch(self, device):
+        start_time = time.time()
+        uuid = device.uuid
+        batch = self._settings.get_boolean(["batch_uploads"])
+        done = []
 
-                    uuid = self._settings.get(["disk_uuid"])
-                    sdwire_set_progress(0)
-                    if sdwire_mount(uuid):
-                        sdwire_copyfile(
-                            path,
-                            os.path.join(self.mdir.name, remote_filename),
-                            sdwire_set_progress,
-                        )
+        queued = self._jobs.queued(uuid)
+        if queued:
+            self._timing.add("queue", start_time - min(job.queued for job in queued))
 
-                        if self.lfn:
-                            # Try to find short filename using vfat ioctl
-                            short_filename = self._get_vfat_remote_filename(
-                                self.mdir.name, remote_filename
-                            )
+        if not self._check_printer_state(notify=True):
+            while True:
+                job = self._take_upload_job(device)
+                if job is None:
+                    return
+                self._fail_upload_job(job, start_time, error="Printer is busy")
 
-                        sdwire_umount(uuid)
+        mounted = False
+        try:
+            self._progress = progress.ProgressReporter(
+                self.sdwire_send_progress,
+                min_interval=self._settings.get_float(["progress_interval"]),
+                min_step=self._settings.get_float(["progress_step"]),
+            )
+            self._set_phase("mounting")
+            mounted = self._open_card(uuid)
+            if mounted:
+                try:
+                    with self._timed("manifest"):
+                        self._read_card_manifest(uuid)
+                except Exception as e:
+                    self._logger.exception("Reading card manifest failed: {}".format(e))
+                # Keep copying as long as uploads are queued, the card goes back
+                # to the printer only once the whole batch is on it.
+                while True:
+                    job = self._take_upload_job(device)
+                    if job is None:
+                        break
+                    try:
+                        self._upload_job(uuid, job, done)
+                        done.append(job)
+                    except jobs.Cancelled as e:
+                        self._logger.info("{}".format(e))
+                        self._fail_upload_job(job, start_time, jobs.CANCELLED)
+                    except Exception as e:
+                        self._fail_upload_job(job, start_time, error=str(e))
+                        self._logger.exception(
+                            "Uploading to sdwire failed: {}".format(e)
+                        )
+                        self.sdwrite_notify_error(
+                            "Uploading to sdwire failed: {}".format(e)
+                        )
+                    if not batch:
+                        break
 
-                        # Fallback to querying printer for short filename.
-                        if self.lfn and not short_filename:
-                            short_filename = self._get_remote_filename(
-                                remote_filename, start_time
+                # Try to find short filenames using vfat ioctl
+                lfn_jobs = [
+                    job for job in done if job["lfn"] and not job.get("short_filename")
+                ]
+                if lfn_jobs and not self._use_fat32():
+                    with self._timed("resolve_vfat"):
+                        short_names = self._get_vfat_remote_filenames(
+                            [job["remote_filename"] for job in lfn_jobs]
+                        )
+                    for job in lfn_jobs:
+                        job["short_filename"] = short_names.get(job["remote_filename"])
+                        if not job["short_filename"] and job.get("predicted_filename"):
+                            self._logger.info(
+                                "Using predicted short filename {} for {}".format(
+                                    job["predicted_filename"], job["remote_filename"]
+                                )
                             )
+                            job["short_filename"] = job["predicted_filename"]
+
+                for job in done:
+                    if job.get("short_filename") or not job["lfn"]:
+                        self._sd_index.add(
+                            job["remote_filename"],
+                            job.get("short_filename") or job["remote_filename"],
+                            time.time(),
+                        )
 
+                try:
+                    with self._timed("manifest"):
+                        self._write_card_manifest(uuid, done)
                 except Exception as e:
-                    failure_cb(filename, remote_filename, int(time.time() - start_time))
-                    self._logger.exception("Uploading to sdwire failed: {}".format(e))
-                    self.sdwrite_notify_error(
-                        "Uploading to sdwire failed: {}".format(e)
-                    )
-                else:
-                    self._logger.info(
-                        "Upload of {} as {} done in {:.2f}s".format(
-                            filename, remote_filename, time.time() - start_time
-                        )
-                    )
-                    success_cb(
-                        filename,
-                        short_filename if short_filename else remote_filename,
-                        int(time.time() - start_time),
+                    self._logger.exception("Writing card manifest failed: {}".format(e))
+        except Exception as e:
+            self._logger.exception("Uploading to sdwire failed: {}".format(e))
+            self.sdwrite_notify_error("Uploading to sdwire failed: {}".format(e))
+            for job in done:
+                self._fail_upload_job(job, start_time, error=str(e))
+            done = []
+        finally:
+            self._set_phase("unmounting")
+            if not self._close_card(uuid, mounted):
+                for job in done:
+                    self._fail_upload_job(
+                        job, start_time, error="Giving the card back failed"
                     )
+                done = []
+
+        if not mounted:
+            # nothing was copied, fail what was waiting for this session
+            while True:
+                job = self._take_upload_job(device)
+                if job is None:
+                    return
+                self._fail_upload_job(
+                    job, start_time, error="The card could not be opened"
+                )
 
+        # Fallback to querying printer for short filenames, once for the whole batch.
+        unresolved = [
+            job for job in done if job["lfn"] and not job.get("short_filename")
+        ]
+        if unresolved:
+            self._set_phase("resolving")
+            with self._timed("resolve_m20"):
+                short_names = self._get_remote_filenames(
+                    [job["remote_filename"] for job in unresolved], start_time
+                )
+            for job in unresolved:
+                job["short_filename"] = short_names.get(job["remote_filename"])
+
+            card_manifest = self._get_manifest(uuid)
+            for job in unresolved:
+                entry = card_manifest.get(job["filename"])
+                if entry and job["short_filename"]:
+                    entry["short"] = job["short_filename"]
+                    card_manifest.set(job["filename"], **entry)
+            card_manifest.save()
+
+        self._set_phase("done")
+        self._logger.info(
+            "Upload of {} file(s) done in {:.2f}s".format(
+                len(done), time.time() - start_time
+            )
+        )
+        for job in done:
+            self._jobs.finish(job, jobs.DONE)
+            job["success_cb"](
+                job["filename"],
+                job.get("short_filename") or job["remote_filename"],
+                int(time.time() - job.queued),
+            )
+
+    ##~~ Card files
+
+    def _card_files(self):
+        if self._use_fat32():
+            return cardfiles.VolumeCard(self._volume)
+        return cardfiles.MountedCard(self.mdir_name)
+
+    def _get_downloads_folder(self):
+        return os.path.join(self.get_plugin_data_folder(), "downloads")
+
+    # manifest keys of the card file ``name``, by long or short name
+    def _manifest_keys(self, uuid, name):
+        card_manifest = self._get_manifest(uuid)
+        name = name.lower()
+        keys = []
+        for key in card_manifest.names():
+            entry = card_manifest.get(key)
+            if name in (entry["remote"].lower(), (entry.get("short") or "").lower()):
+                keys.append(key)
+        return keys
+
+    def _card_session(self, device, delete, rename, download):
+        uuid = device.uuid
+        result = dict(files=[], errors=[], downloads=[])
+
+        def failed(op, path, e):
+            self._logger.info("Card {} of {} failed: {}".format(op, path, e))
+            result["errors"].append(dict(op=op, path=path, error=str(e)))
+
+        self._progress = progress.ProgressReporter(
+            self.sdwire_send_progress,
+            min_interval=self._settings.get_float(["progress_interval"]),
+            min_step=self._settings.get_float(["progress_step"]),
+        )
+        self._set_phase("mounting")
+        opened = self._open_card(uuid)
+        try:
+            if not opened:
+                self._timing.ok = False
+                return None
+            card = self._card_files()
+            try:
+                with self._timed("manifest"):
+                    self._read_card_manifest(uuid)
             except Exception as e:
-                failure_cb(filename, remote_filename, int(time.time() - start_time))
-                self._logger.exception("Unknown problem: {}".format(e))
-                self.sdwrite_notify_error("Unknown problem: {}".format(e))
+                self._logger.exception("Reading card manifest failed: {}".format(e))
+            card_manifest = self._get_manifest(uuid)
+
+            changed = False
+            with self._timed("delete"):
+                for path in delete:
+                    try:
+                        card.delete(path)
+                    except (OSError, ValueError, fat32.Fat32Error) as e:
+                        failed("delete", path, e)
+                        continue
+                    changed = True
+                    self._sd_index.remove(path)
+                    self._get_journal().remove(uuid, path)
+                    for key in self._manifest_keys(uuid, path):
+                        card_manifest.remove(key)
+
+            with self._timed("rename"):
+                for path, new_name in rename:
+                    try:
+                        short_name = card.rename(path, new_name)
+                    except (OSError, ValueError, fat32.Fat32Error) as e:
+                        failed("rename", path, e)
+                        continue
+                    changed = True
+                    self._sd_index.remove(path)
+                    self._sd_index.remove(new_name)
+                    keys = self._manifest_keys(uuid, path)
+                    # a file of the new name was replaced
+                    for key in self._manifest_keys(uuid, new_name):
+                        if key not in keys:
+                            card_manifest.remove(key)
+                    for key in keys:
+                        entry = card_manifest.get(key)
+                        entry.update(remote=new_name, short=short_name)
+                        card_manifest.set(key, **entry)
+
+            if changed:
+                try:
+                    with self._timed("manifest"):
+                        self._write_card_manifest(uuid, [])
+                except Exception as e:
+                    self._logger.exception("Writing card manifest failed: {}".format(e))
+
+            if download:
+                folder = self._get_downloads_folder()
+                # only the files of the last session are kept around
+                shutil.rmtree(folder, ignore_errors=True)
+                with self._timed("download"):
+                    for path in download:
+                        try:
+                            local = os.path.join(*cardfiles.split_path(path))
+                            dst = os.path.join(folder, local)
+                            os.makedirs(os.path.dirname(dst), exist_ok=True)
+                            size = card.export(path, dst)
+                        except (OSError, ValueError, fat32.Fat32Error) as e:
+                            failed("download", path, e)
+                            continue
+                        result["downloads"].append(
+                            dict(
+                                path=path,
+                                size=size,
+                                url="api/plugin/{}?download={}".format(
+                                    self._identifier, quote(local)
+                                ),
+                            )
+                        )
 
-        thread = threading.Thread(target=sdwire_run_upload)
-        thread.daemon = True
-        thread.start()
+            with self._timed("list"):
+                result["files"] = card.list()
+            self._card_listing = (time.monotonic(), result["files"])
+        finally:
+            self._set_phase("unmounting")
+            if not self._close_card(uuid, opened) and opened:
+                result["errors"].append(
+                    dict(op="close", path=None, error="Giving the card back failed")
+                )
+        self._set_phase("done")
+        return result
+
+    # Put the files of the last card session into OctoPrint's sd listing, as
+    # if the printer had answered M20. False without a recent scan.
+    def _publish_card_listing(self, comm):
+        listing = self._card_listing
+        if listing is None or time.monotonic() - listing[0] > CARD_LISTING_TTL:
+            return False
+        if any(not item["name"] for item in listing[1]):
+            # short names unknown, only the printer can tell
+            return False
 
-        # doesn't really matter as filename from success callback takes precedence
-        return remote_filename
+        extended = comm._capability_supported(comm.CAPABILITY_EXTENDED_M20)
+        sd_files = {}
+        for item in listing[1]:
+            name = item["name"].lower() if comm._sdLowerCase else item["name"].upper()
+            if not valid_file_type(name, "machinecode"):
+                continue
+            sd_files["/" + name] = SDFileData(
+                name="/" + name,
+                size=item["size"],
+                timestamp=item["date"] if extended else None,
+                longname=os.path.basename(item["path"]) if extended else None,
+            )
+        comm._sdFiles = sd_files
+        comm._sdFilesAvailable.set()
+        comm._callback.on_comm_sd_files(comm.getSdFiles())
+        return True
 
     ##~~ Softwareupdate hook
 
@@ -423,4 +1967,8 @@ def __plugin_load__():
     __plugin_hooks__ = {
         "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
         "octoprint.printer.sdcardupload": __plugin_implementation__.sdwire_upload,
+        "octoprint.comm.protocol.gcode.received": __plugin_implementation__.sdwire_gcode_received,
+        "octoprint.comm.protocol.gcode.queuing": __plugin_implementation__.sdwire_gcode_queuing,
+        "octoprint.comm.protocol.firmware.capability_report": __plugin_implementation__.sdwire_capability_report,
+        "octoprint.filemanager.extension_tree": __plugin_implementation__.sdwire_extension_tree,
     }
@@ -0,0 +1,39 @@
+import threading
+
+from . import jsonfile
+
+
+class CapabilityCache(object):
+    """
+    What probing the host, the sdwires and the printers found out, kept
+    across restarts so that uploads start with what worked last time.
+    Sections of key -> value, e.g. ``get("mount", "time_offset")``.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._data = jsonfile.load(path, {})
+
+    def get(self, section, key, default=None):
+        with self._lock:
+            return self._data.get(section, {}).get(key, default)
+
+    def set(self, section, key, value):
+        with self._lock:
+            entries = self._data.setdefault(section, {})
+            if key in entries and entries[key] == value:
+                return
+            entries[key] = value
+            jsonfile.save(self._path, self._data)
+
+    def clear(self, section):
+        with self._lock:
+            if self._data.pop(section, None) is not None:
+                jsonfile.save(self._path, self._data)
+
+    def to_dict(self):
+        with self._lock:
+            return dict(
+                (section, dict(entries)) for section, entries in self._data.items()
+            )
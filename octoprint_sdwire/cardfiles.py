@@ -0,0 +1,132 @@
+import errno
+import os
+import shutil
+
+from . import vfat
+
+
+def split_path(path):
+    parts = [part for part in path.replace("\\", "/").split("/") if part]
+    if not parts or any(part in (".", "..") for part in parts):
+        raise ValueError("Invalid path on the card: {}".format(path))
+    return parts
+
+
+def _base_name(name):
+    parts = split_path(name)
+    if len(parts) != 1:
+        raise ValueError("Not a file name: {}".format(name))
+    return parts[0]
+
+
+class MountedCard(object):
+    """
+    Files of the card mounted at ``root``. Paths are relative to the root of
+    the card with "/" between directories. Listed files have their long
+    ``path``, the ``name`` the printer knows them by (short names, lower
+    case; None if the vfat ioctl can't tell), ``size`` and ``date``.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _local(self, path):
+        return os.path.join(self.root, *split_path(path))
+
+    def _short_names(self, directory):
+        # empty where the vfat ioctl isn't available
+        try:
+            return dict(vfat.ShortNameCache(directory).items())
+        except OSError:
+            return {}
+
+    def list(self):
+        files = []
+        directories = [(self.root, (), ())]
+        while directories:
+            directory, path, short_path = directories.pop(0)
+            short_names = self._short_names(directory)
+            for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+                short_name = short_names.get(entry.name.lower())
+                entry_short_path = (
+                    short_path + (short_name,)
+                    if short_path is not None and short_name
+                    else None
+                )
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(
+                        (entry.path, path + (entry.name,), entry_short_path)
+                    )
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat()
+                    files.append(
+                        dict(
+                            path="/".join(path + (entry.name,)),
+                            name="/".join(entry_short_path)
+                            if entry_short_path
+                            else None,
+                            size=st.st_size,
+                            date=int(st.st_mtime),
+                        )
+                    )
+        return files
+
+    def export(self, path, dst):
+        shutil.copyfile(self._local(path), dst)
+        return os.path.getsize(dst)
+
+    def delete(self, path):
+        os.unlink(self._local(path))
+
+    def rename(self, path, new_name):
+        # within the same directory, returns the new short name (None if unknown)
+        src = self._local(path)
+        directory = os.path.dirname(src)
+        os.replace(src, os.path.join(directory, _base_name(new_name)))
+        return self._short_names(directory).get(new_name.lower())
+
+
+class VolumeCard(object):
+    """
+    Files of an open ``fat32.Fat32Volume``, like ``MountedCard``. The FAT32
+    writer only changes the root directory, files below it can be listed and
+    downloaded but not deleted or renamed.
+    """
+
+    def __init__(self, volume):
+        self.volume = volume
+
+    def _root_name(self, path):
+        parts = split_path(path)
+        if len(parts) != 1:
+            raise ValueError(
+                "Only files in the root directory can be changed: {}".format(path)
+            )
+        return parts[0]
+
+    def list(self):
+        return [
+            dict(
+                path=entry["path"],
+                name=entry["short_path"].lower(),
+                size=entry["size"],
+                date=int(entry["date"]) if entry["date"] else None,
+            )
+            for entry in self.volume.walk()
+        ]
+
+    def export(self, path, dst):
+        entry = self.volume.find_path("/".join(split_path(path)))
+        if entry is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return self.volume.export(entry, dst)
+
+    def delete(self, path):
+        if not self.volume.delete(self._root_name(path)):
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+
+    def rename(self, path, new_name):
+        name = self._root_name(path)
+        if self.volume.find(name) is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return self.volume.rename(name, _base_name(new_name))
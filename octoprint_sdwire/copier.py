@@ -0,0 +1,490 @@
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+MIN_BUFSIZE = 256 * 1024
+MAX_BUFSIZE = 8 * 1024 * 1024
+
+# errors meaning "this kernel/filesystem combination can't do it", not a real
+# I/O failure; the next copy method is tried instead
+_FALLBACK_ERRNOS = (
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.EBADF,
+)
+
+
+# linux/falloc.h, linux/fs.h, linux/fiemap.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FIBMAP = 1
+FIGETBSZ = 2
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_FLAG_SYNC = 0x01
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+_fallocate = None
+_sync_file_range = None
+
+
+def _get_fallocate():
+    global _fallocate
+    if _fallocate is None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        func = getattr(libc, "fallocate64", None) or libc.fallocate
+        func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        func.restype = ctypes.c_int
+        _fallocate = func
+    return _fallocate
+
+
+def _get_sync_file_range():
+    global _sync_file_range
+    if _sync_file_range is None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        func = libc.sync_file_range
+        func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint]
+        func.restype = ctypes.c_int
+        _sync_file_range = func
+    return _sync_file_range
+
+
+def preallocate(fd, size):
+    """
+    Reserve ``size`` bytes for the file open as ``fd`` in one go, so the
+    filesystem can hand out one run of clusters instead of growing the file
+    chunk by chunk. The file size is left alone (``FALLOC_FL_KEEP_SIZE``, the
+    mode vfat supports), space not written to is given back on close.
+
+    Returns False where the kernel or filesystem can't do it, raises on real
+    errors such as ENOSPC.
+    """
+    if size <= 0:
+        return False
+    try:
+        fallocate = _get_fallocate()
+    except (OSError, AttributeError):
+        return False
+    if fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in _FALLBACK_ERRNOS:
+        return False
+    raise OSError(err, os.strerror(err))
+
+
+def _count_fibmap(fd):
+    # one ioctl per block, needs CAP_SYS_RAWIO
+    block_size = struct.unpack("I", fcntl.ioctl(fd, FIGETBSZ, struct.pack("I", 0)))[0]
+    extents = 0
+    previous = None
+    for block in range(-(-os.fstat(fd).st_size // block_size)):
+        physical = struct.unpack("I", fcntl.ioctl(fd, FIBMAP, struct.pack("I", block)))[
+            0
+        ]
+        if previous is None or physical != previous + 1:
+            extents += 1
+        previous = physical
+    return extents
+
+
+def count_extents(fd):
+    """
+    Number of fragments the file open as ``fd`` is stored in, asked with
+    FIEMAP and FIBMAP as the fallback. None if neither works.
+    """
+    # struct fiemap without room for extents, the kernel just counts them
+    request = bytearray(
+        struct.pack("=QQIIII", 0, 2**64 - 1, FIEMAP_FLAG_SYNC, 0, 0, 0)
+    )
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+        return struct.unpack_from("=I", request, 20)[0]
+    except OSError:
+        pass
+    try:
+        return _count_fibmap(fd)
+    except OSError:
+        return None
+
+
+def sync_range(fd, offset, nbytes, flags):
+    """
+    sync_file_range() on ``fd``. Returns False where the kernel or
+    filesystem can't do it, raises on real errors.
+    """
+    try:
+        func = _get_sync_file_range()
+    except (OSError, AttributeError):
+        return False
+    if func(fd, offset, nbytes, flags) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in _FALLBACK_ERRNOS:
+        return False
+    raise OSError(err, os.strerror(err))
+
+
+class WriteBack(object):
+    """
+    Keeps data written to ``fd`` from piling up in the page cache: at most
+    about ``limit`` bytes are dirty at any time. Written data is handed to
+    the device in windows of half the limit (``sync_file_range()``, or
+    ``fdatasync()`` where that's missing). The window before is waited for
+    and dropped from the cache, along with the same data of ``src_fd``. That
+    leaves little for the final flush or umount and doesn't push other
+    processes' memory out.
+
+    Data goes to ``fd`` sequentially from offset ``start``, read from
+    ``src_fd`` from ``src_start``. ``durable`` is the offset up to which it
+    is on the device.
+    """
+
+    def __init__(self, fd, limit, start=0, src_fd=None, src_start=None):
+        self._fd = fd
+        self._window = max(limit // 2, 1)
+        self._src_fd = src_fd
+        self._src_delta = (start if src_start is None else src_start) - start
+        self._submitted = start
+        self.durable = start
+
+    def _settle(self, end):
+        # everything before ``end`` onto the device and out of the cache
+        nbytes = end - self.durable
+        if nbytes <= 0:
+            return
+        flags = (
+            SYNC_FILE_RANGE_WAIT_BEFORE
+            | SYNC_FILE_RANGE_WRITE
+            | SYNC_FILE_RANGE_WAIT_AFTER
+        )
+        if not sync_range(self._fd, self.durable, nbytes, flags):
+            os.fdatasync(self._fd)
+        os.posix_fadvise(self._fd, self.durable, nbytes, os.POSIX_FADV_DONTNEED)
+        if self._src_fd is not None:
+            os.posix_fadvise(
+                self._src_fd,
+                self.durable + self._src_delta,
+                nbytes,
+                os.POSIX_FADV_DONTNEED,
+            )
+        self.durable = end
+
+    def update(self, offset):
+        # data was written up to ``offset``
+        while offset - self._submitted >= self._window:
+            # start writing this window, the one before had its time
+            sync_range(self._fd, self._submitted, self._window, SYNC_FILE_RANGE_WRITE)
+            self._submitted += self._window
+            self._settle(self._submitted - self._window)
+
+    def finish(self, offset):
+        self._submitted = max(self._submitted, offset)
+        self._settle(offset)
+
+
+def _with_writeback(writeback, progress_cb):
+    # progress callback counting only what is on the device
+    def on_progress(copied, total):
+        writeback.update(copied)
+        if progress_cb:
+            progress_cb(writeback.durable, total)
+
+    return on_progress
+
+
+def verify_prefix(src, dst, limit, bufsize=1024 * 1024, hasher=None, progress_cb=None):
+    """
+    Length of the part of ``dst``, up to ``limit`` bytes, that matches
+    ``src``, compared block by block from the start. Matching blocks are fed
+    to ``hasher``. Used to pick up an interrupted copy where it stopped.
+    """
+    verified = 0
+    with open(src, "rb", buffering=0) as fsrc, open(dst, "rb", buffering=0) as fdst:
+        while verified < limit:
+            n = min(bufsize, limit - verified)
+            block = fsrc.read(n)
+            if len(block) != n or fdst.read(n) != block:
+                break
+            if hasher is not None:
+                hasher.update(block)
+            verified += n
+            if progress_cb:
+                progress_cb(verified, limit)
+    return verified
+
+
+def _drop_cache(fd):
+    # written back first, dirty pages can't be dropped
+    os.fsync(fd)
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def read_back(path, hasher, bufsize=1024 * 1024, progress_cb=None):
+    """
+    Feed ``path`` to ``hasher`` as stored on the device, not as cached in
+    memory: read with O_DIRECT, or where the filesystem refuses that after
+    flushing the file and dropping its cached pages.
+
+    Returns the bytes read and whether O_DIRECT was used.
+    """
+    direct = hasattr(os, "O_DIRECT")
+    try:
+        fd = os.open(path, os.O_RDONLY | (os.O_DIRECT if direct else 0))
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise
+        direct = False
+        fd = os.open(path, os.O_RDONLY)
+
+    # anonymous mmap is page aligned, as O_DIRECT wants it
+    buf = mmap.mmap(-1, bufsize)
+    try:
+        if not direct:
+            _drop_cache(fd)
+        size = os.fstat(fd).st_size
+        done = 0
+        while True:
+            try:
+                n = os.readv(fd, [buf])
+            except OSError as e:
+                if not direct or done or e.errno != errno.EINVAL:
+                    raise
+                # O_DIRECT accepted on open but not on read
+                os.close(fd)
+                fd = os.open(path, os.O_RDONLY)
+                direct = False
+                _drop_cache(fd)
+                continue
+            if not n:
+                break
+            with memoryview(buf) as view:
+                hasher.update(view[:n])
+            done += n
+            if progress_cb:
+                progress_cb(done, size)
+    finally:
+        os.close(fd)
+        buf.close()
+    return done, direct
+
+
+def adaptive_bufsize(file_size):
+    # aim for ~64 progress steps per file, power of two within limits
+    bufsize = MIN_BUFSIZE
+    while bufsize < MAX_BUFSIZE and bufsize * 64 < file_size:
+        bufsize *= 2
+    return bufsize
+
+
+def _copy_kernel(copy_func, fsrc, fdst, size, copied, bufsize, progress_cb):
+    while copied < size:
+        n = copy_func(fsrc, fdst, min(bufsize, size - copied))
+        if n == 0:
+            break
+        copied += n
+        if progress_cb:
+            progress_cb(copied, size)
+    return copied
+
+
+def _copy_file_range(fsrc, fdst, count):
+    return os.copy_file_range(fsrc, fdst, count)
+
+
+def _sendfile(fsrc, fdst, count):
+    return os.sendfile(fdst, fsrc, None, count)
+
+
+def _copy_buffered(fsrc, fdst, size, copied, bufsize, progress_cb, hasher=None):
+    # Double buffering: a reader thread fills one buffer while this thread
+    # writes the other one out. Buffers are allocated once and reused.
+    free = queue.Queue()
+    filled = queue.Queue()
+    for _i in range(2):
+        free.put(bytearray(bufsize))
+
+    def reader():
+        try:
+            while True:
+                buf = free.get()
+                if buf is None:
+                    return
+                n = os.readv(fsrc, [buf])
+                if hasher is not None and n:
+                    # hashlib drops the GIL, so this overlaps with the write
+                    hasher.update(memoryview(buf)[:n])
+                filled.put((buf, n))
+                if n == 0:
+                    return
+        except Exception as e:
+            filled.put((e, 0))
+
+    thread = threading.Thread(target=reader, name="sdwire-copy-reader")
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            buf, n = filled.get()
+            if isinstance(buf, Exception):
+                raise buf
+            if n == 0:
+                break
+            view = memoryview(buf)[:n]
+            while view:
+                written = os.write(fdst, view)
+                view = view[written:]
+            copied += n
+            free.put(buf)
+            if progress_cb:
+                progress_cb(copied, size)
+    finally:
+        free.put(None)
+        thread.join()
+
+    return copied
+
+
+def _with_checkpoints(fdst, progress_cb, checkpoint_cb, interval, start):
+    # progress callback that also flushes and reports a checkpoint every
+    # ``interval`` bytes
+    next_checkpoint = [start + interval]
+
+    def on_progress(copied, total):
+        if copied >= next_checkpoint[0]:
+            os.fdatasync(fdst)
+            checkpoint_cb(copied)
+            next_checkpoint[0] = copied + interval
+        if progress_cb:
+            progress_cb(copied, total)
+
+    return on_progress
+
+
+def copy_file(
+    src,
+    dst,
+    progress_cb=None,
+    bufsize=0,
+    zero_copy=True,
+    hasher=None,
+    preallocate_dst=False,
+    resume_from=0,
+    checkpoint_cb=None,
+    checkpoint_interval=0,
+    writeback_limit=0,
+):
+    """
+    Copy ``src`` to ``dst``, calling ``progress_cb(copied, total)`` after every
+    chunk. Kernel side copies (``copy_file_range``, then ``sendfile``) are
+    tried first unless ``zero_copy`` is false, a double-buffered reader/writer
+    pair is the fallback. ``bufsize`` of 0 picks a chunk size from the file
+    size. Data is fed to ``hasher`` (a hashlib object) as it is read, which
+    rules out the kernel side copies. With ``preallocate_dst`` the whole size
+    is reserved before the first write.
+
+    ``resume_from`` keeps that many bytes of an existing ``dst`` and copies
+    the rest (check them with ``verify_prefix()`` first, ``hasher`` has to
+    have seen them). ``checkpoint_cb(copied)`` is called every
+    ``checkpoint_interval`` bytes once the data is flushed to ``dst``.
+
+    ``writeback_limit`` caps the bytes left dirty in the page cache (see
+    ``WriteBack``), progress then counts what is on the device and ``dst`` is
+    flushed before returning.
+
+    Returns a dict with bytes copied (including ``resume_from``), elapsed
+    time, MB/s of what was written, the method used, bytes resumed, whether
+    space was preallocated and the fragments ``dst`` ended up in.
+    """
+    start = time.monotonic()
+    fsrc = os.open(src, os.O_RDONLY)
+    try:
+        size = os.fstat(fsrc).st_size
+        if not bufsize:
+            bufsize = adaptive_bufsize(size)
+
+        flags = os.O_WRONLY | os.O_CREAT
+        if not resume_from:
+            flags |= os.O_TRUNC
+        fdst = os.open(dst, flags, 0o644)
+        try:
+            if resume_from:
+                os.ftruncate(fdst, resume_from)
+                os.lseek(fsrc, resume_from, os.SEEK_SET)
+                os.lseek(fdst, resume_from, os.SEEK_SET)
+            preallocated = preallocate_dst and preallocate(fdst, size)
+            copied = resume_from
+            method = None
+
+            report = progress_cb
+            writeback = None
+            if writeback_limit:
+                writeback = WriteBack(fdst, writeback_limit, resume_from, fsrc)
+                progress_cb = _with_writeback(writeback, progress_cb)
+            if checkpoint_cb and checkpoint_interval:
+                progress_cb = _with_checkpoints(
+                    fdst, progress_cb, checkpoint_cb, checkpoint_interval, resume_from
+                )
+
+            kernel_methods = []
+            if zero_copy and hasher is None:
+                if hasattr(os, "copy_file_range"):
+                    kernel_methods.append(("copy_file_range", _copy_file_range))
+                if hasattr(os, "sendfile"):
+                    kernel_methods.append(("sendfile", _sendfile))
+
+            for name, func in kernel_methods:
+                try:
+                    copied = _copy_kernel(
+                        func, fsrc, fdst, size, copied, bufsize, progress_cb
+                    )
+                except OSError as e:
+                    if e.errno not in _FALLBACK_ERRNOS:
+                        raise
+                    # the next method carries on from what this one wrote
+                    copied = os.lseek(fdst, 0, os.SEEK_CUR)
+                    os.lseek(fsrc, copied, os.SEEK_SET)
+                    continue
+                method = name
+                break
+
+            if method is None or copied < size:
+                # offsets of both files already point past what was copied
+                method = "buffered"
+                copied = _copy_buffered(
+                    fsrc, fdst, size, copied, bufsize, progress_cb, hasher
+                )
+            if writeback is not None:
+                writeback.finish(copied)
+                if report:
+                    report(copied, size)
+            fragments = count_extents(fdst)
+        finally:
+            os.close(fdst)
+    finally:
+        os.close(fsrc)
+
+    elapsed = time.monotonic() - start
+    written = copied - resume_from
+    return dict(
+        copied=copied,
+        elapsed=elapsed,
+        speed=written / elapsed / 1000000 if elapsed > 0 else 0.0,
+        method=method,
+        bufsize=bufsize,
+        resumed=resume_from,
+        preallocated=preallocated,
+        fragments=fragments,
+    )
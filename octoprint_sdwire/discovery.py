@@ -0,0 +1,99 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+
+BY_UUID_DIR = "/dev/disk/by-uuid"
+
+# from <sys/inotify.h>
+IN_CREATE = 0x00000100
+IN_MOVED_TO = 0x00000080
+
+POLL_INTERVAL = 0.05
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(
+            ctypes.util.find_library("c") or "libc.so.6", use_errno=True
+        )
+    return _libc
+
+
+def find_device(uuid, by_uuid_dir=BY_UUID_DIR):
+    # udev names the link after the fs UUID, vfat ones are upper case but
+    # users type them any way they like
+    try:
+        names = os.listdir(by_uuid_dir)
+    except OSError:
+        return None
+
+    uuid = uuid.lower()
+    for name in names:
+        if name.lower() == uuid:
+            path = os.path.join(by_uuid_dir, name)
+            if os.path.exists(path):
+                return os.path.realpath(path)
+    return None
+
+
+def _inotify_watch(path):
+    try:
+        libc = _get_libc()
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+
+    if libc.inotify_add_watch(fd, os.fsencode(path), IN_CREATE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def wait_for_device(uuid, timeout, by_uuid_dir=BY_UUID_DIR):
+    """
+    Wait up to ``timeout`` seconds for the block device with filesystem
+    ``uuid`` to show up in ``by_uuid_dir`` and return its device node.
+
+    Wakes up on inotify events for the directory, falls back to cheap
+    polling of the directory if inotify can't be used. Returns None on
+    timeout.
+    """
+    deadline = time.monotonic() + timeout
+
+    # watch first, then check, so a link created in between isn't missed
+    fd = _inotify_watch(by_uuid_dir)
+    try:
+        poller = None
+        if fd is not None:
+            poller = select.poll()
+            poller.register(fd, select.POLLIN)
+
+        while True:
+            device = find_device(uuid, by_uuid_dir)
+            if device:
+                return device
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+
+            if poller is None:
+                time.sleep(min(POLL_INTERVAL, remaining))
+                continue
+
+            if poller.poll(remaining * 1000):
+                try:
+                    while os.read(fd, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+    finally:
+        if fd is not None:
+            os.close(fd)
@@ -0,0 +1,841 @@
+import array
+import os
+import struct
+import subprocess
+import sys
+import time
+import zlib
+
+from . import copier, vfat
+
+FSCK_VFAT = "/usr/sbin/fsck.vfat"
+
+ATTR_READ_ONLY = 0x01
+ATTR_HIDDEN = 0x02
+ATTR_SYSTEM = 0x04
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0F
+
+ENTRY_SIZE = 32
+DELETED = 0xE5
+LAST_LFN = 0x40
+LFN_CHARS = 13
+
+FAT_MASK = 0x0FFFFFFF
+FAT_BAD = 0x0FFFFFF7
+FAT_EOC = 0x0FFFFFFF
+
+# FSInfo sector signatures
+FSINFO_LEAD = 0x41615252
+FSINFO_STRUCT = 0x61417272
+
+
+class Fat32Error(Exception):
+    pass
+
+
+def _lfn_checksum(name11):
+    checksum = 0
+    for c in name11:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + c) & 0xFF
+    return checksum
+
+
+def _dos_datetime(timestamp):
+    t = time.localtime(timestamp)
+    year = min(max(t.tm_year, 1980), 2107)
+    date = ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    dtime = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    return date, dtime
+
+
+def _from_dos_datetime(date, dtime):
+    # local time like _dos_datetime(), None when no date is set
+    if not date:
+        return None
+    try:
+        return time.mktime(
+            (
+                1980 + (date >> 9),
+                (date >> 5) & 0x0F,
+                date & 0x1F,
+                dtime >> 11,
+                (dtime >> 5) & 0x3F,
+                (dtime & 0x1F) * 2,
+                0,
+                0,
+                -1,
+            )
+        )
+    except (OverflowError, ValueError):
+        return None
+
+
+def _short_name_bytes(short_name):
+    base, _, ext = short_name.partition(".")
+    raw = (base.ljust(8) + ext.ljust(3)).encode("cp437", errors="replace")
+    if raw[0] == DELETED:
+        raw = b"\x05" + raw[1:]
+    return raw
+
+
+def _decode_short_name(raw, ntres):
+    if raw[0] == 0x05:
+        raw = bytes([DELETED]) + raw[1:]
+    base = raw[:8].decode("cp437").rstrip()
+    ext = raw[8:].decode("cp437").rstrip()
+    # NT case flags, set by Linux/Windows for lower case 8.3 names
+    if ntres & 0x08:
+        base = base.lower()
+    if ntres & 0x10:
+        ext = ext.lower()
+    return base + "." + ext if ext else base
+
+
+def _extents(clusters):
+    extents = []
+    for cluster in clusters:
+        if extents and extents[-1][0] + extents[-1][1] == cluster:
+            extents[-1][1] += 1
+        else:
+            extents.append([cluster, 1])
+    return extents
+
+
+def is_mounted(path):
+    device = os.path.realpath(path)
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                source = line.split(" ", 1)[0]
+                if source.startswith("/") and os.path.realpath(source) == device:
+                    return True
+    except OSError:
+        pass
+    return False
+
+
+def fsck(path, fsck_vfat=FSCK_VFAT):
+    # read-only check, returns (ok, output), ok is None if fsck couldn't run
+    try:
+        output = subprocess.check_output(
+            [fsck_vfat, "-n", path], stderr=subprocess.STDOUT
+        )
+    except subprocess.CalledProcessError as e:
+        return False, e.output.decode(errors="replace")
+    except OSError as e:
+        return None, str(e)
+    return True, output.decode(errors="replace")
+
+
+def mkfs(path, size, cluster_size=4096, label="SDWIRE"):
+    """
+    Create an empty FAT32 filesystem of ``size`` bytes in image file
+    ``path``, laid out like mkfs.vfat does (32 reserved sectors, two FATs,
+    backup boot sector at 6). The image is sparse. Meant for tests and
+    benchmarks, cards come formatted.
+    """
+    sector = 512
+    spc = cluster_size // sector
+    reserved = 32
+    total = size // sector
+
+    fat_sectors = 1
+    while True:
+        clusters = (total - reserved - 2 * fat_sectors) // spc
+        needed = -(-(clusters + 2) * 4 // sector)
+        if needed <= fat_sectors:
+            break
+        fat_sectors = needed
+    if clusters < 65525:
+        raise Fat32Error(
+            "{} bytes is too small for FAT32 with {} byte clusters".format(
+                size, cluster_size
+            )
+        )
+
+    boot = bytearray(sector)
+    boot[0:11] = b"\xeb\x58\x90MSWIN4.1"
+    struct.pack_into(
+        "<HBHBHHBHHHII",
+        boot,
+        11,
+        sector,
+        spc,
+        reserved,
+        2,
+        0,
+        0,
+        0xF8,
+        0,
+        63,
+        255,
+        0,
+        total,
+    )
+    struct.pack_into("<IHHIHH", boot, 36, fat_sectors, 0, 0, 2, 1, 6)
+    struct.pack_into(
+        "<BBBI11s8s",
+        boot,
+        64,
+        0x80,
+        0,
+        0x29,
+        int(time.time()) & 0xFFFFFFFF,
+        label.upper().ljust(11).encode("ascii")[:11],
+        b"FAT32   ",
+    )
+    boot[510:512] = b"\x55\xaa"
+
+    fsinfo = bytearray(sector)
+    struct.pack_into("<I", fsinfo, 0, FSINFO_LEAD)
+    struct.pack_into("<IIII", fsinfo, 484, FSINFO_STRUCT, clusters - 1, 3, 0)
+    struct.pack_into("<I", fsinfo, 508, 0xAA550000)
+
+    fat = struct.pack("<III", 0x0FFFFFF8, FAT_EOC, FAT_EOC)
+
+    root = bytearray(cluster_size)
+    root[0:11] = label.upper().ljust(11).encode("ascii")[:11]
+    root[11] = ATTR_VOLUME_ID
+
+    with open(path, "wb") as f:
+        f.truncate(size)
+        for offset in (0, 6):
+            f.seek(offset * sector)
+            f.write(boot)
+            f.write(fsinfo)
+        for index in range(2):
+            f.seek((reserved + index * fat_sectors) * sector)
+            f.write(fat)
+        f.seek((reserved + 2 * fat_sectors) * sector)
+        f.write(root)
+
+
+class Fat32Volume(object):
+    """
+    Minimal FAT32 writer working directly on a block device or image file,
+    no mount, page cache or sudo involved. Files go into the root directory;
+    data clusters are allocated contiguously when possible and the FAT is
+    written back in one go per file.
+    """
+
+    def __init__(self, path):
+        if is_mounted(path):
+            raise Fat32Error("{} is mounted".format(path))
+
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | getattr(os, "O_CLOEXEC", 0))
+        try:
+            self._read_boot_sector()
+            self._read_fat()
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    ##~~ low level io
+
+    def _pread(self, size, offset):
+        data = os.pread(self._fd, size, offset)
+        if len(data) != size:
+            raise Fat32Error("short read at {}".format(offset))
+        return data
+
+    def _pwrite(self, data, offset):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self._fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    def _cluster_offset(self, cluster):
+        return self.data_offset + (cluster - 2) * self.cluster_size
+
+    ##~~ boot sector and FAT
+
+    def _read_boot_sector(self):
+        boot = self._pread(512, 0)
+        if boot[510:512] != b"\x55\xaa":
+            raise Fat32Error("no boot sector signature")
+
+        (
+            bytes_per_sector,
+            sectors_per_cluster,
+            reserved_sectors,
+            num_fats,
+            root_entries,
+            total_sectors_16,
+            _media,
+            fat_size_16,
+        ) = struct.unpack_from("<HBHBHHBH", boot, 11)
+        (
+            total_sectors_32,
+            fat_size_32,
+            ext_flags,
+            _version,
+            root_cluster,
+            fsinfo_sector,
+        ) = struct.unpack_from("<IIHHIH", boot, 32)
+
+        if bytes_per_sector not in (512, 1024, 2048, 4096) or not sectors_per_cluster:
+            raise Fat32Error("invalid BPB")
+        if root_entries or fat_size_16 or not fat_size_32:
+            raise Fat32Error("not a FAT32 filesystem")
+
+        total_sectors = total_sectors_16 or total_sectors_32
+        data_sector = reserved_sectors + num_fats * fat_size_32
+
+        self.bytes_per_sector = bytes_per_sector
+        self.cluster_size = bytes_per_sector * sectors_per_cluster
+        self.fat_offset = reserved_sectors * bytes_per_sector
+        self.fat_size = fat_size_32 * bytes_per_sector
+        self.data_offset = data_sector * bytes_per_sector
+        self.cluster_count = (total_sectors - data_sector) // sectors_per_cluster
+        self.root_cluster = root_cluster
+
+        if self.cluster_count < 65525:
+            raise Fat32Error("not a FAT32 filesystem (too few clusters)")
+        if (self.cluster_count + 2) * 4 > self.fat_size:
+            raise Fat32Error("FAT too small for cluster count")
+
+        # bit 7 set: only the active FAT is used, no mirroring
+        if ext_flags & 0x80:
+            self._fats = [ext_flags & 0x0F]
+        else:
+            self._fats = list(range(num_fats))
+
+        if fsinfo_sector in (0, 0xFFFF):
+            self._fsinfo_offset = None
+        else:
+            self._fsinfo_offset = fsinfo_sector * bytes_per_sector
+
+    def _read_fat(self):
+        entries = self.cluster_count + 2
+        self._fat = array.array("I")
+        self._fat.frombytes(
+            self._pread(entries * 4, self.fat_offset + self._fats[0] * self.fat_size)
+        )
+        if sys.byteorder == "big":
+            self._fat.byteswap()
+        self._dirty = None
+        self._next_free = 2
+
+        if self._fsinfo_offset is not None:
+            fsinfo = self._pread(512, self._fsinfo_offset)
+            lead = struct.unpack_from("<I", fsinfo, 0)[0]
+            struc, _free, next_free = struct.unpack_from("<III", fsinfo, 484)
+            if lead == FSINFO_LEAD and struc == FSINFO_STRUCT:
+                if 2 <= next_free < entries:
+                    self._next_free = next_free
+            else:
+                self._fsinfo_offset = None
+
+    def _get(self, cluster):
+        return self._fat[cluster] & FAT_MASK
+
+    def _set(self, cluster, value):
+        # upper 4 bits are reserved and must be kept
+        self._fat[cluster] = (self._fat[cluster] & ~FAT_MASK & 0xFFFFFFFF) | value
+        if self._dirty is None:
+            self._dirty = [cluster, cluster]
+        else:
+            self._dirty[0] = min(self._dirty[0], cluster)
+            self._dirty[1] = max(self._dirty[1], cluster)
+
+    def _flush_fat(self):
+        if self._dirty is None:
+            return
+        sector = self.bytes_per_sector
+        start = (self._dirty[0] * 4) // sector * sector
+        end = min(-(-(self._dirty[1] + 1) * 4 // sector) * sector, len(self._fat) * 4)
+
+        fat = self._fat[start // 4 : end // 4]
+        if sys.byteorder == "big":
+            fat.byteswap()
+        data = fat.tobytes()
+        for index in self._fats:
+            self._pwrite(data, self.fat_offset + index * self.fat_size + start)
+        self._dirty = None
+
+    def _flush_fsinfo(self):
+        if self._fsinfo_offset is None:
+            return
+        self._pwrite(
+            struct.pack("<II", self.free_clusters(), self._next_free),
+            self._fsinfo_offset + 488,
+        )
+
+    def chain(self, cluster):
+        clusters = []
+        while 2 <= cluster < FAT_BAD:
+            if cluster >= len(self._fat) or len(clusters) > self.cluster_count:
+                raise Fat32Error("corrupt cluster chain")
+            clusters.append(cluster)
+            cluster = self._get(cluster)
+        return clusters
+
+    def free_clusters(self):
+        return self._fat.count(0)
+
+    def free_bytes(self):
+        return self.free_clusters() * self.cluster_size
+
+    def _find_free_run(self, count, start):
+        pattern = b"\0" * (4 * count)
+        data = self._fat.tobytes()
+        pos = start * 4
+        while True:
+            offset = data.find(pattern, pos)
+            if offset < 0:
+                return None
+            if offset % 4:
+                pos = offset + 4 - offset % 4
+                continue
+            return offset // 4
+
+    def _allocate(self, count):
+        if not count:
+            return []
+
+        start = self._find_free_run(count, self._next_free)
+        if start is None and self._next_free > 2:
+            start = self._find_free_run(count, 2)
+        if start is not None:
+            clusters = list(range(start, start + count))
+        else:
+            # no contiguous space left, take free clusters in order
+            clusters = []
+            total = len(self._fat)
+            for i in range(total - 2):
+                cluster = 2 + (self._next_free - 2 + i) % (total - 2)
+                if self._fat[cluster] == 0:
+                    clusters.append(cluster)
+                    if len(clusters) == count:
+                        break
+            if len(clusters) < count:
+                raise Fat32Error(
+                    "not enough free space ({} clusters needed, {} free)".format(
+                        count, len(clusters)
+                    )
+                )
+
+        for cluster, following in zip(clusters, clusters[1:]):
+            self._set(cluster, following)
+        self._set(clusters[-1], FAT_EOC)
+        self._next_free = clusters[-1] + 1 if clusters[-1] + 1 < len(self._fat) else 2
+        return clusters
+
+    def _free(self, cluster):
+        for c in self.chain(cluster):
+            self._set(c, 0)
+
+    ##~~ directories
+
+    def _dir_slots(self, cluster):
+        slots = []
+        for c in self.chain(cluster):
+            data = self._pread(self.cluster_size, self._cluster_offset(c))
+            offset = self._cluster_offset(c)
+            for i in range(0, self.cluster_size, ENTRY_SIZE):
+                slots.append((offset + i, data[i : i + ENTRY_SIZE]))
+        return slots
+
+    def list_dir(self, cluster=None):
+        """
+        Entries of a directory (root by default) as dicts with long_name,
+        short_name, attr, cluster, size, mtime and the slot offsets they use.
+        """
+        if cluster is None:
+            cluster = self.root_cluster
+
+        entries = []
+        lfn = None
+        for offset, raw in self._dir_slots(cluster):
+            first = raw[0]
+            if first == 0:
+                break
+            if first == DELETED:
+                lfn = None
+                continue
+
+            attr = raw[11]
+            if attr & 0x3F == ATTR_LONG_NAME:
+                seq = first & 0x1F
+                if first & LAST_LFN or lfn is None:
+                    lfn = dict(parts={}, checksum=raw[13], slots=[])
+                lfn["parts"][seq] = raw[1:11] + raw[14:26] + raw[28:32]
+                lfn["slots"].append(offset)
+                continue
+
+            if attr & ATTR_VOLUME_ID or raw[:2] in (b".\x20", b".."):
+                lfn = None
+                continue
+
+            short_name = _decode_short_name(raw[:11], raw[12])
+            long_name = None
+            slots = [offset]
+            if lfn is not None and lfn["checksum"] == _lfn_checksum(raw[:11]):
+                units = b"".join(lfn["parts"][i] for i in sorted(lfn["parts"]))
+                long_name = units.decode("utf-16-le", errors="replace")
+                long_name = long_name.split("\0", 1)[0]
+                slots = lfn["slots"] + slots
+            lfn = None
+
+            (hi, wtime, wdate, lo, size) = struct.unpack_from("<HHHHI", raw, 20)
+            entries.append(
+                dict(
+                    long_name=long_name or short_name,
+                    short_name=short_name,
+                    attr=attr,
+                    cluster=(hi << 16) | lo,
+                    size=size,
+                    mtime=(wdate, wtime),
+                    slots=slots,
+                )
+            )
+        return entries
+
+    def _find_slots(self, slots, count, dir_cluster):
+        run = []
+        for offset, raw in slots:
+            if raw[0] in (0, DELETED):
+                run.append(offset)
+                if len(run) == count:
+                    return run
+            else:
+                run = []
+
+        # not enough room, grow the directory by one cluster
+        new = self._allocate(1)[0]
+        self._pwrite(b"\0" * self.cluster_size, self._cluster_offset(new))
+        self._set(self.chain(dir_cluster)[-1], new)
+        self._set(new, FAT_EOC)
+        offset = self._cluster_offset(new)
+        while len(run) < count:
+            run.append(offset)
+            offset += ENTRY_SIZE
+        return run
+
+    def _dir_entries(self, long_name, short_name, needs_lfn, cluster, size, mtime):
+        name11 = _short_name_bytes(short_name)
+        date, dtime = _dos_datetime(mtime)
+        entry = struct.pack(
+            "<11sBBBHHHHHHHI",
+            name11,
+            ATTR_ARCHIVE,
+            0,
+            0,
+            dtime,
+            date,
+            date,
+            (cluster >> 16) & 0xFFFF,
+            dtime,
+            date,
+            cluster & 0xFFFF,
+            size,
+        )
+        if not needs_lfn:
+            return [entry]
+
+        units = long_name.encode("utf-16-le")
+        if len(units) > 255 * 2:
+            raise Fat32Error("file name too long: {}".format(long_name))
+        count = -(-len(units) // (2 * LFN_CHARS))
+        if len(units) % (2 * LFN_CHARS):
+            units += b"\0\0"
+            units += b"\xff" * (count * 2 * LFN_CHARS - len(units))
+
+        checksum = _lfn_checksum(name11)
+        entries = []
+        for seq in range(count, 0, -1):
+            part = units[(seq - 1) * 2 * LFN_CHARS : seq * 2 * LFN_CHARS]
+            entries.append(
+                struct.pack(
+                    "<B10sBBB12sH4s",
+                    seq | (LAST_LFN if seq == count else 0),
+                    part[0:10],
+                    ATTR_LONG_NAME,
+                    0,
+                    checksum,
+                    part[10:22],
+                    0,
+                    part[22:26],
+                )
+            )
+        return entries + [entry]
+
+    def _unique_short_name(self, long_name, existing):
+        short_name, needs_lfn = vfat.make_short_name(long_name, existing)
+        if short_name:
+            return short_name, needs_lfn
+
+        # more than 9 numeric tails taken, use hashed ones like the kernel
+        short_name = vfat.make_short_name(long_name)[0]
+        if not short_name:
+            raise Fat32Error("invalid file name: {}".format(long_name))
+        base, _, ext = short_name.partition(".")
+        # same name for the same file every time, unlike hash()
+        seed = zlib.crc32(long_name.encode("utf-8")) & 0xFFFF
+        for i in range(0x10000):
+            name = "{}{:04X}~1".format(base[:2], (seed - i * 11) & 0xFFFF)
+            if ext:
+                name += "." + ext
+            if name not in existing:
+                return name, True
+        raise Fat32Error("no free short name for {}".format(long_name))
+
+    ##~~ files
+
+    def find(self, name):
+        for entry in self.list_dir():
+            if entry["attr"] & ATTR_DIRECTORY:
+                continue
+            if name.lower() in (
+                entry["long_name"].lower(),
+                entry["short_name"].lower(),
+            ):
+                return entry
+        return None
+
+    def walk(self, cluster=None, path=(), short_path=()):
+        """
+        Files of a directory (root by default) and all directories below as
+        dicts like ``list_dir()`` gives them, plus ``path`` and
+        ``short_path`` ("/"-joined from the root) and ``date``.
+        """
+        for entry in self.list_dir(cluster):
+            entry_path = path + (entry["long_name"],)
+            entry_short_path = short_path + (entry["short_name"],)
+            if entry["attr"] & ATTR_DIRECTORY:
+                if entry["cluster"]:
+                    for child in self.walk(
+                        entry["cluster"], entry_path, entry_short_path
+                    ):
+                        yield child
+                continue
+            entry["path"] = "/".join(entry_path)
+            entry["short_path"] = "/".join(entry_short_path)
+            entry["date"] = _from_dos_datetime(*entry["mtime"])
+            yield entry
+
+    def find_path(self, path):
+        # file anywhere on the card by long or short path, None if missing
+        path = path.strip("/").lower()
+        for entry in self.walk():
+            if path in (entry["path"].lower(), entry["short_path"].lower()):
+                return entry
+        return None
+
+    def export(self, entry, dst, bufsize=1024 * 1024, progress_cb=None):
+        # copy a file found with list_dir()/walk() to local file ``dst``
+        size = entry["size"]
+        done = 0
+        with open(dst, "wb") as f:
+            for first, count in _extents(self.chain(entry["cluster"]) if size else []):
+                offset = self._cluster_offset(first)
+                left = min(count * self.cluster_size, size - done)
+                while left > 0:
+                    data = self._pread(min(bufsize, left), offset)
+                    f.write(data)
+                    offset += len(data)
+                    left -= len(data)
+                    done += len(data)
+                    if progress_cb:
+                        progress_cb(done, size)
+        return done
+
+    def rename(self, name, new_name):
+        """
+        Rename file ``name`` in the root directory to ``new_name``, replacing
+        a file of that name. The data stays where it is. Returns the new
+        short name.
+        """
+        entry = self.find(name)
+        if entry is None:
+            raise Fat32Error("{} not found".format(name))
+        # new_name may be the file's own other name, e.g. its 8.3 alias
+        target = self.find(new_name)
+        if target is not None and target["slots"] != entry["slots"]:
+            self.delete(new_name)
+
+        existing = set(
+            other["short_name"].upper()
+            for other in self.list_dir()
+            if other["slots"] != entry["slots"]
+        )
+        short_name, needs_lfn = self._unique_short_name(new_name, existing)
+        entries = self._dir_entries(
+            new_name,
+            short_name,
+            needs_lfn,
+            entry["cluster"],
+            entry["size"],
+            _from_dos_datetime(*entry["mtime"]) or time.time(),
+        )
+
+        # the old entries are dropped first so their slots can be reused
+        for offset in entry["slots"]:
+            self._pwrite(bytes([DELETED]), offset)
+        slots = self._find_slots(
+            self._dir_slots(self.root_cluster), len(entries), self.root_cluster
+        )
+        for offset, raw in zip(slots, entries):
+            self._pwrite(raw, offset)
+        self._flush_fat()
+        self._flush_fsinfo()
+        os.fsync(self._fd)
+        return short_name.lower()
+
+    def read_file(self, name):
+        # whole file as bytes, meant for small files; None if missing
+        entry = self.find(name)
+        if entry is None:
+            return None
+        data = bytearray()
+        for cluster in self.chain(entry["cluster"]):
+            data += self._pread(self.cluster_size, self._cluster_offset(cluster))
+        return bytes(data[: entry["size"]])
+
+    def read_back(self, name, hasher, bufsize=1024 * 1024, progress_cb=None):
+        """
+        Feed file ``name`` to ``hasher`` as stored on the card: the cached
+        pages of its clusters are dropped before they are read. Returns the
+        bytes read.
+        """
+        entry = self.find(name)
+        if entry is None:
+            raise Fat32Error("{} not found".format(name))
+        size = entry["size"]
+        os.fsync(self._fd)
+        done = 0
+        for first, count in _extents(self.chain(entry["cluster"])):
+            offset = self._cluster_offset(first)
+            left = min(count * self.cluster_size, size - done)
+            os.posix_fadvise(self._fd, offset, left, os.POSIX_FADV_DONTNEED)
+            while left > 0:
+                data = self._pread(min(bufsize, left), offset)
+                hasher.update(data)
+                offset += len(data)
+                left -= len(data)
+                done += len(data)
+                if progress_cb:
+                    progress_cb(done, size)
+        return done
+
+    def delete(self, name):
+        for entry in self.list_dir():
+            if entry["attr"] & ATTR_DIRECTORY:
+                continue
+            if name.lower() in (
+                entry["long_name"].lower(),
+                entry["short_name"].lower(),
+            ):
+                if entry["cluster"]:
+                    self._free(entry["cluster"])
+                for offset in entry["slots"]:
+                    self._pwrite(bytes([DELETED]), offset)
+                self._flush_fat()
+                self._flush_fsinfo()
+                return True
+        return False
+
+    def write_file(
+        self,
+        name,
+        src,
+        progress_cb=None,
+        bufsize=1024 * 1024,
+        mtime=None,
+        hasher=None,
+        writeback_limit=0,
+    ):
+        """
+        Write local file ``src`` as ``name`` into the root directory,
+        replacing a file of the same name. Data is fed to ``hasher`` on the
+        way if given. ``writeback_limit`` caps the bytes left dirty in the
+        page cache (see ``copier.WriteBack``), progress then counts what is on
+        the card. Returns a dict with the short name, bytes written, number
+        of fragments and MB/s.
+        """
+        start_time = time.monotonic()
+        size = os.path.getsize(src)
+        if mtime is None:
+            mtime = time.time()
+
+        self.delete(name)
+
+        existing = set(entry["short_name"].upper() for entry in self.list_dir())
+        short_name, needs_lfn = self._unique_short_name(name, existing)
+
+        clusters = self._allocate(-(-size // self.cluster_size))
+        extents = _extents(clusters)
+
+        buf = bytearray(min(bufsize, max(size, 1)))
+        written = 0
+        try:
+            with open(src, "rb", buffering=0) as f:
+                for first, count in extents:
+                    offset = self._cluster_offset(first)
+                    left = min(count * self.cluster_size, size - written)
+                    writeback = None
+                    if writeback_limit:
+                        writeback = copier.WriteBack(
+                            self._fd, writeback_limit, offset, f.fileno(), written
+                        )
+                    while left > 0:
+                        n = f.readinto(memoryview(buf)[: min(len(buf), left)])
+                        if not n:
+                            raise Fat32Error("{} shrank while copying".format(src))
+                        if hasher is not None:
+                            hasher.update(memoryview(buf)[:n])
+                        self._pwrite(memoryview(buf)[:n], offset)
+                        offset += n
+                        left -= n
+                        written += n
+                        if writeback is not None:
+                            writeback.update(offset)
+                        if progress_cb:
+                            pending = offset - writeback.durable if writeback else 0
+                            progress_cb(written - pending, size)
+                    if writeback is not None:
+                        writeback.finish(offset)
+                        if progress_cb:
+                            progress_cb(written, size)
+        except BaseException:
+            # nothing points at the clusters yet, give them back
+            if clusters:
+                self._free(clusters[0])
+            raise
+
+        entries = self._dir_entries(
+            name, short_name, needs_lfn, clusters[0] if clusters else 0, size, mtime
+        )
+        slots = self._find_slots(
+            self._dir_slots(self.root_cluster), len(entries), self.root_cluster
+        )
+
+        # data first, then FAT, then the directory entry pointing at it
+        os.fsync(self._fd)
+        self._flush_fat()
+        for offset, entry in zip(slots, entries):
+            self._pwrite(entry, offset)
+        self._flush_fsinfo()
+        os.fsync(self._fd)
+
+        elapsed = time.monotonic() - start_time
+        return dict(
+            short_filename=short_name.lower(),
+            copied=written,
+            elapsed=elapsed,
+            speed=written / elapsed / 1000000 if elapsed > 0 else 0.0,
+            method="fat32",
+            fragments=len(extents),
+        )
+
+    def close(self):
+        if self._fd is not None:
+            self._flush_fat()
+            os.fsync(self._fd)
+            os.close(self._fd)
+            self._fd = None
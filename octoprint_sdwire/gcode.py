@@ -0,0 +1,588 @@
+import os
+import re
+import struct
+import time
+import zlib
+
+from . import copier
+
+# input is read in chunks of this size, only whole lines are passed on
+CHUNK_SIZE = 256 * 1024
+
+_THUMBNAIL_BEGIN_RE = re.compile(rb"^;\s*thumbnail(_\w+)?\s+begin\b")
+_THUMBNAIL_END_RE = re.compile(rb"^;\s*thumbnail(_\w+)?\s+end\b")
+_MOVE_RE = re.compile(rb"^(G0|G1|G2|G3|G92)(\s|$)")
+_METADATA_RE = re.compile(rb"^;\s*([^=;]+?)\s*=\s*(.*?)\s*$")
+
+
+class Stage(object):
+    """
+    One step of a transform pipeline. ``process()`` gets a list of lines
+    (bytes, without line terminator) and returns the lines to pass on,
+    ``flush()`` returns what is still held back at the end of the file.
+    Stages only ever see one chunk of lines at a time.
+    """
+
+    name = None
+
+    def process(self, lines):
+        return lines
+
+    def flush(self):
+        return []
+
+    def signature(self):
+        return self.name
+
+
+class StripComments(Stage):
+    # drops ; comments, thumbnail blocks (which are comments too) and blank
+    # lines; with comments=False only thumbnails go
+
+    name = "strip"
+
+    def __init__(self, comments=True, thumbnails=True):
+        self.comments = comments
+        self.thumbnails = thumbnails
+        self._in_thumbnail = False
+
+    def process(self, lines):
+        result = []
+        for line in lines:
+            if self.thumbnails:
+                if self._in_thumbnail:
+                    if _THUMBNAIL_END_RE.match(line):
+                        self._in_thumbnail = False
+                    continue
+                if _THUMBNAIL_BEGIN_RE.match(line):
+                    self._in_thumbnail = True
+                    continue
+            if self.comments:
+                pos = line.find(b";")
+                if pos != -1:
+                    line = line[:pos]
+                line = line.rstrip()
+                if not line:
+                    continue
+            result.append(line)
+        return result
+
+    def signature(self):
+        return "{}(comments={},thumbnails={})".format(
+            self.name, int(self.comments), int(self.thumbnails)
+        )
+
+
+class TrimPrecision(Stage):
+    # rounds move parameters with more decimals than needed, extrusion keeps
+    # more digits than coordinates; lines already precise enough are only
+    # scanned, which is the common case for current slicers
+
+    name = "precision"
+
+    def __init__(self, xyz=3, e=5):
+        self.xyz = xyz
+        self.e = e
+        self._param_re = re.compile(
+            rb"([XYZIJR])(-?\d*\.\d{%d}\d+)|(E)(-?\d*\.\d{%d}\d+)|(F)(\d*\.\d+)"
+            % (xyz, e)
+        )
+
+    def _trim(self, match):
+        if match.group(1):
+            axis, value, digits = match.group(1), match.group(2), self.xyz
+        elif match.group(3):
+            axis, value, digits = match.group(3), match.group(4), self.e
+        else:
+            axis, value, digits = match.group(5), match.group(6), 0
+        value = b"%.*f" % (digits, float(value))
+        if digits:
+            value = value.rstrip(b"0").rstrip(b".")
+        if value in (b"-0", b""):
+            value = b"0"
+        return axis + value
+
+    def process(self, lines):
+        result = []
+        for line in lines:
+            if _MOVE_RE.match(line):
+                pos = line.find(b";")
+                if pos == -1:
+                    line = self._param_re.sub(self._trim, line)
+                else:
+                    line = self._param_re.sub(self._trim, line[:pos]) + line[pos:]
+            result.append(line)
+        return result
+
+    def signature(self):
+        return "{}(xyz={},e={})".format(self.name, self.xyz, self.e)
+
+
+class TextEncoder(object):
+    name = "text"
+
+    def scan(self, fd):
+        pass
+
+    def header(self):
+        return b""
+
+    def encode(self, lines):
+        if not lines:
+            return b""
+        return b"\n".join(lines) + b"\n"
+
+    def flush(self):
+        return b""
+
+    def signature(self):
+        return self.name
+
+
+# MeatPack packs the 15 most common characters of gcode two to a byte, a
+# nibble of 0b1111 means the character follows in full. With spaces omitted
+# "E" takes the code of the space.
+_MEATPACK_CHARACTERS = b"0123456789.E\nGX"
+_MEATPACK_ENABLE_PACKING = b"\xff\xff\xfb"
+_MEATPACK_DISABLE_PACKING = b"\xff\xff\xfa"
+_MEATPACK_ENABLE_NO_SPACES = b"\xff\xff\xf7"
+_MEATPACK_MOVE_TABLE = bytes.maketrans(b"egx", b"EGX")
+_PAIR_RE = re.compile(b"..", re.S)
+
+
+class _MeatPackPairs(dict):
+    # encoded form of two characters, filled in as pairs come up
+
+    def __missing__(self, pair):
+        codes = [_MEATPACK_CHARACTERS.find(c) for c in pair]
+        codes = [0b1111 if code == -1 else code for code in codes]
+        encoded = bytes([codes[0] | codes[1] << 4]) + bytes(
+            c for c, code in zip(pair, codes) if code == 0b1111
+        )
+        self[pair] = encoded
+        return encoded
+
+
+_meatpack_pairs = _MeatPackPairs()
+
+
+def _meatpack_line(line):
+    # Like libbgcode: comments are cut off, moves lose their spaces and have
+    # their letters upper case. Lines are padded to an even length with a
+    # newline, so pairs never span two lines.
+    pos = line.find(b";")
+    if pos != -1:
+        line = line[:pos]
+    line = line.rstrip()
+    if not line:
+        return b""
+    pos = line.find(b"G")
+    if pos != -1 and line[pos + 1 : pos + 2].isdigit():
+        line = line.translate(_MEATPACK_MOVE_TABLE, b" ")
+    line += b"\n"
+    if len(line) % 2:
+        line += b"\n"
+    return line
+
+
+def meatpack(lines):
+    """
+    MeatPack encoding of ``lines`` (without line terminators) with spaces
+    omitted, comment lines are kept and passed on unpacked. Each call is a
+    complete stream as a .bgcode gcode block needs it.
+    """
+    out = [_MEATPACK_ENABLE_PACKING, _MEATPACK_ENABLE_NO_SPACES]
+    packing = True
+    code = []
+
+    def pack():
+        out.append(
+            b"".join(map(_meatpack_pairs.__getitem__, _PAIR_RE.findall(b"".join(code))))
+        )
+        del code[:]
+
+    for line in lines:
+        if line[:1] == b";":
+            if code:
+                pack()
+            if packing:
+                out.append(_MEATPACK_DISABLE_PACKING)
+                packing = False
+            out.append(line + b"\n")
+            continue
+        line = _meatpack_line(line)
+        if not line:
+            continue
+        if not packing:
+            out.append(_MEATPACK_ENABLE_PACKING)
+            packing = True
+        code.append(line)
+    if code:
+        pack()
+    return b"".join(out)
+
+
+class BgcodeEncoder(object):
+    """
+    Writes Prusa's binary gcode (.bgcode): file header, the metadata blocks
+    firmware expects and the gcode itself in MeatPack encoded blocks, every
+    block protected by a CRC32. Metadata comes from the statistics and
+    configuration PrusaSlicer writes as comments at the end of the file.
+    """
+
+    name = "bgcode"
+
+    MAGIC = b"GCDE"
+    VERSION = 1
+    CHECKSUM_CRC32 = 1
+
+    BLOCK_FILE_METADATA = 0
+    BLOCK_GCODE = 1
+    BLOCK_SLICER_METADATA = 2
+    BLOCK_PRINTER_METADATA = 3
+    BLOCK_PRINT_METADATA = 4
+
+    # firmware only decompresses gcode blocks packed with heatshrink
+    COMPRESSION_NONE = 0
+
+    ENCODING_INI = 0
+    ENCODING_MEATPACK_COMMENTS = 2
+
+    # size limit of the gcode in a block before encoding, as PrusaSlicer does
+    BLOCK_SIZE = 65536
+
+    # statistics and configuration are looked for this far from the end
+    METADATA_TAIL = 1024 * 1024
+
+    # what PrusaSlicer puts in the printer and print metadata blocks
+    PRINTER_KEYS = (
+        "printer_model",
+        "filament_type",
+        "nozzle_diameter",
+        "bed_temperature",
+        "brim_width",
+        "fill_density",
+        "layer_height",
+        "temperature",
+        "ironing",
+        "support_material",
+        "max_layer_z",
+        "extruder_colour",
+        "filament used [mm]",
+        "filament used [g]",
+        "estimated printing time (normal mode)",
+    )
+    PRINT_KEYS = (
+        "filament used [mm]",
+        "filament used [cm3]",
+        "filament used [g]",
+        "filament cost",
+        "total filament used [g]",
+        "total filament cost",
+        "total filament used for wipe tower [g]",
+        "estimated printing time (normal mode)",
+        "estimated printing time (silent mode)",
+        "estimated first layer printing time (normal mode)",
+        "estimated first layer printing time (silent mode)",
+    )
+
+    def __init__(self, printer_model=""):
+        self.printer_model = printer_model
+        self._stats = {}
+        self._config = []
+        self._pending = []
+        self._pending_size = 0
+
+    def scan(self, fd):
+        # reads "; key = value" comments off the end of the source, without
+        # moving its offset; the slicer's configuration sits between
+        # "; prusaslicer_config = begin" and "end"
+        size = os.fstat(fd).st_size
+        offset = max(size - self.METADATA_TAIL, 0)
+        lines = os.pread(fd, size - offset, offset).split(b"\n")
+        if offset:
+            lines.pop(0)
+
+        self._stats = {}
+        self._config = []
+        in_config = False
+        for line in lines:
+            match = _METADATA_RE.match(line)
+            if not match:
+                continue
+            key, value = (group.decode("utf-8", "replace") for group in match.groups())
+            if key == "prusaslicer_config":
+                in_config = value == "begin"
+            elif in_config:
+                self._config.append((key, value))
+            else:
+                self._stats[key] = value
+
+    def _block(self, block_type, params, data):
+        header = struct.pack("<HHI", block_type, self.COMPRESSION_NONE, len(data))
+        crc = zlib.crc32(header)
+        crc = zlib.crc32(params, crc)
+        crc = zlib.crc32(data, crc)
+        return header + params + data + struct.pack("<I", crc)
+
+    def _metadata(self, block_type, values):
+        data = "".join("{}={}\n".format(k, v) for k, v in values).encode("utf-8")
+        return self._block(block_type, struct.pack("<H", self.ENCODING_INI), data)
+
+    def _lookup(self, keys):
+        config = dict(self._config)
+        if self.printer_model:
+            config["printer_model"] = self.printer_model
+        values = []
+        for key in keys:
+            value = self._stats.get(key, config.get(key))
+            if value is not None:
+                values.append((key, value))
+        return values
+
+    def header(self):
+        return b"".join(
+            [
+                struct.pack("<4sIH", self.MAGIC, self.VERSION, self.CHECKSUM_CRC32),
+                self._metadata(
+                    self.BLOCK_FILE_METADATA, [("Producer", "OctoPrint-Sdwire")]
+                ),
+                self._metadata(
+                    self.BLOCK_PRINTER_METADATA, self._lookup(self.PRINTER_KEYS)
+                ),
+                self._metadata(
+                    self.BLOCK_PRINT_METADATA, self._lookup(self.PRINT_KEYS)
+                ),
+                self._metadata(self.BLOCK_SLICER_METADATA, self._config),
+            ]
+        )
+
+    def _gcode_block(self):
+        data = meatpack(self._pending)
+        self._pending = []
+        self._pending_size = 0
+        return self._block(
+            self.BLOCK_GCODE, struct.pack("<H", self.ENCODING_MEATPACK_COMMENTS), data
+        )
+
+    def encode(self, lines):
+        blocks = []
+        for line in lines:
+            if self._pending and self._pending_size + len(line) + 1 > self.BLOCK_SIZE:
+                blocks.append(self._gcode_block())
+            self._pending.append(line)
+            self._pending_size += len(line) + 1
+        return b"".join(blocks)
+
+    def flush(self):
+        if not self._pending:
+            return b""
+        return self._gcode_block()
+
+    def signature(self):
+        return "{}(printer_model={},encoding=meatpack)".format(
+            self.name, self.printer_model
+        )
+
+
+class Pipeline(object):
+    """
+    Streams a file through line ``stages`` and an ``encoder`` chunk by
+    chunk, so memory use is bounded by the chunk size and not the file size.
+    """
+
+    def __init__(self, stages=(), encoder=None):
+        self.stages = list(stages)
+        self.encoder = encoder or TextEncoder()
+
+    @property
+    def extension(self):
+        return ".bgcode" if isinstance(self.encoder, BgcodeEncoder) else None
+
+    def signature(self):
+        return "+".join(
+            [stage.signature() for stage in self.stages] + [self.encoder.signature()]
+        )
+
+    def _process(self, lines):
+        for stage in self.stages:
+            if not lines:
+                break
+            lines = stage.process(lines)
+        return lines
+
+    def _flush(self):
+        lines = []
+        for stage in self.stages:
+            lines = stage.process(lines) + stage.flush()
+        return lines
+
+    def run(
+        self, fsrc, write, size, progress_cb=None, chunk_size=CHUNK_SIZE, hasher=None
+    ):
+        bytes_in = bytes_out = 0
+        tail = b""
+
+        def out(data):
+            nonlocal bytes_out
+            if data:
+                write(data)
+                bytes_out += len(data)
+
+        self.encoder.scan(fsrc)
+        out(self.encoder.header())
+        while True:
+            chunk = os.read(fsrc, chunk_size)
+            if not chunk:
+                break
+            if hasher is not None:
+                hasher.update(chunk)
+            bytes_in += len(chunk)
+
+            lines = (tail + chunk).split(b"\n")
+            tail = lines.pop()
+            out(self.encoder.encode(self._process(lines)))
+            if progress_cb:
+                progress_cb(bytes_in, size)
+
+        if tail:
+            out(self.encoder.encode(self._process([tail])))
+        out(self.encoder.encode(self._flush()))
+        out(self.encoder.flush())
+        return bytes_in, bytes_out
+
+
+def build_pipeline(
+    strip_comments=False,
+    strip_thumbnails=False,
+    precision=False,
+    precision_xyz=3,
+    precision_e=5,
+    bgcode=False,
+    printer_model="",
+):
+    # None when nothing is enabled, the file is copied as is then
+    stages = []
+    if strip_comments or strip_thumbnails:
+        stages.append(
+            StripComments(comments=strip_comments, thumbnails=strip_thumbnails)
+        )
+    if precision:
+        stages.append(TrimPrecision(xyz=precision_xyz, e=precision_e))
+    encoder = BgcodeEncoder(printer_model) if bgcode else None
+    if not stages and encoder is None:
+        return None
+    return Pipeline(stages, encoder)
+
+
+def _write_all(fd):
+    def write(data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+
+    return write
+
+
+def _hashing(write, hasher):
+    def hashing_write(data):
+        hasher.update(data)
+        write(data)
+
+    return hashing_write
+
+
+def _writing_back(write, writeback, progress_cb):
+    # Output offsets don't match the input, progress is scaled by the share
+    # of the output on the device.
+    written = [0]
+
+    def writing_back(data):
+        write(data)
+        written[0] += len(data)
+        writeback.update(written[0])
+
+    def on_progress(bytes_in, size):
+        if progress_cb:
+            progress_cb(bytes_in * writeback.durable // max(written[0], 1), size)
+
+    return writing_back, on_progress
+
+
+def copy_file(
+    src,
+    dst,
+    pipeline,
+    progress_cb=None,
+    bufsize=0,
+    hasher=None,
+    write_speed=None,
+    preallocate_dst=False,
+    out_hasher=None,
+    writeback_limit=0,
+):
+    """
+    Like ``copier.copy_file()``, but passes the data through ``pipeline``.
+    The result also has the input and output sizes and the copy time saved,
+    see ``transform_result()``. Preallocation reserves the input size, stages
+    only shrink the data and the rest is given back on close. ``hasher``
+    sees the input, ``out_hasher`` what is written. With ``writeback_limit``
+    progress counts the input whose output is on the device.
+    """
+    start = time.monotonic()
+    fsrc = os.open(src, os.O_RDONLY)
+    try:
+        size = os.fstat(fsrc).st_size
+        fdst = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if preallocate_dst:
+                copier.preallocate(fdst, size)
+            write = _write_all(fdst)
+            if out_hasher is not None:
+                write = _hashing(write, out_hasher)
+            report = progress_cb
+            writeback = None
+            if writeback_limit:
+                writeback = copier.WriteBack(fdst, writeback_limit)
+                write, progress_cb = _writing_back(write, writeback, progress_cb)
+            bytes_in, bytes_out = pipeline.run(
+                fsrc,
+                write,
+                size,
+                progress_cb=progress_cb,
+                chunk_size=bufsize or CHUNK_SIZE,
+                hasher=hasher,
+            )
+            if writeback is not None:
+                writeback.finish(bytes_out)
+                os.posix_fadvise(fsrc, 0, 0, os.POSIX_FADV_DONTNEED)
+                if report:
+                    report(bytes_in, size)
+            fragments = copier.count_extents(fdst)
+        finally:
+            os.close(fdst)
+    finally:
+        os.close(fsrc)
+
+    elapsed = time.monotonic() - start
+    return transform_result(bytes_in, bytes_out, elapsed, write_speed, fragments)
+
+
+def transform_result(bytes_in, bytes_out, elapsed, write_speed=None, fragments=None):
+    # With ``write_speed`` (bytes/s of plain copies to the card) the saving is
+    # what copying the original would have taken minus what this took, so a
+    # transform slower than the card shows up as negative. Unknown (None)
+    # until a plain copy was measured.
+    saved_time = None
+    if write_speed:
+        saved_time = bytes_in / write_speed - elapsed
+    return dict(
+        copied=bytes_in,
+        written=bytes_out,
+        elapsed=elapsed,
+        speed=bytes_in / elapsed / 1000000 if elapsed > 0 else 0.0,
+        method="transform",
+        saved_bytes=bytes_in - bytes_out,
+        saved_time=saved_time,
+        fragments=fragments,
+    )
@@ -0,0 +1,189 @@
+import collections
+import itertools
+import threading
+import time
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# re-uploads of the file selected for printing go first
+PRIORITY_SELECTED = 10
+
+
+class Cancelled(Exception):
+    pass
+
+
+class UploadJob(object):
+    """
+    One upload to a card. What the upload needs and finds out on the way
+    (paths, names, callbacks, hashes) is kept as items, ``job["size"]``;
+    state, progress and cancellation are attributes that any thread may read.
+    """
+
+    def __init__(self, device, priority=0, **data):
+        self.id = None
+        self.device = device
+        self.priority = priority
+        self.state = QUEUED
+        self.phase = None
+        self.progress = 0.0
+        self.error = None
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+        self._data = data
+        self._cancel = threading.Event()
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def check_cancelled(self):
+        # called by the copy between chunks
+        if self._cancel.is_set():
+            raise Cancelled("Upload of {} was cancelled".format(self.get("filename")))
+
+    def to_dict(self):
+        return dict(
+            id=self.id,
+            filename=self.get("filename"),
+            remote=self.get("short_filename") or self.get("remote_filename"),
+            card=self.device.uuid if self.device else None,
+            priority=self.priority,
+            state=self.state,
+            phase=self.phase,
+            progress=round(self.progress, 1),
+            error=self.error,
+            queued=self.queued,
+            started=self.started,
+            finished=self.finished,
+        )
+
+
+class JobQueue(object):
+    """
+    The plugin's upload jobs: queued ones in priority order (first come first
+    served within a priority), running ones and the last ``history``
+    finished ones. A job is taken by the session of its card.
+    """
+
+    def __init__(self, history=50):
+        self._cond = threading.Condition()
+        self._ids = itertools.count(1)
+        self._queued = []
+        self._running = []
+        self._finished = collections.deque(maxlen=history)
+
+    def _sort(self):
+        # stable, so equal priorities keep their order
+        self._queued.sort(key=lambda job: -job.priority)
+
+    def _find(self, job_id):
+        for job in itertools.chain(self._queued, self._running, self._finished):
+            if job.id == job_id:
+                return job
+        return None
+
+    def add(self, job):
+        with self._cond:
+            job.id = next(self._ids)
+            self._queued.append(job)
+            self._sort()
+            self._cond.notify_all()
+        return job
+
+    def settle(self, window):
+        # wait until no job was added for ``window`` seconds
+        with self._cond:
+            while window and self._cond.wait(timeout=window):
+                pass
+
+    def queued(self, uuid=None):
+        with self._cond:
+            return [
+                job
+                for job in self._queued
+                if uuid is None or (job.device and job.device.uuid == uuid)
+            ]
+
+    def get(self, job_id):
+        with self._cond:
+            return self._find(job_id)
+
+    def take(self, uuid):
+        # next queued job for card ``uuid``, now running
+        with self._cond:
+            for i, job in enumerate(self._queued):
+                if job.device.uuid == uuid:
+                    del self._queued[i]
+                    job.state = RUNNING
+                    job.started = time.time()
+                    self._running.append(job)
+                    return job
+        return None
+
+    def finish(self, job, state, error=None):
+        with self._cond:
+            if job.state in (DONE, FAILED, CANCELLED):
+                return
+            if job in self._running:
+                self._running.remove(job)
+            elif job in self._queued:
+                self._queued.remove(job)
+            job.state = state
+            job.error = error
+            job.finished = time.time()
+            self._finished.append(job)
+
+    def cancel(self, job_id):
+        """
+        Cancel a queued or running job. A queued one is out of the queue when
+        this returns, the caller reports it as failed. A running one stops
+        at its next progress update. Returns the job, None if there's no
+        such job or it's finished already.
+        """
+        with self._cond:
+            job = self._find(job_id)
+            if job is None or job.state not in (QUEUED, RUNNING):
+                return None
+            job.cancel()
+            if job.state == QUEUED:
+                self._queued.remove(job)
+                job.state = CANCELLED
+                job.finished = time.time()
+                self._finished.append(job)
+            return job
+
+    def prioritize(self, job_id, priority):
+        # None unless the job is still queued
+        with self._cond:
+            job = self._find(job_id)
+            if job is None or job.state != QUEUED:
+                return None
+            job.priority = priority
+            self._sort()
+            return job
+
+    def status(self):
+        with self._cond:
+            return dict(
+                queued=[job.to_dict() for job in self._queued],
+                running=[job.to_dict() for job in self._running],
+                finished=[job.to_dict() for job in reversed(self._finished)],
+            )
@@ -0,0 +1,19 @@
+import json
+import os
+
+
+def load(path, default):
+    # contents of JSON file ``path``, ``default`` if missing or unreadable
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save(path, data):
+    # replaced atomically, a crash leaves the old or the new contents
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
@@ -0,0 +1,231 @@
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from . import jsonfile
+
+# kept in the root of the card, next to the files it describes
+MANIFEST_NAME = "sdwire-manifest.json"
+
+HASH_ALGORITHM = "sha256"
+
+
+def new_hasher():
+    return hashlib.new(HASH_ALGORITHM)
+
+
+def file_hash(path, bufsize=1024 * 1024):
+    hasher = new_hasher()
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hasher.update(view[:n])
+    return hasher.hexdigest()
+
+
+class HashCache(object):
+    """
+    Hashes of local files, keyed by path and trusted as long as size, mtime
+    and inode are unchanged, so a file is hashed at most once.
+    """
+
+    def __init__(self, path, max_entries=500):
+        self._path = path
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = jsonfile.load(path, {})
+
+    @staticmethod
+    def _key(st):
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def get(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry and entry["key"] == self._key(st):
+            return entry["hash"]
+        return None
+
+    def put(self, path, digest):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        with self._lock:
+            self._entries[path] = dict(key=self._key(st), hash=digest, used=time.time())
+            if len(self._entries) > self._max_entries:
+                oldest = sorted(self._entries.items(), key=lambda x: x[1]["used"])
+                for key, _entry in oldest[: len(self._entries) - self._max_entries]:
+                    del self._entries[key]
+            jsonfile.save(self._path, self._entries)
+
+    def hash(self, path):
+        digest = self.get(path)
+        if digest is None:
+            digest = file_hash(path)
+            self.put(path, digest)
+        return digest
+
+
+class UploadJournal(object):
+    """
+    Progress of copies to the cards: card uuid and remote name -> source
+    size and the offset known to be flushed to the card. An entry lives from
+    the first checkpoint until the copy finishes, whatever is left says
+    where an interrupted copy can pick up.
+    """
+
+    def __init__(self, path, max_entries=50):
+        self._path = path
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = jsonfile.load(path, {})
+
+    @staticmethod
+    def _key(uuid, remote):
+        return "{}/{}".format(uuid, remote.lower())
+
+    def get(self, uuid, remote):
+        with self._lock:
+            entry = self._entries.get(self._key(uuid, remote))
+            return dict(entry) if entry else None
+
+    def update(self, uuid, remote, size, offset):
+        with self._lock:
+            self._entries[self._key(uuid, remote)] = dict(
+                size=size, offset=offset, updated=time.time()
+            )
+            if len(self._entries) > self._max_entries:
+                oldest = sorted(self._entries.items(), key=lambda x: x[1]["updated"])
+                for key, _entry in oldest[: len(self._entries) - self._max_entries]:
+                    del self._entries[key]
+            jsonfile.save(self._path, self._entries)
+
+    def remove(self, uuid, remote):
+        with self._lock:
+            if self._entries.pop(self._key(uuid, remote), None) is not None:
+                jsonfile.save(self._path, self._entries)
+
+
+class Manifest(object):
+    """
+    What the plugin put on one card: file name -> size, mtime, hash, short
+    name, upload and last print time. A copy lives on the card itself, the host keeps a
+    cache of it so unchanged uploads can be detected without the card.
+    """
+
+    def __init__(self, path=None):
+        self._path = path
+        self._lock = threading.Lock()
+        self._files = {}
+        if path:
+            self._files = jsonfile.load(path, {}).get("files", {})
+
+    def get(self, name):
+        with self._lock:
+            entry = self._files.get(name)
+            return dict(entry) if entry else None
+
+    def set(self, name, **entry):
+        with self._lock:
+            self._files[name] = entry
+
+    def remove(self, name):
+        with self._lock:
+            self._files.pop(name, None)
+
+    def names(self):
+        with self._lock:
+            return list(self._files.keys())
+
+    def mark_printed(self, remote, when=None):
+        # ``remote`` is the name the printer knows the file by, long or short
+        remote = remote.lower()
+        with self._lock:
+            for name, entry in self._files.items():
+                names = (entry.get("remote", name), entry.get("short") or "")
+                if remote in (n.lower() for n in names):
+                    entry["printed"] = time.time() if when is None else when
+                    return True
+        return False
+
+    def eviction_order(self, policy="uploaded", protected=(), keep=()):
+        # entries that may be deleted to make room, least recently used
+        # first; ``protected`` are fnmatch patterns never to delete, ``keep``
+        # names of files in use right now
+        keep = set(name.lower() for name in keep)
+        protected = [pattern.lower() for pattern in protected]
+        with self._lock:
+            items = [(name, dict(entry)) for name, entry in self._files.items()]
+
+        candidates = []
+        for name, entry in items:
+            remote = [
+                n.lower() for n in (entry.get("remote", name), entry.get("short")) if n
+            ]
+            if keep.intersection(remote):
+                continue
+            names = remote + [name.lower()]
+            if any(fnmatch.fnmatch(n, p) for n in names for p in protected):
+                continue
+            candidates.append((name, entry))
+
+        def last_used(item):
+            entry = item[1]
+            if policy == "printed":
+                # a fresh upload counts as used even if not printed yet
+                return max(entry.get("printed") or 0, entry.get("uploaded") or 0)
+            return entry.get("uploaded") or 0
+
+        candidates.sort(key=last_used)
+        return candidates
+
+    def prune(self, existing):
+        # drop entries of files no longer on the card or changed in size,
+        # ``existing`` maps names found on the card to their sizes
+        existing = dict((name.lower(), size) for name, size in existing.items())
+        with self._lock:
+            for name, entry in list(self._files.items()):
+                card_size = entry.get("card_size", entry["size"])
+                if existing.get(entry.get("remote", name).lower()) != card_size:
+                    del self._files[name]
+
+    def dumps(self):
+        with self._lock:
+            return json.dumps(dict(version=1, files=self._files), indent=1)
+
+    def loads(self, data):
+        try:
+            files = json.loads(data).get("files", {})
+        except (ValueError, AttributeError):
+            logging.getLogger(__name__).warning("Ignoring unreadable card manifest")
+            files = {}
+        with self._lock:
+            # prints are recorded on the host while the card is away, keep them
+            for name, entry in files.items():
+                known = self._files.get(name)
+                if (
+                    known
+                    and isinstance(entry, dict)
+                    and known.get("hash") == entry.get("hash")
+                    and (known.get("printed") or 0) > (entry.get("printed") or 0)
+                ):
+                    entry["printed"] = known["printed"]
+            self._files = files
+
+    def save(self):
+        if self._path:
+            with self._lock:
+                jsonfile.save(self._path, dict(version=1, files=self._files))
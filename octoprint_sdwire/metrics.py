@@ -0,0 +1,264 @@
+import collections
+import math
+import threading
+import time
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class PhaseResult(object):
+    # handed out by Timing.phase(), set ``ok`` to False to count a failure
+    def __init__(self):
+        self.ok = True
+
+
+class Timing(object):
+    """
+    Phase durations of one operation (an upload batch, a switch, ...).
+    Phases run more than once, e.g. the copy of every file in a batch, are
+    summed up.
+    """
+
+    def __init__(self, kind, clock=time.monotonic):
+        self.kind = kind
+        self.time = time.time()
+        self.phases = collections.OrderedDict()
+        self.failed = []
+        self.bytes = 0
+        self.files = 0
+        self.ok = True
+        self._clock = clock
+        self._start = clock()
+
+    def add(self, phase, duration, ok=True):
+        self.phases[phase] = self.phases.get(phase, 0.0) + duration
+        if not ok and phase not in self.failed:
+            self.failed.append(phase)
+
+    def phase(self, phase):
+        return _PhaseContext(self, phase)
+
+    def elapsed(self):
+        return self._clock() - self._start
+
+    def to_dict(self):
+        return dict(
+            kind=self.kind,
+            time=self.time,
+            ok=self.ok,
+            phases=dict(self.phases),
+            failed=list(self.failed),
+            bytes=self.bytes,
+            files=self.files,
+        )
+
+
+class _PhaseContext(object):
+    def __init__(self, timing, phase):
+        self._timing = timing
+        self._phase = phase
+        self._result = PhaseResult()
+
+    def __enter__(self):
+        self._start = self._timing._clock()
+        return self._result
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self._result.ok = False
+        self._timing.add(
+            self._phase, self._timing._clock() - self._start, self._result.ok
+        )
+        return False
+
+
+def _quantile(values, q):
+    # nearest rank on sorted values
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, int(math.ceil(q * len(values))) - 1))
+    return values[rank]
+
+
+def _distribution(values):
+    values = sorted(values)
+    result = dict(("p{}".format(int(q * 100)), _quantile(values, q)) for q in QUANTILES)
+    result["max"] = values[-1] if values else None
+    return result
+
+
+class Metrics(object):
+    """
+    Ring buffers of the last ``history`` timings of each kind plus counters
+    that are never reset (totals for Prometheus). Percentiles are computed
+    over the ring buffers.
+    """
+
+    def __init__(self, history=200):
+        self._lock = threading.Lock()
+        self._history = history
+        self._records = collections.OrderedDict()
+        # (kind, phase) -> [count, seconds, failures]
+        self._totals = collections.OrderedDict()
+        # kind -> [count, failures, bytes, files]
+        self._kinds = collections.OrderedDict()
+
+    def start(self, kind):
+        return Timing(kind)
+
+    def record(self, timing, ok=None):
+        if ok is not None:
+            timing.ok = ok
+        timing.add("total", timing.elapsed(), timing.ok)
+        self._store(timing)
+
+    def record_phase(self, kind, phase, duration, ok=True):
+        # single phase operation, e.g. one switch, no separate total
+        timing = Timing(kind)
+        timing.add(phase, duration, ok)
+        timing.ok = ok
+        self._store(timing)
+
+    def _store(self, timing):
+        with self._lock:
+            records = self._records.get(timing.kind)
+            if records is None:
+                records = self._records[timing.kind] = collections.deque(
+                    maxlen=self._history
+                )
+            records.append(timing.to_dict())
+            for phase, duration in timing.phases.items():
+                totals = self._totals.setdefault((timing.kind, phase), [0, 0.0, 0])
+                totals[0] += 1
+                totals[1] += duration
+                if phase in timing.failed:
+                    totals[2] += 1
+            kind = self._kinds.setdefault(timing.kind, [0, 0, 0, 0])
+            kind[0] += 1
+            kind[1] += 0 if timing.ok else 1
+            kind[2] += timing.bytes
+            kind[3] += timing.files
+
+    def recent(self, limit=None):
+        with self._lock:
+            records = [r for kind in self._records.values() for r in kind]
+        records.sort(key=lambda r: r["time"])
+        return records[-limit:] if limit else records
+
+    def summary(self):
+        records = self.recent()
+        with self._lock:
+            totals = [(key, list(value)) for key, value in self._totals.items()]
+            kinds = [(key, list(value)) for key, value in self._kinds.items()]
+
+        result = collections.OrderedDict()
+        for kind, (count, failures, nbytes, files) in kinds:
+            result[kind] = dict(
+                count=count, failures=failures, bytes=nbytes, files=files, phases={}
+            )
+        for (kind, phase), (count, seconds, failures) in totals:
+            values = [
+                r["phases"][phase]
+                for r in records
+                if r["kind"] == kind and phase in r["phases"]
+            ]
+            stats = dict(count=count, seconds=seconds, failures=failures)
+            stats.update(_distribution(values))
+            result[kind]["phases"][phase] = stats
+
+        # MB/s of the copy alone and of the whole upload
+        uploads = [r for r in records if r["kind"] == "upload" and r["bytes"]]
+        if "upload" in result:
+            result["upload"]["throughput"] = dict(
+                copy=_distribution(
+                    [
+                        r["bytes"] / r["phases"]["copy"] / 1000000
+                        for r in uploads
+                        if r["phases"].get("copy")
+                    ]
+                ),
+                total=_distribution(
+                    [
+                        r["bytes"] / r["phases"]["total"] / 1000000
+                        for r in uploads
+                        if r["phases"].get("total")
+                    ]
+                ),
+            )
+        return result
+
+    def prometheus(self):
+        summary = self.summary()
+        lines = [
+            "# HELP sdwire_phase_seconds Duration of sdwire operation phases.",
+            "# TYPE sdwire_phase_seconds summary",
+        ]
+        failures = []
+        for kind, data in summary.items():
+            for phase, stats in data["phases"].items():
+                labels = 'kind="{}",phase="{}"'.format(kind, phase)
+                for q in QUANTILES:
+                    value = stats["p{}".format(int(q * 100))]
+                    if value is not None:
+                        lines.append(
+                            'sdwire_phase_seconds{{{},quantile="{}"}} {:.6f}'.format(
+                                labels, q, value
+                            )
+                        )
+                lines.append(
+                    "sdwire_phase_seconds_sum{{{}}} {:.6f}".format(
+                        labels, stats["seconds"]
+                    )
+                )
+                lines.append(
+                    "sdwire_phase_seconds_count{{{}}} {}".format(labels, stats["count"])
+                )
+                failures.append(
+                    "sdwire_phase_failures_total{{{}}} {}".format(
+                        labels, stats["failures"]
+                    )
+                )
+
+        lines.append("# HELP sdwire_phase_failures_total Failed phases.")
+        lines.append("# TYPE sdwire_phase_failures_total counter")
+        lines.extend(failures)
+
+        lines.append("# HELP sdwire_operations_total Operations by kind.")
+        lines.append("# TYPE sdwire_operations_total counter")
+        for kind, data in summary.items():
+            lines.append(
+                'sdwire_operations_total{{kind="{}"}} {}'.format(kind, data["count"])
+            )
+        lines.append(
+            "# HELP sdwire_operation_failures_total Failed operations by kind."
+        )
+        lines.append("# TYPE sdwire_operation_failures_total counter")
+        for kind, data in summary.items():
+            lines.append(
+                'sdwire_operation_failures_total{{kind="{}"}} {}'.format(
+                    kind, data["failures"]
+                )
+            )
+
+        upload = summary.get("upload")
+        if upload:
+            lines.append("# HELP sdwire_upload_bytes_total Bytes uploaded to the card.")
+            lines.append("# TYPE sdwire_upload_bytes_total counter")
+            lines.append("sdwire_upload_bytes_total {}".format(upload["bytes"]))
+            lines.append("# HELP sdwire_upload_files_total Files uploaded to the card.")
+            lines.append("# TYPE sdwire_upload_files_total counter")
+            lines.append("sdwire_upload_files_total {}".format(upload["files"]))
+            lines.append(
+                "# HELP sdwire_upload_throughput_mbps Upload throughput in MB/s, "
+                "of the copy and of the whole upload."
+            )
+            lines.append("# TYPE sdwire_upload_throughput_mbps gauge")
+            for scope, stats in upload["throughput"].items():
+                for q in QUANTILES:
+                    value = stats["p{}".format(int(q * 100))]
+                    if value is not None:
+                        lines.append(
+                            'sdwire_upload_throughput_mbps{{scope="{}",quantile="{}"}} '
+                            "{:.3f}".format(scope, q, value)
+                        )
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,181 @@
+import logging
+import re
+import subprocess
+import threading
+import time
+
+MODES = ("sd", "usb")
+
+# sd-mux-ctrl names: DUT (device under test, the printer) and TS (test server, us)
+_STATUS_RE = re.compile(r"\b(TS|DUT)\b")
+
+
+class MuxBackend(object):
+    # select(mode) switches the card, status() returns the mode the hardware
+    # reports or None when the backend can't tell
+
+    def select(self, mode):
+        raise NotImplementedError()
+
+    def status(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class SdMuxCtrlBackend(MuxBackend):
+    def __init__(self, sd_mux_ctrl, serial, logger=None, sudo="/usr/bin/sudo"):
+        self._sd_mux_ctrl = sd_mux_ctrl
+        self._serial = serial
+        self._sudo = sudo
+        self._logger = logger or logging.getLogger(__name__)
+
+    def _run(self, action):
+        cmd = [
+            self._sd_mux_ctrl,
+            "--device-serial={}".format(self._serial),
+            action,
+        ]
+        if self._sudo:
+            cmd.insert(0, self._sudo)
+        try:
+            output = subprocess.check_output(cmd, stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError) as e:
+            self._logger.debug("running command ({}) failed: {}".format(cmd, e))
+            return None
+        self._logger.debug("running command ({}) succeeded: {}".format(cmd, output))
+        return output.decode(errors="replace")
+
+    def select(self, mode):
+        return self._run("--dut" if mode == "sd" else "--ts") is not None
+
+    def status(self):
+        output = self._run("--status")
+        if output is None:
+            return None
+        match = _STATUS_RE.search(output)
+        if not match:
+            return None
+        return "sd" if match.group(1) == "DUT" else "usb"
+
+
+class FtdiBackend(MuxBackend):
+    # Keeps the sdwire's FT200X open through pyftdi and drives its CBUS pins
+    # directly, no process per switch and no sudo (needs an udev rule giving
+    # access to the usb device instead).
+
+    VENDOR = 0x0403
+    PRODUCT = 0x6015
+    PINS = dict(sd=0xF0, usb=0xF1)
+
+    def __init__(self, serial, logger=None):
+        from pyftdi.ftdi import Ftdi
+
+        self._logger = logger or logging.getLogger(__name__)
+        self._ftdi = Ftdi()
+        self._ftdi.open(self.VENDOR, self.PRODUCT, serial=serial)
+        self._mode = None
+
+    def select(self, mode):
+        from pyftdi.ftdi import Ftdi
+
+        try:
+            self._ftdi.set_bitmode(self.PINS[mode], Ftdi.BitMode.CBUS)
+        except Exception as e:
+            self._logger.debug("Setting sdwire pins failed: {}".format(e))
+            self._mode = None
+            return False
+        self._mode = mode
+        return True
+
+    def status(self):
+        return self._mode
+
+    def close(self):
+        self._ftdi.close()
+
+
+class FakeBackend(MuxBackend):
+    # in-memory stand-in for tests and benchmarks
+    def __init__(self, mode=None, delay=0.0, fail=False):
+        self.mode = mode
+        self.delay = delay
+        self.fail = fail
+        self.calls = []
+
+    def select(self, mode):
+        self.calls.append(mode)
+        if self.delay:
+            time.sleep(self.delay)
+        if self.fail:
+            return False
+        self.mode = mode
+        return True
+
+    def status(self):
+        return self.mode
+
+
+class MuxController(object):
+    """
+    Long-lived owner of one sdwire. Tracks which side the card is on and
+    skips switches that are already in effect; after a switch the state is
+    read back from the hardware where the backend supports it. A forced
+    switch pauses ``settle`` seconds afterwards, printers toggled off and on
+    again quickly may miss that the card was gone.
+    """
+
+    def __init__(self, backend, logger=None, retries=3, settle=0.0):
+        self._backend = backend
+        self._logger = logger or logging.getLogger(__name__)
+        self._retries = retries
+        self._settle = settle
+        self._lock = threading.RLock()
+        self._mode = None
+
+    @property
+    def mode(self):
+        return self._mode
+
+    def invalidate(self):
+        with self._lock:
+            self._mode = None
+
+    def refresh(self):
+        with self._lock:
+            self._mode = self._backend.status()
+            return self._mode
+
+    def switch(self, mode, force=False):
+        if mode not in MODES:
+            raise ValueError("unknown mode: {}".format(mode))
+
+        with self._lock:
+            if self._mode is None and not force:
+                self.refresh()
+            if self._mode == mode and not force:
+                self._logger.debug("Sdwire already in {} mode.".format(mode.upper()))
+                return True
+
+            self._mode = None
+            for attempt in range(self._retries):
+                if not self._backend.select(mode):
+                    continue
+                status = self._backend.status()
+                if status is None or status == mode:
+                    self._mode = mode
+                    if force and self._settle:
+                        time.sleep(self._settle)
+                    return True
+                self._logger.info(
+                    "Sdwire reports {} after switching to {} (attempt {}).".format(
+                        status, mode, attempt + 1
+                    )
+                )
+            return False
+
+    def close(self):
+        with self._lock:
+            self._backend.close()
+            self._mode = None
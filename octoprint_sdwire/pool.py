@@ -0,0 +1,189 @@
+import contextlib
+import errno
+import fcntl
+import itertools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+class Device(object):
+    # one sdwire: its serial, the uuid of the card in it and the printer
+    # (serial port or printer profile id) the card sits in
+    def __init__(self, serial, uuid, printer=None):
+        self.serial = serial
+        self.uuid = uuid
+        self.printer = printer
+
+    def __repr__(self):
+        return "Device({}, {}, printer={})".format(self.serial, self.uuid, self.printer)
+
+
+def parse_devices(text):
+    # one device per line: serial, uuid and optionally the printer, blank
+    # lines and # comments are skipped
+    devices = []
+    for line in (text or "").splitlines():
+        fields = line.split("#", 1)[0].split()
+        if len(fields) >= 2:
+            devices.append(Device(fields[0], fields[1], " ".join(fields[2:]) or None))
+    return devices
+
+
+def configured_devices(devices, serial, uuid):
+    # the pool from settings; the single serial/uuid pair of older
+    # configurations when it's empty
+    result = parse_devices(devices)
+    if not result and (serial or uuid):
+        result.append(Device(serial, uuid))
+    return result
+
+
+def select_device(devices, port=None, profile=None):
+    """
+    The device whose ``printer`` matches the connected printer's serial
+    port or profile id. A device without ``printer`` matches any printer,
+    a single device is used whatever it says.
+    """
+    if len(devices) == 1:
+        return devices[0]
+    fallback = None
+    for device in devices:
+        if device.printer is None:
+            fallback = fallback or device
+        elif device.printer in (port, profile):
+            return device
+    return fallback
+
+
+def default_lock_dir():
+    base = "/run/lock" if os.path.isdir("/run/lock") else tempfile.gettempdir()
+    return os.path.join(base, "octoprint-sdwire")
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class HostScheduler(object):
+    """
+    Coordinates uploads of all OctoPrint instances on the host (one per
+    printer) through lock files in ``lock_dir``. A card has one session at a
+    time, so uploads to the same card are serial and different cards run in
+    parallel. Copies share the host's I/O: at most ``slots`` files are
+    copied at once and slots are handed out first come first served, one
+    file at a time, so cards with long batches take turns with the others.
+    ``slots`` of 0 means no limit.
+
+    Without a usable ``lock_dir`` nothing is coordinated.
+    """
+
+    def __init__(self, lock_dir, slots=2, poll=0.1, logger=None):
+        self._lock_dir = lock_dir
+        self._slots = slots
+        self._poll = poll
+        self._logger = logger or logging.getLogger(__name__)
+        self._tickets = itertools.count()
+        self._disabled = False
+
+    def _open(self, name):
+        if self._disabled:
+            return None
+        try:
+            if not os.path.isdir(self._lock_dir):
+                os.makedirs(self._lock_dir, exist_ok=True)
+                # instances may run as different users
+                os.chmod(self._lock_dir, 0o1777)
+            fd = os.open(
+                os.path.join(self._lock_dir, name), os.O_RDWR | os.O_CREAT, 0o666
+            )
+        except OSError as e:
+            self._logger.warning(
+                "Can't use {} for upload locks, uploads of other instances "
+                "are not coordinated: {}".format(self._lock_dir, e)
+            )
+            self._disabled = True
+            return None
+        try:
+            os.fchmod(fd, 0o666)
+        except OSError:
+            pass
+        return fd
+
+    @contextlib.contextmanager
+    def card(self, uuid):
+        # yields the seconds spent waiting for another session to finish
+        fd = self._open("card-{}.lock".format(uuid))
+        start = time.monotonic()
+        try:
+            if fd is not None:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    self._logger.info(
+                        "Card {} is busy with another upload, waiting".format(uuid)
+                    )
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+            yield time.monotonic() - start
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def _update_queue(self, change=None):
+        fd = self._open("copy-slots.json")
+        if fd is None:
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = b""
+            while True:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    break
+                data += chunk
+            try:
+                queue = json.loads(data.decode("utf-8") or "[]")
+            except ValueError:
+                queue = []
+            # tickets of processes that died holding or waiting for a slot
+            queue = [t for t in queue if _alive(int(t.split(":")[0]))]
+            if change is not None:
+                change(queue)
+            # rewritten in place, the file may belong to another user
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, json.dumps(queue).encode("utf-8"))
+            return queue
+        finally:
+            os.close(fd)
+
+    @contextlib.contextmanager
+    def copy_slot(self):
+        # yields the seconds spent waiting for a slot
+        start = time.monotonic()
+        if self._slots <= 0:
+            yield 0.0
+            return
+
+        ticket = "{}:{}:{}".format(
+            os.getpid(), threading.get_ident(), next(self._tickets)
+        )
+        queue = self._update_queue(lambda queue: queue.append(ticket))
+        try:
+            while queue is not None and ticket not in queue[: self._slots]:
+                time.sleep(self._poll)
+                queue = self._update_queue()
+            yield time.monotonic() - start
+        finally:
+            self._update_queue(lambda queue: ticket in queue and queue.remove(ticket))
@@ -0,0 +1,91 @@
+import time
+
+
+class ProgressReporter(object):
+    """
+    Turns per-chunk copy callbacks into plugin messages. A message is sent
+    only when at least ``min_interval`` seconds passed *and* the percentage
+    moved by ``min_step`` since the last one; phase changes and completion
+    are always sent.
+    """
+
+    def __init__(self, send, min_interval=0.5, min_step=1.0, clock=time.monotonic):
+        self._send = send
+        self._min_interval = min_interval
+        self._min_step = min_step
+        self._clock = clock
+
+        self.phase = None
+        self.filename = None
+        self.total = 0
+        self.copied = 0
+        self._started = None
+        self._last_time = None
+        self._last_copied = 0
+        self._last_percent = None
+        self._start_copied = 0
+
+    def set_phase(self, phase, filename=None, total=None, copied=0):
+        # ``copied`` is where a resumed copy starts, speeds count from there
+        self.phase = phase
+        if filename is not None:
+            self.filename = filename
+        if total is not None:
+            self.total = total
+            self.copied = copied
+            self._started = self._last_time = self._clock()
+            self._last_copied = copied
+            self._start_copied = copied
+            self._last_percent = None
+        self._emit(self._clock(), 0.0)
+
+    def update(self, copied, total=None):
+        if total is not None:
+            self.total = total
+        self.copied = copied
+
+        now = self._clock()
+        percent = self.percent
+        done = self.total and copied >= self.total
+        if not done and self._last_percent is not None:
+            if now - self._last_time < self._min_interval:
+                return
+            if percent - self._last_percent < self._min_step:
+                return
+
+        elapsed = now - self._last_time
+        speed = (copied - self._last_copied) / elapsed if elapsed > 0 else 0.0
+        self._emit(now, speed)
+
+    @property
+    def percent(self):
+        if not self.total:
+            return 0.0
+        return min(100.0, 100.0 * self.copied / self.total)
+
+    def _emit(self, now, speed):
+        avg_speed = 0.0
+        eta = None
+        if self._started is not None:
+            elapsed = now - self._started
+            if elapsed > 0:
+                avg_speed = (self.copied - self._start_copied) / elapsed
+            if avg_speed > 0:
+                eta = (self.total - self.copied) / avg_speed
+
+        self._last_time = now
+        self._last_copied = self.copied
+        self._last_percent = self.percent
+
+        self._send(
+            dict(
+                progress=int(self.percent),
+                phase=self.phase,
+                filename=self.filename,
+                copied=self.copied,
+                total=self.total,
+                speed=round(speed / 1000000, 2),
+                avg_speed=round(avg_speed / 1000000, 2),
+                eta=round(eta) if eta is not None else None,
+            )
+        )
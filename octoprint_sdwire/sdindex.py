@@ -0,0 +1,102 @@
+import threading
+
+# printers list long names cut to their own limit (56 characters on a Prusa
+# MK3), names longer than this are also matched by prefix
+TRUNCATED_LENGTH = 20
+
+
+class SdIndex(object):
+    """
+    The printer's sd card listing indexed by display name, built from
+    OctoPrint's cached listing (no M20) and kept up to date with the files
+    the plugin writes itself. Long names the printer shows cut off are
+    indexed by that prefix too. ``invalidate()`` it when the card changed.
+
+    Written files are kept on top of the listing until a listing shows them,
+    the printer lists the card only after it got it back.
+    """
+
+    def __init__(self, truncated_length=TRUNCATED_LENGTH):
+        self._truncated_length = truncated_length
+        self._lock = threading.Lock()
+        self._loaded = False
+        # display name (lower case) -> (name, date)
+        self._names = {}
+        # short names (lower case) on the card
+        self._short = set()
+        # files written since, same keys and values as _names
+        self._written = {}
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded = False
+            self._names = {}
+            self._short = set()
+            self._written = {}
+
+    def load(self, files):
+        # files as returned by printer.get_sd_files(), replaces the index
+        names = {}
+        short = set()
+        for item in files:
+            if not item.get("name"):
+                continue
+            short.add(item["name"].lower())
+            if item.get("display"):
+                names[item["display"].lower()] = (item["name"], item.get("date"))
+        with self._lock:
+            self._names = names
+            self._short = short
+            self._loaded = True
+            for display, (name, date) in list(self._written.items()):
+                if name.lower() in short:
+                    del self._written[display]
+
+    def add(self, display, name, date=None):
+        # a file the plugin wrote, under its full long name
+        with self._lock:
+            self._written[display.lower()] = (name, date)
+
+    def remove(self, name):
+        # by short or display name
+        name = name.lower()
+        with self._lock:
+            for names in (self._names, self._written):
+                entry = names.pop(name, None)
+                if entry:
+                    self._short.discard(entry[0].lower())
+                for display, (short, _date) in list(names.items()):
+                    if short.lower() == name:
+                        del names[display]
+            self._short.discard(name)
+
+    def __contains__(self, name):
+        name = name.lower()
+        with self._lock:
+            return name in self._short or any(
+                short.lower() == name for short, _date in self._written.values()
+            )
+
+    def lookup(self, filename, timestamp=None):
+        """
+        Short name of ``filename``, exact match first. Otherwise the longest
+        listed prefix of it (longer than ``truncated_length``) whose date is
+        not before ``timestamp``. None when not in the index.
+        """
+        key = filename.lower()
+        with self._lock:
+            entry = self._written.get(key) or self._names.get(key)
+            if entry:
+                return entry[0]
+            for length in range(len(key) - 1, self._truncated_length, -1):
+                entry = self._names.get(key[:length])
+                if entry is None:
+                    continue
+                name, date = entry
+                if timestamp is None or (date and int(date) >= timestamp):
+                    return name
+        return None
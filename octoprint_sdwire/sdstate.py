@@ -0,0 +1,84 @@
+import collections
+import threading
+import time
+
+# same lines OctoPrint's comm layer reacts to
+SD_READY_LINES = ("SD card ok", "Card successfully initialized")
+SD_RELEASED_LINES = (
+    "SD init fail",
+    "volume.init failed",
+    "No media",
+    "openRoot failed",
+    "SD Card unmounted",
+    "SD card released",
+)
+
+# re-check the printer state this often when no line arrives, for firmwares
+# that don't report state changes at all
+RECHECK_INTERVAL = 0.5
+
+
+def parse_line(line):
+    # True/False for lines reporting sd card state, None for everything else
+    for s in SD_READY_LINES:
+        if s in line:
+            return True
+    for s in SD_RELEASED_LINES:
+        if s in line:
+            return False
+    return None
+
+
+class SdStateWaiter(object):
+    """
+    Waits for the printer's sd card to become ready or released. Woken up by
+    serial responses (see ``parse_line``) and events, the printer state is
+    only re-checked as a safety net. Every wait is recorded in ``waits``.
+    """
+
+    def __init__(self, history=100):
+        self._cond = threading.Condition()
+        self._state = None
+        self.waits = collections.deque(maxlen=history)
+
+    def reset(self):
+        # forget what was reported so far, call before sending M21/M22
+        with self._cond:
+            self._state = None
+
+    def set_state(self, ready):
+        with self._cond:
+            self._state = ready
+            self._cond.notify_all()
+
+    def notify(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def wait(self, ready, timeout, check=None):
+        start = time.monotonic()
+        deadline = start + timeout
+        source = None
+
+        with self._cond:
+            while True:
+                if self._state == ready:
+                    source = "line"
+                    break
+                if check is not None and check() == ready:
+                    source = "check"
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(min(remaining, RECHECK_INTERVAL))
+
+        result = dict(
+            state="ready" if ready else "released",
+            duration=time.monotonic() - start,
+            timeout=timeout,
+            ok=source is not None,
+            source=source,
+        )
+        self.waits.append(result)
+        return result
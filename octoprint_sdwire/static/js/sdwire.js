@@ -11,6 +11,53 @@ $(function () {
         // assign the injected parameters, e.g.:
         self.filesViewModel = parameters[0];
 
+        self.formatEta = function (seconds) {
+            var minutes = Math.floor(seconds / 60);
+            var rest = seconds % 60;
+            return minutes + ":" + (rest < 10 ? "0" : "") + rest;
+        };
+
+        self.progressText = function (data) {
+            switch (data["phase"]) {
+                case "mounting":
+                    return "Sdwire: switching card to USB...";
+                case "unmounting":
+                    return "Sdwire: flushing and switching card back to printer...";
+                case "resolving":
+                    return "Sdwire: looking up file names on printer...";
+                case "done":
+                    return "Sdwire: done";
+            }
+
+            if (data["phase"] == "verifying") {
+                return (
+                    "Sdwire: verifying " +
+                    data["filename"] +
+                    " on the card - " +
+                    data["progress"] +
+                    "%..."
+                );
+            }
+
+            var text = data["phase"] == "transforming" ? "Converting " : "Uploading ";
+            if (data["filename"]) {
+                text += data["filename"] + " ";
+            }
+            text += (data["phase"] == "transforming" ? "for" : "to") + " sdwire - ";
+            text += data["progress"] + "%";
+            if (data["speed"]) {
+                text += " (" + data["speed"] + " MB/s";
+                if (data["avg_speed"]) {
+                    text += ", avg " + data["avg_speed"] + " MB/s";
+                }
+                if (data["eta"] !== null && data["eta"] !== undefined) {
+                    text += ", " + self.formatEta(data["eta"]) + " left";
+                }
+                text += ")";
+            }
+            return text + "...";
+        };
+
         self.onDataUpdaterPluginMessage = function (plugin, data) {
             if (plugin != "sdwire") {
                 return;
@@ -19,7 +66,7 @@ $(function () {
             if (data.hasOwnProperty("progress")) {
                 self.filesViewModel._setProgressBar(
                     data["progress"],
-                    "Uploading to sdwire - " + data["progress"] + "%...",
+                    self.progressText(data),
                     false
                 );
             }
@@ -0,0 +1,179 @@
+import os
+import threading
+
+from . import _vfatdir
+
+# Characters handled specially by the kernel when it derives a short name,
+# see vfat_skip_char()/vfat_replace_char() in fs/fat/namei_vfat.c
+_SKIP_CHARS = " ."
+_REPLACE_CHARS = "+=,;[]"
+
+# default codepage of the vfat driver
+_CODEPAGE = "cp437"
+
+
+def _short_char(c, info):
+    if c in _SKIP_CHARS:
+        info["valid"] = False
+        return ""
+    if c in _REPLACE_CHARS:
+        info["valid"] = False
+        return "_"
+
+    try:
+        raw = c.encode(_CODEPAGE)
+    except UnicodeEncodeError:
+        info["valid"] = False
+        return "_"
+
+    upper = c.upper()
+    try:
+        if len(upper.encode(_CODEPAGE)) != 1:
+            upper = c
+    except UnicodeEncodeError:
+        upper = c
+
+    if raw[0] >= 0x7F:
+        info["lower"] = info["upper"] = False
+    elif upper.isalpha():
+        if upper == c:
+            info["lower"] = False
+        else:
+            info["upper"] = False
+    return upper
+
+
+def _format(base, ext):
+    return base + "." + ext if ext else base
+
+
+def make_short_name(long_name, existing=()):
+    """
+    Derive the 8.3 name the Linux vfat driver (default ``shortname=mixed``,
+    numeric tails) gives a new file called ``long_name`` in a directory whose
+    current short names are ``existing`` (upper case ``BASE.EXT``).
+
+    Returns ``(short_name, needs_lfn)`` with the short name in upper case,
+    or None as short name when the kernel would fall back to its time based
+    tails after ``~9``.
+    """
+    ulen = len(long_name)
+
+    # only the last dot starts an extension, a trailing dot means none
+    dot = long_name.rfind(".")
+    if dot == -1 or dot == ulen - 1:
+        size = ulen
+        ext_start = None
+    elif all(c in _SKIP_CHARS for c in long_name[:dot]):
+        # names like "...test" use the extension as base name
+        size = ulen
+        ext_start = None
+    else:
+        size = dot
+        ext_start = dot + 1
+
+    is_shortname = True
+    base_info = dict(valid=True, lower=True, upper=True)
+    ext_info = dict(valid=True, lower=True, upper=True)
+
+    base = ""
+    for i in range(size):
+        c = _short_char(long_name[i], base_info)
+        if not c:
+            continue
+        base += c
+        if len(base) >= 8:
+            if i + 1 < size:
+                is_shortname = False
+            break
+    if not base:
+        return None, True
+
+    ext = ""
+    if ext_start is not None:
+        for i in range(ext_start, ulen):
+            c = _short_char(long_name[i], ext_info)
+            if not c:
+                continue
+            ext += c
+            if len(ext) >= 3:
+                if i + 1 != ulen:
+                    is_shortname = False
+                break
+
+    existing = set(name.upper() for name in existing)
+
+    if is_shortname and base_info["valid"] and ext_info["valid"]:
+        # lossless 8.3 name, stored as is (upper case)
+        return _format(base, ext), not (base_info["upper"] and ext_info["upper"])
+
+    if len(base) > 6:
+        base = base[:6]
+    for i in range(1, 10):
+        name = _format("{}~{}".format(base, i), ext)
+        if name not in existing:
+            return name, True
+
+    return None, True
+
+
+def predict_short_name(long_name, existing=()):
+    # short name as printers list it (lower case), None if unpredictable
+    short_name, _needs_lfn = make_short_name(long_name, existing)
+    return short_name.lower() if short_name else None
+
+
+class ShortNameCache(object):
+    """
+    Long to short name mapping of one directory on a mounted vfat card,
+    read with a single VFAT_IOCTL_READDIR_BOTH pass. Lives for one mount
+    session; ``invalidate()`` it when the directory changed behind its back.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._names = None
+
+    def _load(self):
+        names = {}
+        for long_name, short_name in _vfatdir.get_short_names(self.path).items():
+            names[os.fsdecode(long_name).lower()] = os.fsdecode(short_name)
+        return names
+
+    def _get_names(self):
+        if self._names is None:
+            self._names = self._load()
+        return self._names
+
+    def invalidate(self):
+        with self._lock:
+            self._names = None
+
+    def lookup(self, long_name):
+        with self._lock:
+            short_name = self._get_names().get(long_name.lower())
+        return short_name.lower() if short_name else None
+
+    def items(self):
+        # (long name, short name) pairs, both lower case
+        with self._lock:
+            return [
+                (long_name, short_name.lower())
+                for long_name, short_name in self._get_names().items()
+            ]
+
+    def short_names(self):
+        with self._lock:
+            return set(name.upper() for name in self._get_names().values())
+
+    def add(self, long_name, short_name):
+        with self._lock:
+            self._get_names()[long_name.lower()] = short_name.upper()
+
+    def predict(self, long_name):
+        # name of an existing file doesn't change when it is overwritten
+        short_name = self.lookup(long_name)
+        if short_name:
+            return short_name
+        return predict_short_name(long_name, self.short_names())
@@ -65,6 +65,8 @@ additional_setup_parameters = {"python_requires": ">=3,<4"}
 
 # Additional requirements for optional install options and/or OS-specific dependencies
 extra_requires = {
+    # mux_backend "ftdi", drives the sdwire without sd-mux-ctrl
+    "ftdi": ["pyftdi"],
     # Dependencies for development
     "develop": [
         # Testing dependencies
@@ -8,49 +8,67 @@
 
 #include <Python.h>
 
-/* Returns short vfat filename for specified directory and long filename */
-static PyObject *vfat_get_short_name(PyObject *self, PyObject *args) {
-	char *dir = NULL, *long_filename = NULL;
+/* Returns dict mapping long to short vfat filename for all entries in specified directory */
+static PyObject *vfat_get_short_names(PyObject *self, PyObject *args) {
+	char *dir = NULL;
 	int fd, ret;
 	struct __fat_dirent entry[2];
+	PyObject *names, *long_name, *short_name;
 
 	/* Parse arguments */
-	if(!PyArg_ParseTuple(args, "ss", &dir, &long_filename)) {
+	if(!PyArg_ParseTuple(args, "s", &dir)) {
 		return NULL;
 	}
 
+	names = PyDict_New();
+	if (names == NULL)
+		return NULL;
+
 	fd = open(dir, O_RDONLY | O_DIRECTORY);
 	if (fd == -1) {
+		Py_DECREF(names);
 		PyErr_SetFromErrnoWithFilename(PyExc_OSError, dir);
 		return NULL;
 	}
 
 	for (;;) {
+		Py_BEGIN_ALLOW_THREADS
 		ret = ioctl( fd, VFAT_IOCTL_READDIR_BOTH, entry);
+		Py_END_ALLOW_THREADS
 		if (ret < 0) {
 			PyErr_SetFromErrnoWithFilename(PyExc_OSError, dir);
 			close(fd);
+			Py_DECREF(names);
 			return NULL;
 		}
 		if (ret == 0)
 			break;
 
-		if (strcasecmp(entry[1].d_name, long_filename) == 0) {
-			/* printf("%s -> '%s'\n", entry[0].d_name, entry[1].d_name); */
+		if (strcmp(entry[0].d_name, ".") == 0 || strcmp(entry[0].d_name, "..") == 0)
+			continue;
+
+		/* entries without long name have an empty one */
+		short_name = PyBytes_FromString(entry[0].d_name);
+		long_name = PyBytes_FromString(entry[1].d_name[0] ? entry[1].d_name : entry[0].d_name);
+		if (short_name == NULL || long_name == NULL || PyDict_SetItem(names, long_name, short_name) < 0) {
+			Py_XDECREF(short_name);
+			Py_XDECREF(long_name);
 			close(fd);
-			return PyBytes_FromString(entry[0].d_name);
+			Py_DECREF(names);
+			return NULL;
 		}
+		Py_DECREF(short_name);
+		Py_DECREF(long_name);
 	}
 
 	close(fd);
 
-	Py_INCREF(Py_None);
-	return Py_None;
+	return names;
 }
 
 static PyMethodDef vfatMethods[] = {
-	{"get_short_name",  vfat_get_short_name, METH_VARARGS,
-		"Get short vfat file name for long filename in specified dir."},
+	{"get_short_names",  vfat_get_short_names, METH_VARARGS,
+		"Get dict of long to short vfat file names of all entries in specified dir."},
 	{NULL, NULL, 0, NULL}
 };
 
@@ -0,0 +1,206 @@
+import errno
+import hashlib
+import os
+
+import pytest
+
+from octoprint_sdwire import copier
+
+SIZE = 3 * 1024 * 1024 + 1234
+BUFSIZE = 256 * 1024
+
+
+@pytest.fixture
+def src(tmp_path):
+    path = tmp_path / "src.gcode"
+    path.write_bytes(os.urandom(SIZE))
+    return str(path)
+
+
+def failing(errno_, after=0):
+    # kernel copy function copying ``after`` chunks before failing
+    calls = []
+
+    def copy(fsrc, fdst, count):
+        calls.append(count)
+        if len(calls) > after:
+            raise OSError(errno_, os.strerror(errno_))
+        return os.write(fdst, os.read(fsrc, count))
+
+    return copy
+
+
+def copy(src, dst, **kwargs):
+    progress = []
+    result = copier.copy_file(
+        src,
+        dst,
+        progress_cb=lambda copied, total: progress.append((copied, total)),
+        bufsize=BUFSIZE,
+        **kwargs
+    )
+    with open(src, "rb") as a, open(dst, "rb") as b:
+        assert a.read() == b.read()
+    assert result["copied"] == SIZE
+    assert progress[-1] == (SIZE, SIZE)
+    assert [copied for copied, _total in progress] == sorted(
+        copied for copied, _total in progress
+    )
+    return result, progress
+
+
+@pytest.mark.skipif(
+    not hasattr(os, "copy_file_range"), reason="copy_file_range not available"
+)
+def test_copy_file_range(src, tmp_path):
+    result, _progress = copy(src, str(tmp_path / "dst"))
+    assert result["method"] == "copy_file_range"
+
+
+def test_fallback_order(src, tmp_path, monkeypatch):
+    monkeypatch.setattr(copier, "_copy_file_range", failing(errno.EXDEV))
+    result, _progress = copy(src, str(tmp_path / "dst"))
+    assert result["method"] == "sendfile"
+
+    monkeypatch.setattr(copier, "_sendfile", failing(errno.ENOSYS))
+    result, _progress = copy(src, str(tmp_path / "dst"))
+    assert result["method"] == "buffered"
+
+
+def test_fallback_after_partial_copy(src, tmp_path, monkeypatch):
+    # the next method carries on where the failed one stopped
+    monkeypatch.setattr(copier, "_copy_file_range", failing(errno.EINVAL, after=3))
+    result, progress = copy(src, str(tmp_path / "dst"))
+    assert result["method"] == "sendfile"
+    assert progress[:3] == [(BUFSIZE * i, SIZE) for i in (1, 2, 3)]
+    assert len(progress) == -(-SIZE // BUFSIZE)
+
+    monkeypatch.setattr(copier, "_sendfile", failing(errno.EINVAL, after=2))
+    result, progress = copy(src, str(tmp_path / "dst"))
+    assert result["method"] == "buffered"
+    assert len(progress) == -(-SIZE // BUFSIZE)
+
+
+def test_real_error_is_raised(src, tmp_path, monkeypatch):
+    monkeypatch.setattr(copier, "_copy_file_range", failing(errno.EIO, after=1))
+    monkeypatch.setattr(copier, "_sendfile", failing(errno.EIO, after=1))
+    with pytest.raises(OSError) as e:
+        copier.copy_file(src, str(tmp_path / "dst"), bufsize=BUFSIZE)
+    assert e.value.errno == errno.EIO
+
+
+def test_buffered(src, tmp_path):
+    result, _progress = copy(src, str(tmp_path / "dst"), zero_copy=False)
+    assert result["method"] == "buffered"
+
+
+def test_hasher_forces_buffered(src, tmp_path):
+    hasher = hashlib.sha256()
+    result, _progress = copy(src, str(tmp_path / "dst"), hasher=hasher)
+    assert result["method"] == "buffered"
+    with open(src, "rb") as f:
+        assert hasher.hexdigest() == hashlib.sha256(f.read()).hexdigest()
+
+
+def test_writeback_limit(src, tmp_path):
+    result, progress = copy(src, str(tmp_path / "dst"), writeback_limit=512 * 1024)
+    # progress only counts what is on the device, whole windows of 256 KiB
+    assert all(copied % BUFSIZE == 0 for copied, _total in progress[:-1])
+
+
+def test_writeback_windows(tmp_path, monkeypatch):
+    synced = []
+    monkeypatch.setattr(
+        copier, "sync_range", lambda fd, offset, nbytes, flags: synced.append(flags)
+    )
+    with open(str(tmp_path / "dst"), "wb") as f:
+        writeback = copier.WriteBack(f.fileno(), 200)
+        writeback.update(99)
+        assert writeback.durable == 0
+        # the first window is submitted, nothing waited for yet
+        writeback.update(150)
+        assert writeback.durable == 0
+        # submitting the next one waits for the one before
+        writeback.update(250)
+        assert writeback.durable == 100
+        writeback.update(400)
+        assert writeback.durable == 300
+        writeback.finish(420)
+        assert writeback.durable == 420
+    assert synced
+
+
+def test_checkpoints(src, tmp_path):
+    checkpoints = []
+    copy(
+        src,
+        str(tmp_path / "dst"),
+        checkpoint_cb=checkpoints.append,
+        checkpoint_interval=1024 * 1024,
+    )
+    assert checkpoints == [1024 * 1024, 2 * 1024 * 1024, 3 * 1024 * 1024]
+
+
+def test_verify_prefix(src, tmp_path):
+    dst = tmp_path / "dst"
+    with open(src, "rb") as f:
+        data = f.read()
+    dst.write_bytes(data)
+    hasher = hashlib.sha256()
+    assert copier.verify_prefix(src, str(dst), SIZE, BUFSIZE, hasher) == SIZE
+    assert hasher.hexdigest() == hashlib.sha256(data).hexdigest()
+    # only up to the limit
+    assert copier.verify_prefix(src, str(dst), 1000, BUFSIZE) == 1000
+
+
+def test_verify_prefix_mismatch(src, tmp_path):
+    dst = tmp_path / "dst"
+    with open(src, "rb") as f:
+        data = bytearray(f.read())
+    data[2 * BUFSIZE + 10] ^= 0xFF
+    dst.write_bytes(bytes(data))
+    hasher = hashlib.sha256()
+    # whole matching blocks only
+    assert copier.verify_prefix(src, str(dst), SIZE, BUFSIZE, hasher) == 2 * BUFSIZE
+    assert hasher.hexdigest() == hashlib.sha256(data[: 2 * BUFSIZE]).hexdigest()
+    # a destination shorter than the limit
+    dst.write_bytes(bytes(data[:1000]))
+    assert copier.verify_prefix(src, str(dst), SIZE, BUFSIZE) == 0
+
+
+@pytest.mark.parametrize("zero_copy", [True, False])
+def test_resume_truncated(src, tmp_path, zero_copy):
+    # an interrupted copy left the first part of the file
+    dst = tmp_path / "dst"
+    with open(src, "rb") as f:
+        data = f.read()
+    dst.write_bytes(data[: 5 * BUFSIZE // 2])
+    hasher = hashlib.sha256()
+    resume_from = copier.verify_prefix(src, str(dst), 5 * BUFSIZE // 2, BUFSIZE, hasher)
+    assert resume_from == 5 * BUFSIZE // 2
+
+    result, progress = copy(
+        src,
+        str(dst),
+        zero_copy=zero_copy,
+        hasher=None if zero_copy else hasher,
+        resume_from=resume_from,
+    )
+    assert result["resumed"] == resume_from
+    assert progress[0][0] > resume_from
+    if not zero_copy:
+        assert hasher.hexdigest() == hashlib.sha256(data).hexdigest()
+
+
+def test_resume_after_mismatch(src, tmp_path):
+    # the card's copy differs in the second block, it is copied again from
+    # there and what followed is replaced
+    dst = tmp_path / "dst"
+    with open(src, "rb") as f:
+        data = bytearray(f.read())
+    data[BUFSIZE + 1] ^= 0xFF
+    dst.write_bytes(bytes(data) + b"junk")
+    resume_from = copier.verify_prefix(src, str(dst), SIZE, BUFSIZE)
+    assert resume_from == BUFSIZE
+    result, _progress = copy(src, str(dst), resume_from=resume_from)
+    assert result["copied"] == SIZE
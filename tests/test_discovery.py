@@ -0,0 +1,100 @@
+import os
+import threading
+import time
+
+import pytest
+
+from octoprint_sdwire import discovery
+
+UUID = "ABCD-1234"
+
+
+@pytest.fixture
+def by_uuid(tmp_path):
+    # fake /dev/disk/by-uuid and the device node its links point to
+    links = tmp_path / "by-uuid"
+    links.mkdir()
+    device = tmp_path / "sda1"
+    device.write_bytes(b"")
+    return str(links), str(device)
+
+
+def add_link_later(links, device, delay, name=UUID):
+    def add():
+        time.sleep(delay)
+        os.symlink(device, os.path.join(links, name))
+
+    thread = threading.Thread(target=add)
+    thread.start()
+    return thread
+
+
+def test_find_device(by_uuid):
+    links, device = by_uuid
+    assert discovery.find_device(UUID, links) is None
+    os.symlink(device, os.path.join(links, UUID))
+    assert discovery.find_device(UUID.lower(), links) == os.path.realpath(device)
+    os.unlink(os.path.join(links, UUID))
+    assert discovery.find_device(UUID, links) is None
+
+
+def test_find_device_dangling_link(by_uuid):
+    links, device = by_uuid
+    os.symlink(device, os.path.join(links, UUID))
+    os.unlink(device)
+    assert discovery.find_device(UUID, links) is None
+
+
+def test_find_device_missing_dir(tmp_path):
+    assert discovery.find_device(UUID, str(tmp_path / "missing")) is None
+
+
+def test_wait_for_device_present(by_uuid):
+    links, device = by_uuid
+    os.symlink(device, os.path.join(links, UUID))
+    assert discovery.wait_for_device(UUID, 0, links) == os.path.realpath(device)
+
+
+def test_wait_for_device_inotify_wakeup(by_uuid, monkeypatch):
+    links, device = by_uuid
+    fd = discovery._inotify_watch(links)
+    if fd is None:
+        pytest.skip("inotify not available")
+    os.close(fd)
+    # polling would only find the link after 30s
+    monkeypatch.setattr(discovery, "POLL_INTERVAL", 30)
+    # an unrelated link wakes the wait up without ending it
+    add_link_later(links, device, 0.05, name="0000-0000")
+    thread = add_link_later(links, device, 0.2)
+    start = time.monotonic()
+    result = discovery.wait_for_device(UUID, 5, links)
+    elapsed = time.monotonic() - start
+    thread.join()
+    assert result == os.path.realpath(device)
+    assert elapsed < 2
+
+
+def test_wait_for_device_polling_fallback(by_uuid, monkeypatch):
+    links, device = by_uuid
+    monkeypatch.setattr(discovery, "_inotify_watch", lambda path: None)
+    thread = add_link_later(links, device, 0.2)
+    result = discovery.wait_for_device(UUID, 5, links)
+    thread.join()
+    assert result == os.path.realpath(device)
+
+
+@pytest.mark.parametrize("inotify", [True, False])
+def test_wait_for_device_timeout(by_uuid, monkeypatch, inotify):
+    links, _device = by_uuid
+    if not inotify:
+        monkeypatch.setattr(discovery, "_inotify_watch", lambda path: None)
+    start = time.monotonic()
+    assert discovery.wait_for_device(UUID, 0.3, links) is None
+    assert 0.3 <= time.monotonic() - start < 2
+
+
+def test_wait_for_device_link_removed(by_uuid):
+    links, device = by_uuid
+    os.symlink(device, os.path.join(links, UUID))
+    os.unlink(os.path.join(links, UUID))
+    assert discovery.wait_for_device(UUID, 0.2, links) is None
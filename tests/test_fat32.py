@@ -0,0 +1,210 @@
+import os
+import shutil
+import struct
+import subprocess
+import sys
+
+import pytest
+
+from octoprint_sdwire import fat32
+
+MKFS_VFAT = shutil.which("mkfs.vfat") or shutil.which("mkfs.fat")
+FSCK_VFAT = shutil.which("fsck.vfat") or shutil.which("fsck.fat")
+
+IMAGE_SIZE = 64 << 20
+
+
+def make_image(path, mkfs):
+    if mkfs == "mkfs.vfat":
+        if MKFS_VFAT is None:
+            pytest.skip("mkfs.vfat not installed")
+        with open(path, "wb") as f:
+            f.truncate(IMAGE_SIZE)
+        subprocess.check_output(
+            [MKFS_VFAT, "-F", "32", "-s", "1", "-n", "SDWIRE", path],
+            stderr=subprocess.STDOUT,
+        )
+    else:
+        fat32.mkfs(path, IMAGE_SIZE, cluster_size=512)
+
+
+@pytest.fixture(params=["mkfs.vfat", "builtin"])
+def image(request, tmp_path):
+    path = str(tmp_path / "card.img")
+    make_image(path, request.param)
+    return path
+
+
+def check_volume(path):
+    """
+    fsck.vfat -n where installed. The structural checks below run always:
+    identical FAT copies, chains matching the file sizes, no cross-linked or
+    lost clusters and a correct FSInfo free count.
+    """
+    if FSCK_VFAT:
+        ok, output = fat32.fsck(path, fsck_vfat=FSCK_VFAT)
+        assert ok, output
+
+    volume = fat32.Fat32Volume(path)
+    try:
+        fats = [
+            volume._pread(volume.fat_size, volume.fat_offset + index * volume.fat_size)
+            for index in volume._fats
+        ]
+        assert all(fat == fats[0] for fat in fats)
+
+        used = set(volume.chain(volume.root_cluster))
+        for entry in volume.list_dir():
+            clusters = volume.chain(entry["cluster"]) if entry["cluster"] else []
+            assert len(clusters) == -(-entry["size"] // volume.cluster_size), entry
+            assert not used.intersection(clusters), entry
+            used.update(clusters)
+
+        allocated = set(
+            cluster
+            for cluster in range(2, volume.cluster_count + 2)
+            if volume._get(cluster)
+        )
+        assert allocated == used
+
+        if volume._fsinfo_offset is not None:
+            free = struct.unpack_from(
+                "<I", volume._pread(512, volume._fsinfo_offset), 488
+            )[0]
+            assert free == volume.free_clusters()
+    finally:
+        volume.close()
+
+
+def write(volume, tmp_path, name, size):
+    src = tmp_path / "src"
+    data = os.urandom(size)
+    src.write_bytes(data)
+    result = volume.write_file(name, str(src))
+    assert result["copied"] == size
+    return result, data
+
+
+def names(volume):
+    return dict(
+        (entry["long_name"], entry["short_name"]) for entry in volume.list_dir()
+    )
+
+
+def test_write_overwrite_delete(image, tmp_path):
+    volume = fat32.Fat32Volume(image)
+    files = {}
+    try:
+        for name, size in (
+            ("BENCHY.GCO", 3000),
+            ("a.gcode", 0),
+            ("lower.gco", 512),
+            ("Long File Name With Spaces.gcode", 70000),
+            ("zażółć.gcode", 1500),
+        ):
+            _result, files[name] = write(volume, tmp_path, name, size)
+
+        # numeric tails up to ~9, then hashed ones
+        for i in range(12):
+            name = "longprefix part {}.gcode".format(i)
+            _result, files[name] = write(volume, tmp_path, name, 1000 + i)
+    finally:
+        volume.close()
+    check_volume(image)
+
+    volume = fat32.Fat32Volume(image)
+    try:
+        listed = names(volume)
+        assert set(listed) == set(files)
+        assert listed["BENCHY.GCO"] == "BENCHY.GCO"
+        assert listed["Long File Name With Spaces.gcode"] == "LONGFI~1.GCO"
+        tails = [listed["longprefix part {}.gcode".format(i)] for i in range(12)]
+        assert len(set(tails)) == 12
+        assert "LONGPR~9.GCO" in tails
+        assert any("~" in tail and not tail.startswith("LONGPR~") for tail in tails)
+        for name, data in files.items():
+            assert volume.read_file(name) == data
+
+        # overwrite larger and smaller, delete some
+        _result, files["BENCHY.GCO"] = write(volume, tmp_path, "BENCHY.GCO", 90000)
+        _result, files["Long File Name With Spaces.gcode"] = write(
+            volume, tmp_path, "Long File Name With Spaces.gcode", 10
+        )
+        for name in ("a.gcode", "longprefix part 3.gcode", "longprefix part 11.gcode"):
+            assert volume.delete(name)
+            del files[name]
+        assert not volume.delete("missing.gcode")
+        # reuses the freed slots and tail
+        _result, files["longprefix part 99.gcode"] = write(
+            volume, tmp_path, "longprefix part 99.gcode", 2000
+        )
+    finally:
+        volume.close()
+    check_volume(image)
+
+    volume = fat32.Fat32Volume(image)
+    try:
+        assert set(names(volume)) == set(files)
+        for name, data in files.items():
+            assert volume.read_file(name) == data
+    finally:
+        volume.close()
+
+
+def test_rename(image, tmp_path):
+    volume = fat32.Fat32Volume(image)
+    try:
+        _result, data = write(volume, tmp_path, "old name.gcode", 5000)
+        write(volume, tmp_path, "target.gcode", 7000)
+        assert volume.rename("old name.gcode", "target.gcode") == "target~1.gco"
+        assert set(names(volume)) == {"target.gcode"}
+        assert volume.read_file("target.gcode") == data
+    finally:
+        volume.close()
+    check_volume(image)
+
+
+def test_rename_to_own_short_name(image, tmp_path):
+    volume = fat32.Fat32Volume(image)
+    try:
+        _result, data = write(volume, tmp_path, "Long Name.gcode", 5000)
+        short_name = names(volume)["Long Name.gcode"]
+        assert volume.rename("Long Name.gcode", short_name) == short_name.lower()
+        assert set(names(volume)) == {short_name}
+        assert volume.read_file(short_name) == data
+        # the clusters are still in use, a new file doesn't get them
+        write(volume, tmp_path, "other.gcode", 5000)
+        assert volume.read_file(short_name) == data
+    finally:
+        volume.close()
+    check_volume(image)
+
+
+def test_free_space_error(image, tmp_path):
+    volume = fat32.Fat32Volume(image)
+    try:
+        src = tmp_path / "big"
+        with open(str(src), "wb") as f:
+            f.truncate(volume.free_bytes() + volume.cluster_size)
+        with pytest.raises(fat32.Fat32Error):
+            volume.write_file("big.gcode", str(src))
+        assert "big.gcode" not in names(volume)
+    finally:
+        volume.close()
+    check_volume(image)
+
+
+def test_hashed_short_name_is_stable():
+    code = (
+        "from octoprint_sdwire import fat32;"
+        "v = fat32.Fat32Volume.__new__(fat32.Fat32Volume);"
+        "taken = set('LONGPR~{}.GCO'.format(i) for i in range(1, 10));"
+        "print(v._unique_short_name('longprefix part x.gcode', taken)[0])"
+    )
+    outputs = set(
+        subprocess.check_output(
+            [sys.executable, "-c", code], env=dict(os.environ, PYTHONHASHSEED=seed)
+        )
+        for seed in ("1", "2")
+    )
+    assert len(outputs) == 1
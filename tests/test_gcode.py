@@ -0,0 +1,189 @@
+import struct
+import zlib
+
+import pytest
+
+from octoprint_sdwire import gcode
+
+GCODE = b"".join(
+    [
+        b"; generated by PrusaSlicer 2.6.1\n",
+        b"; thumbnail begin 16x16 8\n; AAAA=\n; thumbnail end\n",
+        b"G28 ; home\nM104 S215\n",
+        b"".join(
+            b"G1 X%.6f Y%.6f E%.7f F1500.000\n" % (i % 200, i % 180, i / 1000.0)
+            for i in range(20000)
+        ),
+        b"M84\n",
+        b"; filament used [mm] = 1234.56\n",
+        b"; filament used [g] = 3.68\n",
+        b"; estimated printing time (normal mode) = 22m 47s\n",
+        b"; prusaslicer_config = begin\n",
+        b"; filament_type = PLA\n",
+        b"; nozzle_diameter = 0.4\n",
+        b"; printer_model = MK4\n",
+        b"; start_gcode = M17 ; enable steppers\\nG90\n",
+        b"; prusaslicer_config = end\n",
+    ]
+)
+
+
+def read_bgcode(path):
+    """
+    Blocks of a .bgcode file as (type, params, data), checking the header,
+    every CRC and the order of the metadata blocks.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    assert struct.unpack_from("<4sIH", data) == (b"GCDE", 1, 1)
+    pos = 10
+    blocks = []
+    while pos < len(data):
+        block_type, compression, size = struct.unpack_from("<HHI", data, pos)
+        assert compression == 0
+        end = pos + 8 + 2 + size
+        (crc,) = struct.unpack_from("<I", data, end)
+        assert crc == zlib.crc32(data[pos:end])
+        blocks.append((block_type, data[pos + 8 : pos + 10], data[pos + 10 : end]))
+        pos = end + 4
+    assert pos == len(data)
+
+    types = [block[0] for block in blocks]
+    assert types[:4] == [0, 3, 4, 2]
+    assert set(types[4:]) == {1}
+    return blocks
+
+
+def unmeatpack(data):
+    # MeatPack decoder as in firmware: 0xff 0xff starts a command, packed
+    # bytes hold the first character in the low nibble
+    characters = b"0123456789. \nGX"
+    out = bytearray()
+    packing = no_spaces = False
+    pos = 0
+    while pos < len(data):
+        if data[pos : pos + 2] == b"\xff\xff":
+            command = data[pos + 2]
+            packing = {251: True, 250: False}.get(command, packing)
+            no_spaces = {247: True, 246: False}.get(command, no_spaces)
+            pos += 3
+            continue
+        byte = data[pos]
+        pos += 1
+        if not packing:
+            out.append(byte)
+            continue
+        for code in (byte & 0xF, byte >> 4):
+            if code == 0b1111:
+                out.append(data[pos])
+                pos += 1
+            elif code == 0b1011 and no_spaces:
+                out += b"E"
+            else:
+                out.append(characters[code])
+    return bytes(out)
+
+
+def expected_gcode(data):
+    # what is left of the gcode after encoding: comment lines, moves without
+    # spaces and comments, other commands without comments
+    lines = []
+    for line in data.splitlines():
+        if not line.startswith(b";"):
+            line = line.split(b";")[0].rstrip()
+            if line.startswith(b"G"):
+                line = line.replace(b" ", b"")
+        if line:
+            lines.append(line)
+    return lines
+
+
+def metadata(block):
+    return dict(line.split("=", 1) for line in block[2].decode("utf-8").splitlines())
+
+
+@pytest.fixture
+def bgcode(tmp_path):
+    src = tmp_path / "part.gcode"
+    src.write_bytes(GCODE)
+    dst = str(tmp_path / "part.bgcode")
+    pipeline = gcode.build_pipeline(bgcode=True)
+    gcode.copy_file(str(src), dst, pipeline, bufsize=4096)
+    return dst
+
+
+def test_bgcode_blocks(bgcode):
+    blocks = read_bgcode(bgcode)
+    gcode_blocks = [block for block in blocks if block[0] == 1]
+    assert len(gcode_blocks) > 1
+    assert all(block[1] == struct.pack("<H", 2) for block in gcode_blocks)
+    decoded = [unmeatpack(block[2]) for block in gcode_blocks]
+    assert all(len(data) <= gcode.BgcodeEncoder.BLOCK_SIZE for data in decoded)
+    assert expected_gcode(b"".join(decoded)) == expected_gcode(GCODE)
+
+
+def test_bgcode_is_smaller(tmp_path):
+    src = tmp_path / "part.gcode"
+    src.write_bytes(GCODE)
+    pipeline = gcode.build_pipeline(bgcode=True)
+    result = gcode.copy_file(str(src), str(tmp_path / "part.bgcode"), pipeline)
+    assert result["written"] < len(GCODE) * 0.7
+
+
+def test_meatpack_pairs():
+    assert gcode.meatpack([b"G1 X1"]) == b"\xff\xff\xfb\xff\xff\xf7\x1d\x1e\xcc"
+    # odd lines are padded with a newline, unpacked characters follow their
+    # byte, comments stay text
+    assert gcode.meatpack([b"M84", b"; end"]) == (
+        b"\xff\xff\xfb\xff\xff\xf7\x8fM\xc4\xff\xff\xfa; end\n"
+    )
+
+
+def test_bgcode_metadata(bgcode):
+    blocks = read_bgcode(bgcode)
+    printer, print_, slicer = (metadata(block) for block in blocks[1:4])
+    assert printer == {
+        "printer_model": "MK4",
+        "filament_type": "PLA",
+        "nozzle_diameter": "0.4",
+        "filament used [mm]": "1234.56",
+        "filament used [g]": "3.68",
+        "estimated printing time (normal mode)": "22m 47s",
+    }
+    assert print_ == {
+        "filament used [mm]": "1234.56",
+        "filament used [g]": "3.68",
+        "estimated printing time (normal mode)": "22m 47s",
+    }
+    assert slicer["start_gcode"] == "M17 ; enable steppers\\nG90"
+    assert len(slicer) == 4
+
+
+def test_bgcode_printer_model_setting(tmp_path):
+    src = tmp_path / "part.gcode"
+    src.write_bytes(GCODE)
+    dst = str(tmp_path / "part.bgcode")
+    pipeline = gcode.build_pipeline(bgcode=True, printer_model="MK3.9")
+    gcode.copy_file(str(src), dst, pipeline)
+    assert metadata(read_bgcode(dst)[1])["printer_model"] == "MK3.9"
+
+
+def test_bgcode_libbgcode(bgcode, tmp_path):
+    pybgcode = pytest.importorskip("pybgcode")
+    f = pybgcode.open(bgcode, "rb")
+    try:
+        assert pybgcode.is_valid_binary_gcode(f, True) == pybgcode.EResult.Success
+    finally:
+        pybgcode.close(f)
+
+    ascii_path = str(tmp_path / "part.gcode.out")
+    src = pybgcode.open(bgcode, "rb")
+    dst = pybgcode.open(ascii_path, "wb")
+    try:
+        result = pybgcode.from_binary_to_ascii(src, dst, True)
+    finally:
+        pybgcode.close(src)
+        pybgcode.close(dst)
+    assert result == pybgcode.EResult.Success
+    with open(ascii_path, "rb") as f:
+        assert b"G1 X199.000000 Y19.000000" in f.read()
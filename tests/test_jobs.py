@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pytest
+
+from octoprint_sdwire import jobs, pool
+
+CARD = pool.Device("sd-wire_11", "ABCD-1234")
+OTHER = pool.Device("sd-wire_12", "5678-EF01")
+
+
+def add(queue, name, priority=0, device=CARD):
+    return queue.add(jobs.UploadJob(device, priority=priority, filename=name))
+
+
+def names(job_list):
+    return [job["filename"] for job in job_list]
+
+
+def test_priority_order():
+    queue = jobs.JobQueue()
+    for name, priority in (("a", 0), ("b", 0), ("sel", 10), ("c", 5), ("d", 0)):
+        add(queue, name, priority)
+    # first come first served within a priority
+    assert names(queue.queued()) == ["sel", "c", "a", "b", "d"]
+
+
+def test_prioritize():
+    queue = jobs.JobQueue()
+    a, b, c = add(queue, "a"), add(queue, "b"), add(queue, "c")
+    assert queue.prioritize(c.id, 20) is c
+    assert names(queue.queued()) == ["c", "a", "b"]
+    assert queue.prioritize(b.id, 20) is b
+    assert names(queue.queued()) == ["c", "b", "a"]
+    # only queued jobs
+    assert queue.take(CARD.uuid) is c
+    assert queue.prioritize(c.id, 30) is None
+    assert queue.prioritize(99, 30) is None
+    assert a.priority == 0
+
+
+def test_take_per_card():
+    queue = jobs.JobQueue()
+    add(queue, "a", device=OTHER)
+    add(queue, "b")
+    add(queue, "c", device=OTHER)
+    job = queue.take(CARD.uuid)
+    assert job["filename"] == "b"
+    assert job.state == jobs.RUNNING and job.started
+    assert queue.take(CARD.uuid) is None
+    assert names(queue.queued(OTHER.uuid)) == ["a", "c"]
+    assert queue.status()["running"][0]["filename"] == "b"
+
+
+def test_cancel_queued():
+    queue = jobs.JobQueue()
+    a, b = add(queue, "a"), add(queue, "b")
+    assert queue.cancel(a.id) is a
+    assert a.state == jobs.CANCELLED and a.cancelled
+    assert names(queue.queued()) == ["b"]
+    assert queue.take(CARD.uuid) is b
+    # finished jobs can't be cancelled again
+    assert queue.cancel(a.id) is None
+    assert queue.status()["finished"][0]["state"] == jobs.CANCELLED
+
+
+def test_cancel_running():
+    queue = jobs.JobQueue()
+    job = add(queue, "a")
+    queue.take(CARD.uuid)
+    assert queue.cancel(job.id) is job
+    # the copy notices at its next check, the session finishes the job
+    assert job.state == jobs.RUNNING
+    with pytest.raises(jobs.Cancelled):
+        job.check_cancelled()
+    queue.finish(job, jobs.CANCELLED)
+    queue.finish(job, jobs.FAILED, "ignored")
+    assert job.state == jobs.CANCELLED and job.error is None
+    assert queue.status() == dict(queued=[], running=[], finished=[job.to_dict()])
+
+
+def test_history():
+    queue = jobs.JobQueue(history=2)
+    for name in ("a", "b", "c"):
+        job = add(queue, name)
+        queue.take(CARD.uuid)
+        queue.finish(job, jobs.DONE)
+    assert [job["filename"] for job in queue.status()["finished"]] == ["c", "b"]
+
+
+def test_settle():
+    queue = jobs.JobQueue()
+    start = time.monotonic()
+    queue.settle(0)
+    assert time.monotonic() - start < 0.05
+
+    # each new job restarts the window
+    timer = threading.Timer(0.1, add, (queue, "a"))
+    timer.start()
+    start = time.monotonic()
+    queue.settle(0.2)
+    timer.join()
+    assert time.monotonic() - start >= 0.29
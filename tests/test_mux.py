@@ -0,0 +1,100 @@
+import pytest
+
+from octoprint_sdwire import mux
+
+
+class FlakyBackend(mux.FakeBackend):
+    # reports the other side for the first ``wrong`` switches
+    def __init__(self, wrong, **kwargs):
+        super(FlakyBackend, self).__init__(**kwargs)
+        self.wrong = wrong
+
+    def status(self):
+        if self.wrong:
+            self.wrong -= 1
+            return "usb" if self.mode == "sd" else "sd"
+        return self.mode
+
+
+def test_switch():
+    backend = mux.FakeBackend(mode="sd")
+    controller = mux.MuxController(backend)
+    assert controller.switch("usb")
+    assert backend.mode == "usb"
+    assert controller.mode == "usb"
+    assert backend.calls == ["usb"]
+
+
+def test_switch_skips_current_side():
+    backend = mux.FakeBackend(mode="usb")
+    controller = mux.MuxController(backend)
+    # side read from the hardware once, then tracked
+    assert controller.switch("usb")
+    assert controller.switch("usb")
+    assert backend.calls == []
+
+
+def test_switch_force():
+    backend = mux.FakeBackend(mode="sd")
+    controller = mux.MuxController(backend)
+    assert controller.switch("sd", force=True)
+    assert backend.calls == ["sd"]
+
+
+def test_switch_settle(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(mux.time, "sleep", sleeps.append)
+    backend = mux.FakeBackend(mode="sd")
+    controller = mux.MuxController(backend, settle=0.3)
+    # only forced toggles give the printer time to notice
+    assert controller.switch("usb")
+    assert sleeps == []
+    assert controller.switch("sd", force=True)
+    assert controller.switch("usb", force=True)
+    assert sleeps == [0.3, 0.3]
+
+
+def test_switch_unknown_mode():
+    controller = mux.MuxController(mux.FakeBackend())
+    with pytest.raises(ValueError):
+        controller.switch("printer")
+
+
+def test_switch_failure_retries():
+    backend = mux.FakeBackend(mode="sd", fail=True)
+    controller = mux.MuxController(backend, retries=3)
+    assert not controller.switch("usb")
+    assert backend.calls == ["usb"] * 3
+    # the side is unknown after a failure, the next switch asks again
+    assert controller.mode is None
+    backend.fail = False
+    assert controller.switch("usb")
+    assert backend.calls == ["usb"] * 4
+
+
+def test_switch_read_back_mismatch():
+    backend = FlakyBackend(1, mode="sd")
+    controller = mux.MuxController(backend, retries=3)
+    # skips the initial status read so the first read back is the wrong one
+    assert controller.switch("usb", force=True)
+    assert backend.calls == ["usb", "usb"]
+    assert controller.mode == "usb"
+
+
+def test_switch_read_back_gives_up():
+    backend = FlakyBackend(10, mode="sd")
+    controller = mux.MuxController(backend, retries=2)
+    assert not controller.switch("usb", force=True)
+    assert backend.calls == ["usb", "usb"]
+    assert controller.mode is None
+
+
+def test_invalidate_and_close():
+    backend = mux.FakeBackend(mode="sd")
+    controller = mux.MuxController(backend)
+    controller.switch("usb")
+    controller.invalidate()
+    assert controller.mode is None
+    assert controller.refresh() == "usb"
+    controller.close()
+    assert controller.mode is None
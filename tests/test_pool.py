@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+import time
+
+from octoprint_sdwire import pool
+
+DEVICES = """
+# serial       uuid        printer
+sd-wire_11     ABCD-1234   /dev/ttyACM0
+sd-wire_12     5678-EF01   _default
+
+sd-wire_13     1111-2222
+"""
+
+
+def test_parse_devices():
+    devices = pool.parse_devices(DEVICES)
+    assert [(d.serial, d.uuid, d.printer) for d in devices] == [
+        ("sd-wire_11", "ABCD-1234", "/dev/ttyACM0"),
+        ("sd-wire_12", "5678-EF01", "_default"),
+        ("sd-wire_13", "1111-2222", None),
+    ]
+    assert pool.parse_devices(None) == []
+
+
+def test_configured_devices():
+    assert len(pool.configured_devices(DEVICES, "sd-wire_1", "0000-0000")) == 3
+    # older single device configurations
+    (device,) = pool.configured_devices("", "sd-wire_1", "0000-0000")
+    assert (device.serial, device.uuid) == ("sd-wire_1", "0000-0000")
+    assert pool.configured_devices("", "", "") == []
+
+
+def test_select_device():
+    devices = pool.parse_devices(DEVICES)
+    assert pool.select_device(devices, port="/dev/ttyACM0") is devices[0]
+    assert pool.select_device(devices, port="/dev/ttyUSB0", profile="_default") is (
+        devices[1]
+    )
+    # the one without a printer for any other printer
+    assert pool.select_device(devices, port="/dev/ttyUSB0") is devices[2]
+    assert pool.select_device(devices[:2], port="/dev/ttyUSB0") is None
+    # a single device whatever it says
+    assert pool.select_device(devices[:1], port="/dev/ttyUSB0") is devices[0]
+
+
+def test_card_lock(tmp_path):
+    first = pool.HostScheduler(str(tmp_path / "locks"))
+    second = pool.HostScheduler(str(tmp_path / "locks"))
+    waited = []
+
+    def other_session():
+        with second.card("ABCD-1234") as wait:
+            waited.append(wait)
+
+    with first.card("ABCD-1234") as wait:
+        assert wait < 0.1
+        thread = threading.Thread(target=other_session)
+        thread.start()
+        # other cards aren't blocked
+        with second.card("5678-EF01"):
+            pass
+        time.sleep(0.2)
+        assert not waited
+    thread.join()
+    assert waited[0] >= 0.2
+
+
+def test_copy_slots(tmp_path):
+    scheduler = pool.HostScheduler(str(tmp_path), slots=2, poll=0.01)
+    slots = str(tmp_path / "copy-slots.json")
+    with scheduler.copy_slot():
+        with scheduler.copy_slot():
+            with open(slots) as f:
+                assert len(json.load(f)) == 2
+            waited = []
+
+            def third():
+                with scheduler.copy_slot() as wait:
+                    waited.append(wait)
+
+            thread = threading.Thread(target=third)
+            thread.start()
+            time.sleep(0.2)
+            assert not waited
+    thread.join()
+    assert waited[0] >= 0.2
+    with open(slots) as f:
+        assert json.load(f) == []
+
+
+def test_dead_tickets_dropped(tmp_path):
+    # a process that died holding a slot
+    pid = os.fork()
+    if not pid:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    with open(str(tmp_path / "copy-slots.json"), "w") as f:
+        json.dump(["{}:1:0".format(pid)], f)
+    scheduler = pool.HostScheduler(str(tmp_path), slots=1, poll=0.01)
+    with scheduler.copy_slot() as wait:
+        assert wait < 0.1
+
+
+def test_unusable_lock_dir(tmp_path):
+    (tmp_path / "file").write_text("")
+    scheduler = pool.HostScheduler(str(tmp_path / "file" / "locks"), slots=1)
+    # nothing is coordinated, nothing waits
+    with scheduler.card("ABCD-1234"), scheduler.copy_slot():
+        with scheduler.copy_slot() as wait:
+            assert wait < 0.1
@@ -0,0 +1,95 @@
+import pytest
+
+from octoprint_sdwire import progress
+
+MB = 1000000
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def reporter():
+    messages = []
+    clock = Clock()
+    reporter = progress.ProgressReporter(messages.append, clock=clock)
+    reporter.messages = messages
+    reporter.clock = clock
+    return reporter
+
+
+def test_throttled(reporter):
+    reporter.set_phase("copying", "a.gcode", total=100 * MB)
+    assert len(reporter.messages) == 1
+    assert reporter.messages[0]["progress"] == 0
+
+    # too soon
+    reporter.clock.now += 0.1
+    reporter.update(10 * MB)
+    assert len(reporter.messages) == 1
+    reporter.clock.now += 1
+    reporter.update(10 * MB)
+    assert len(reporter.messages) == 2
+    # too little
+    reporter.clock.now += 1
+    reporter.update(10 * MB + 500000)
+    assert len(reporter.messages) == 2
+    reporter.update(11 * MB)
+    assert len(reporter.messages) == 3
+    assert reporter.messages[-1]["progress"] == 11
+
+    # completion always goes out
+    reporter.update(100 * MB)
+    assert len(reporter.messages) == 4
+    assert reporter.messages[-1]["progress"] == 100
+    assert reporter.messages[-1]["eta"] == 0
+
+
+def test_phase_change_always_sent(reporter):
+    reporter.set_phase("copying", "a.gcode", total=MB)
+    reporter.set_phase("verifying")
+    assert [m["phase"] for m in reporter.messages] == ["copying", "verifying"]
+    # the filename and size carry over
+    assert reporter.messages[-1]["filename"] == "a.gcode"
+    assert reporter.messages[-1]["total"] == MB
+
+
+def test_speed_and_eta(reporter):
+    reporter.set_phase("copying", "a.gcode", total=100 * MB)
+    reporter.clock.now += 2
+    reporter.update(20 * MB)
+    message = reporter.messages[-1]
+    assert message["speed"] == 10.0
+    assert message["avg_speed"] == 10.0
+    assert message["eta"] == 8
+
+    # speed is since the last message, avg_speed since the start
+    reporter.clock.now += 2
+    reporter.update(60 * MB)
+    message = reporter.messages[-1]
+    assert message["speed"] == 20.0
+    assert message["avg_speed"] == 15.0
+
+
+def test_resumed(reporter):
+    # speeds count from where a resumed copy starts
+    reporter.set_phase("copying", "a.gcode", total=100 * MB, copied=50 * MB)
+    assert reporter.messages[-1]["progress"] == 50
+    reporter.clock.now += 1
+    reporter.update(60 * MB)
+    message = reporter.messages[-1]
+    assert message["avg_speed"] == 10.0
+    assert message["eta"] == 4
+
+
+def test_unknown_total(reporter):
+    reporter.set_phase("copying", "a.gcode")
+    reporter.clock.now += 1
+    reporter.update(MB)
+    assert reporter.percent == 0.0
+    assert reporter.messages[-1]["eta"] is None
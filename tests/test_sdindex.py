@@ -0,0 +1,70 @@
+from octoprint_sdwire import sdindex
+
+LONG = "benchy_0.2mm_PLA_MK3S_1h2m.gcode"
+
+FILES = [
+    dict(name="BENCHY~1.GCO", display=LONG[:30], date=1000),
+    dict(name="CUBE.GCO", display="cube.gcode", date=500),
+    dict(name="OLD.GCO"),
+    dict(display="no short name"),
+]
+
+
+def index():
+    index = sdindex.SdIndex()
+    assert not index.loaded
+    index.load(FILES)
+    assert index.loaded
+    return index
+
+
+def test_lookup():
+    sd = index()
+    assert sd.lookup("Cube.gcode") == "CUBE.GCO"
+    # listed cut off by the printer
+    assert sd.lookup(LONG) == "BENCHY~1.GCO"
+    assert sd.lookup(LONG, timestamp=1000) == "BENCHY~1.GCO"
+    # an older file under the same prefix isn't this one
+    assert sd.lookup(LONG, timestamp=1001) is None
+    # short prefixes don't match
+    assert sd.lookup("cube.gcode.bak") is None
+    assert sd.lookup("missing.gcode") is None
+
+
+def test_contains():
+    sd = index()
+    assert "cube.gco" in sd
+    assert "OLD.GCO" in sd
+    assert "new.gco" not in sd
+
+
+def test_written():
+    sd = index()
+    sd.add(LONG, "BENCHY~2.GCO", 2000)
+    assert sd.lookup(LONG) == "BENCHY~2.GCO"
+    assert "BENCHY~2.GCO" in sd
+    # kept until a listing shows it
+    sd.load(FILES)
+    assert sd.lookup(LONG) == "BENCHY~2.GCO"
+    sd.load(FILES + [dict(name="BENCHY~2.GCO", display=LONG, date=2000)])
+    sd.load(FILES)
+    assert sd.lookup(LONG) == "BENCHY~1.GCO"
+
+
+def test_remove():
+    sd = index()
+    sd.remove("cube.gcode")
+    assert sd.lookup("cube.gcode") is None
+    assert "CUBE.GCO" not in sd
+    sd.remove("benchy~1.gco")
+    assert sd.lookup(LONG) is None
+    assert "BENCHY~1.GCO" not in sd
+
+
+def test_invalidate():
+    sd = index()
+    sd.add("new.gcode", "NEW.GCO")
+    sd.invalidate()
+    assert not sd.loaded
+    assert sd.lookup("cube.gcode") is None
+    assert sd.lookup("new.gcode") is None
@@ -0,0 +1,56 @@
+import threading
+
+import pytest
+
+from octoprint_sdwire import sdstate
+
+
+@pytest.mark.parametrize(
+    "line, state",
+    [
+        ("echo:SD card ok", True),
+        ("Card successfully initialized", True),
+        ("echo:SD init fail", False),
+        ("echo:No media", False),
+        ("SD card released", False),
+        ("ok T:21.0 /0.0", None),
+    ],
+)
+def test_parse_line(line, state):
+    assert sdstate.parse_line(line) is state
+
+
+def test_wait_for_line():
+    waiter = sdstate.SdStateWaiter()
+    timer = threading.Timer(0.05, waiter.set_state, (True,))
+    timer.start()
+    result = waiter.wait(True, 5)
+    timer.join()
+    assert result["ok"] and result["source"] == "line"
+    # woken up by the line, not by the re-check interval
+    assert result["duration"] < sdstate.RECHECK_INTERVAL
+    assert list(waiter.waits) == [result]
+
+
+def test_wait_for_check():
+    waiter = sdstate.SdStateWaiter()
+    states = [True, True, False]
+    result = waiter.wait(False, 5, check=states.pop)
+    assert result == dict(
+        state="released",
+        duration=result["duration"],
+        timeout=5,
+        ok=True,
+        source="check",
+    )
+
+
+def test_reset():
+    waiter = sdstate.SdStateWaiter()
+    waiter.set_state(False)
+    assert waiter.wait(False, 0)["ok"]
+    # an old report doesn't count for the next M21/M22
+    waiter.reset()
+    result = waiter.wait(False, 0.05)
+    assert not result["ok"] and result["source"] is None
+    assert result["duration"] >= 0.05